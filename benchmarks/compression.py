@@ -0,0 +1,141 @@
+"""
+Compression ratio and CPU cost of the mux link codecs.
+
+    python -m benchmarks.compression [--size BYTES]
+
+For every codec and level the corpus is pushed through a per-stream
+compressor in MAX_PAYLOAD chunks, exactly like MuxSession does, and the
+ratio plus the CPU time per byte of compressing and decompressing is
+reported. The last table runs the same corpora over a real mux link on
+localhost and reads the numbers back from the edge session stats; both
+ends run in this process, so its CPU column covers both codecs.
+"""
+import argparse
+import asyncio
+import os
+import time
+
+from protocols.mux.client import MuxClient
+from protocols.mux.compression import (
+    DEFAULT_WINDOW_BITS,
+    Codec,
+    create_compressor,
+    create_decompressor,
+    zstandard,
+)
+from protocols.mux.frames import MAX_PAYLOAD
+from protocols.mux.server import MuxServerProtocol
+
+FIXTURE = os.path.join(
+    os.path.dirname(__file__), "../protocols/tests/fixtures", "http.bin"
+)
+
+
+def corpora(size: int) -> dict:
+    with open(FIXTURE, "rb") as f:
+        http = f.read()
+    lines = b"".join(
+        b'{"id": %d, "name": "user-%d", "active": %s}\n'
+        % (i, i % 977, b"true" if i % 3 else b"false")
+        for i in range(size // 40)
+    )
+    return {
+        "http": (http * (size // len(http) + 1))[:size],
+        "json": lines[:size],
+        "random": os.urandom(size),
+    }
+
+
+def codecs():
+    yield Codec.ZLIB, 1
+    yield Codec.ZLIB, 6
+    if zstandard is not None:
+        yield Codec.ZSTD, 1
+        yield Codec.ZSTD, 3
+
+
+def bench_codec(codec: Codec, level: int, window_bits: int, data: bytes):
+    compressor = create_compressor(codec, level, window_bits)
+    decompressor = create_decompressor(codec.value)
+
+    start = time.process_time()
+    frames = [
+        compressor.compress(data[i : i + MAX_PAYLOAD])
+        for i in range(0, len(data), MAX_PAYLOAD)
+    ]
+    compress_time = time.process_time() - start
+
+    start = time.process_time()
+    for frame in frames:
+        decompressor.decompress(frame)
+    decompress_time = time.process_time() - start
+
+    wire = sum(len(frame) for frame in frames)
+    return wire / len(data), compress_time, decompress_time
+
+
+class Echo(asyncio.Protocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.transport.write(data)
+
+
+async def bench_link(compression, data: bytes):
+    loop = asyncio.get_running_loop()
+    core = await loop.create_server(
+        lambda: MuxServerProtocol(compression=compression), "127.0.0.1", 0
+    )
+    origin = await loop.create_server(Echo, "127.0.0.1", 0)
+    port = core.sockets[0].getsockname()[1]
+    mux = MuxClient("127.0.0.1", port, connections=1, compression=compression)
+
+    start = time.process_time()
+    reader, writer = await mux.open_connection(
+        "127.0.0.1", origin.sockets[0].getsockname()[1]
+    )
+    writer.write(data)
+    await reader.readexactly(len(data))
+    cpu = time.process_time() - start
+    stats = mux.sessions[0].stats
+
+    writer.close()
+    mux.close()
+    core.close()
+    origin.close()
+    return stats["wire_bytes"] / stats["raw_bytes"], cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=4 * 1024 * 1024)
+    parser.add_argument("--window-bits", type=int, default=DEFAULT_WINDOW_BITS)
+    args = parser.parse_args()
+    data = corpora(args.size)
+
+    print(
+        f"{'corpus':8} {'codec':6} {'lvl':>3} {'ratio':>6} {'comp ns/B':>10} "
+        f"{'decomp ns/B':>12}"
+    )
+    for name, corpus in data.items():
+        for codec, level in codecs():
+            ratio, comp, decomp = bench_codec(codec, level, args.window_bits, corpus)
+            print(
+                f"{name:8} {codec.name.lower():6} {level:>3} {ratio:>6.3f} "
+                f"{comp * 1e9 / len(corpus):>10.2f} {decomp * 1e9 / len(corpus):>12.2f}"
+            )
+
+    print()
+    print(f"{'corpus':8} {'link':6} {'ratio':>6} {'cpu ns/B':>9}")
+    for name, corpus in data.items():
+        for compression in [None, "zlib"] + (["zstd"] if zstandard else []):
+            ratio, cpu = asyncio.run(bench_link(compression, corpus))
+            print(
+                f"{name:8} {compression or 'off':6} {ratio:>6.3f} "
+                f"{cpu * 1e9 / len(corpus):>9.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
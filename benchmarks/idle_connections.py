@@ -0,0 +1,134 @@
+"""
+Resident memory per idle tunnel through the SOCKS5 proxy.
+
+    python -m benchmarks.idle_connections [--connections 10000 100000]
+
+The proxy runs in its own process; this one opens the tunnels to a sink
+origin and reads the proxy's VmRSS from /proc before and after. Each tunnel
+holds two descriptors in the proxy and two more here, so the 100k run needs
+``ulimit -Hn`` above 200k. Tunnels are spread over several loopback source
+addresses and origin ports to stay clear of the ephemeral port range.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import resource
+import socket
+import struct
+
+from protocols.socks5_server.server import Socks5ProxyServerProtocol
+
+# connections per (source address, destination port) pair
+PER_ADDRESS = 20000
+BATCH = 500
+
+
+def raise_fd_limit() -> int:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+def rss(pid: int) -> int:
+    with open(f"/proc/{pid}/status") as f:
+        for line in f:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    raise RuntimeError("VmRSS not found")
+
+
+def serve(conn):
+    raise_fd_limit()
+
+    async def run():
+        server = await asyncio.get_running_loop().create_server(
+            lambda: Socks5ProxyServerProtocol(), "127.0.0.1", 0, backlog=4096
+        )
+        conn.send((os.getpid(), server.sockets[0].getsockname()[1]))
+        await server.serve_forever()
+
+    asyncio.run(run())
+
+
+class Sink(asyncio.Protocol):
+    pass
+
+
+async def open_tunnel(proxy_port: int, source: str, origin_port: int):
+    reader, writer = await asyncio.open_connection(
+        "127.0.0.1", proxy_port, local_addr=(source, 0)
+    )
+    # greeting and CONNECT in one go, the proxy reads them in order
+    writer.write(
+        b"\x05\x01\x00\x05\x01\x00\x01"
+        + socket.inet_aton("127.0.0.1")
+        + struct.pack("!H", origin_port)
+    )
+    await reader.readexactly(2 + 10)
+    return writer
+
+
+async def bench(proxy_pid: int, proxy_port: int, connections: int):
+    loop = asyncio.get_running_loop()
+    origins = [
+        await loop.create_server(Sink, "127.0.0.1", 0, backlog=4096)
+        for _ in range(connections // PER_ADDRESS + 1)
+    ]
+    origin_ports = [origin.sockets[0].getsockname()[1] for origin in origins]
+
+    await asyncio.sleep(0.5)
+    before = rss(proxy_pid)
+
+    writers = []
+    for start in range(0, connections, BATCH):
+        writers += await asyncio.gather(
+            *(
+                open_tunnel(
+                    proxy_port,
+                    f"127.0.0.{2 + i // PER_ADDRESS}",
+                    origin_ports[i // PER_ADDRESS],
+                )
+                for i in range(start, min(start + BATCH, connections))
+            )
+        )
+
+    await asyncio.sleep(1)
+    after = rss(proxy_pid)
+
+    for writer in writers:
+        writer.close()
+    for origin in origins:
+        origin.close()
+    return before, after
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--connections", type=int, nargs="+", default=[10000, 100000])
+    args = parser.parse_args()
+    fd_limit = raise_fd_limit()
+
+    print(f"{'tunnels':>8} {'rss before':>11} {'rss after':>10} {'bytes/tunnel':>13}")
+    for connections in args.connections:
+        if 2 * connections + 64 > fd_limit:
+            print(f"{connections:>8} skipped, needs ulimit -Hn > {2 * connections}")
+            continue
+
+        parent, child = multiprocessing.Pipe()
+        proxy = multiprocessing.Process(target=serve, args=(child,), daemon=True)
+        proxy.start()
+        try:
+            pid, port = parent.recv()
+            before, after = asyncio.run(bench(pid, port, connections))
+        finally:
+            proxy.terminate()
+            proxy.join()
+        print(
+            f"{connections:>8} {before / 2**20:>9.1f}Mi {after / 2**20:>8.1f}Mi "
+            f"{(after - before) / connections:>13.0f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
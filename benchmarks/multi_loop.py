@@ -0,0 +1,151 @@
+"""
+Reverse proxy round trips with one event loop against several in threads.
+
+    python -m benchmarks.multi_loop [--loops 4] [--clients 4] [--connections 50]
+
+The proxy runs in its own process, as a single loop or as a MultiLoopServer
+behind SO_REUSEPORT or an acceptor thread; the echo backend runs in
+another. ``--clients`` processes keep ``--connections`` each busy with 64
+byte request/response round trips, each connection with its own bytes,
+checked on the way back. Whether the GIL is enabled decides whether the
+loops can run Python code in parallel, and is printed first.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import sys
+import time
+
+from protocols.multiloop import MultiLoopServer
+from protocols.reverse_proxy.server import ReverseProxyProtocol
+
+MESSAGE_SIZE = 64
+
+
+class Echo(asyncio.Protocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.transport.write(data)
+
+
+def serve_backend(conn):
+    async def run():
+        server = await asyncio.get_running_loop().create_server(
+            Echo, "127.0.0.1", 0, backlog=4096
+        )
+        conn.send(server.sockets[0].getsockname()[1])
+        await server.serve_forever()
+
+    asyncio.run(run())
+
+
+def serve_proxy(mode: str, loops: int, backend_port: int, conn):
+    def factory():
+        return ReverseProxyProtocol("127.0.0.1", backend_port)
+
+    if mode == "single":
+
+        async def run():
+            server = await asyncio.get_running_loop().create_server(
+                factory, "127.0.0.1", 0, backlog=4096
+            )
+            conn.send(server.sockets[0].getsockname()[1])
+            await server.serve_forever()
+
+        asyncio.run(run())
+        return
+
+    server = MultiLoopServer(lambda: factory, loops=loops, acceptor=mode == "acceptor")
+    server.start()
+    conn.send(server.port)
+    server.serve_forever()
+
+
+async def ping_pong(port: int, index: int, deadline: float) -> int:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    message = bytes([index % 256]) * MESSAGE_SIZE
+    count = 0
+    while time.perf_counter() < deadline:
+        writer.write(message)
+        if await reader.readexactly(MESSAGE_SIZE) != message:
+            raise ValueError("got another connection's bytes")
+        count += 1
+    writer.close()
+    return count
+
+
+def client(port: int, connections: int, start: float, seconds: float, conn):
+    async def run():
+        await asyncio.sleep(max(start - time.time(), 0))
+        deadline = time.perf_counter() + seconds
+        counts = await asyncio.gather(
+            *(ping_pong(port, index, deadline) for index in range(connections))
+        )
+        conn.send(sum(counts))
+
+    asyncio.run(run())
+
+
+def bench(port: int, clients: int, connections: int, seconds: float) -> int:
+    start = time.time() + 0.5
+    pipes = [multiprocessing.Pipe() for _ in range(clients)]
+    processes = [
+        multiprocessing.Process(
+            target=client, args=(port, connections, start, seconds, child)
+        )
+        for _, child in pipes
+    ]
+    for process in processes:
+        process.start()
+    total = sum(parent.recv() for parent, _ in pipes)
+    for process in processes:
+        process.join()
+    return total
+
+
+def gil_enabled() -> bool:
+    is_gil_enabled = getattr(sys, "_is_gil_enabled", None)
+    return is_gil_enabled() if is_gil_enabled else True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--loops", type=int, default=4)
+    parser.add_argument("--clients", type=int, default=4)
+    parser.add_argument("--connections", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=3)
+    args = parser.parse_args()
+
+    print(f"python {sys.version.split()[0]}, GIL {'on' if gil_enabled() else 'off'}")
+    parent, child = multiprocessing.Pipe()
+    backend = multiprocessing.Process(target=serve_backend, args=(child,), daemon=True)
+    backend.start()
+    backend_port = parent.recv()
+
+    print(f"{'mode':>9} {'loops':>6} {'round trips/s':>14}")
+    try:
+        for mode in ["single", "reuseport", "acceptor"]:
+            loops = 1 if mode == "single" else args.loops
+            parent, child = multiprocessing.Pipe()
+            proxy = multiprocessing.Process(
+                target=serve_proxy,
+                args=(mode, loops, backend_port, child),
+                daemon=True,
+            )
+            proxy.start()
+            try:
+                port = parent.recv()
+                count = bench(port, args.clients, args.connections, args.seconds)
+            finally:
+                proxy.terminate()
+                proxy.join()
+            print(f"{mode:>9} {loops:>6} {count / args.seconds:>14.0f}")
+    finally:
+        backend.terminate()
+        backend.join()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+"""
+Rows per second streamed by the PostgreSQL server framework.
+
+    python -m benchmarks.postgres_rows [--rows 5000000] [--columns 4]
+
+The server runs in its own process and serves ``SELECT <rows>`` from an
+async generator; this process reads the raw result off the socket without
+decoding it, so the numbers are those of the server. The server's peak RSS
+is reported as well, it should not grow with the number of rows.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import resource
+import time
+
+from protocols.postgres.messages import query, startup_message
+from protocols.postgres.server import PostgresServerProtocol, Result
+
+
+def serve(conn, columns: int):
+    async def query_handler(sql, params):
+        count = int(sql.split()[1])
+        values = ["x" * 8] * (columns - 1)
+
+        async def rows():
+            for i in range(count):
+                yield (i, *values)
+
+        return Result([f"c{i}" for i in range(columns)], rows())
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        server = await loop.create_server(
+            lambda: PostgresServerProtocol(query_handler), "127.0.0.1", 0
+        )
+        conn.send(server.sockets[0].getsockname()[1])
+        # any message from the parent stops the server
+        await loop.run_in_executor(None, conn.recv)
+        conn.send(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024)
+
+    asyncio.run(run())
+
+
+READY = b"Z\0\0\0\x05I"
+
+
+async def read_until_ready(reader: asyncio.StreamReader) -> int:
+    received = 0
+    tail = b""
+    while not tail.endswith(READY):
+        chunk = await reader.read(256 * 1024)
+        if not chunk:
+            raise ConnectionError("server closed the connection")
+        received += len(chunk)
+        tail = tail[-len(READY) :] + chunk[-len(READY) :]
+    return received
+
+
+async def fetch(port: int, rows: int) -> int:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    writer.write(startup_message({"user": "bench"}))
+    await read_until_ready(reader)
+    writer.write(query(f"SELECT {rows}"))
+    received = await read_until_ready(reader)
+    writer.close()
+    return received
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--rows", type=int, nargs="+", default=[100000, 1000000, 5000000]
+    )
+    parser.add_argument("--columns", type=int, default=4)
+    args = parser.parse_args()
+
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve, args=(child, args.columns))
+    server.start()
+    port = parent.recv()
+
+    print(f"{'rows':>10} {'seconds':>8} {'rows/s':>12} {'MB/s':>8}")
+    for rows in args.rows:
+        start = time.perf_counter()
+        received = asyncio.run(fetch(port, rows))
+        elapsed = time.perf_counter() - start
+        print(
+            f"{rows:>10} {elapsed:>8.2f} {rows / elapsed:>12,.0f}"
+            f" {received / elapsed / 1e6:>8.1f}"
+        )
+
+    parent.send(None)
+    print(f"server peak RSS {parent.recv() / 1e6:.1f} MB")
+    server.join()
+
+
+if __name__ == "__main__":
+    main()
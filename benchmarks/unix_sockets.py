@@ -0,0 +1,147 @@
+"""
+Reverse proxy round trips over loopback TCP and unix domain sockets.
+
+    python -m benchmarks.unix_sockets [--connections 50] [--seconds 3]
+
+The echo backend and the proxy each run in their own process; this one
+keeps every connection busy with 64 byte request/response round trips
+through the proxy, for each combination of listener and backend socket
+type. Reported are round trips per second, their mean latency, and the
+proxy's CPU time per round trip from /proc.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import tempfile
+import time
+from typing import Tuple
+
+from protocols.reverse_proxy.server import ReverseProxyProtocol
+from protocols.unix import create_unix_server, open_unix_connection
+
+MESSAGE = b"x" * 64
+# (listener, backend)
+SETUPS = [("tcp", "tcp"), ("tcp", "unix"), ("unix", "tcp"), ("unix", "unix")]
+
+
+class Echo(asyncio.Protocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.transport.write(data)
+
+
+def cpu_seconds(pid: int) -> float:
+    with open(f"/proc/{pid}/stat") as f:
+        # utime and stime, after the parenthesised command name
+        fields = f.read().rsplit(")", 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def serve_backend(path: str, conn):
+    async def run():
+        tcp = await asyncio.get_running_loop().create_server(Echo, "127.0.0.1", 0)
+        unix = await create_unix_server(Echo, path)
+        conn.send(tcp.sockets[0].getsockname()[1])
+        async with tcp, unix:
+            await asyncio.Future()
+
+    asyncio.run(run())
+
+
+def serve_proxy(listener: str, backend: str, backend_port: int, path: str, conn):
+    def factory():
+        if backend == "unix":
+            return ReverseProxyProtocol(target_path=path)
+        return ReverseProxyProtocol("127.0.0.1", backend_port)
+
+    async def run():
+        if listener == "unix":
+            server = await create_unix_server(
+                factory, f"@benchmark-proxy-{os.getpid()}"
+            )
+            conn.send((os.getpid(), f"@benchmark-proxy-{os.getpid()}"))
+        else:
+            server = await asyncio.get_running_loop().create_server(
+                factory, "127.0.0.1", 0
+            )
+            conn.send((os.getpid(), server.sockets[0].getsockname()[1]))
+        await server.serve_forever()
+
+    asyncio.run(run())
+
+
+async def ping_pong(address, deadline: float) -> Tuple[int, float]:
+    if isinstance(address, str):
+        reader, writer = await open_unix_connection(address)
+    else:
+        reader, writer = await asyncio.open_connection("127.0.0.1", address)
+    count, waited = 0, 0.0
+    while (start := time.perf_counter()) < deadline:
+        writer.write(MESSAGE)
+        await reader.readexactly(len(MESSAGE))
+        waited += time.perf_counter() - start
+        count += 1
+    writer.close()
+    return count, waited
+
+
+async def bench(address, connections: int, seconds: float) -> Tuple[int, float]:
+    deadline = time.perf_counter() + seconds
+    results = await asyncio.gather(
+        *(ping_pong(address, deadline) for _ in range(connections))
+    )
+    return sum(c for c, _ in results), sum(w for _, w in results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--connections", type=int, default=50)
+    parser.add_argument("--seconds", type=float, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "backend.sock")
+        parent, child = multiprocessing.Pipe()
+        backend = multiprocessing.Process(
+            target=serve_backend, args=(path, child), daemon=True
+        )
+        backend.start()
+        backend_port = parent.recv()
+
+        print(
+            f"{'listener':>8} {'backend':>8} {'round trips/s':>14} "
+            f"{'latency':>9} {'proxy cpu/rt':>13}"
+        )
+        try:
+            for listener, backend_type in SETUPS:
+                parent, child = multiprocessing.Pipe()
+                proxy = multiprocessing.Process(
+                    target=serve_proxy,
+                    args=(listener, backend_type, backend_port, path, child),
+                    daemon=True,
+                )
+                proxy.start()
+                try:
+                    pid, address = parent.recv()
+                    cpu = cpu_seconds(pid)
+                    count, waited = asyncio.run(
+                        bench(address, args.connections, args.seconds)
+                    )
+                    cpu = cpu_seconds(pid) - cpu
+                finally:
+                    proxy.terminate()
+                    proxy.join()
+                print(
+                    f"{listener:>8} {backend_type:>8} {count / args.seconds:>14.0f} "
+                    f"{waited / count * 1e6:>7.0f}us {cpu / count * 1e6:>11.1f}us"
+                )
+        finally:
+            backend.terminate()
+            backend.join()
+
+
+if __name__ == "__main__":
+    main()
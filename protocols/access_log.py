@@ -0,0 +1,136 @@
+import json
+import os
+import threading
+import time
+from collections import Counter, deque
+from typing import Any, Deque, List, Optional, Tuple
+
+Address = Tuple[Any, ...]
+# time, client, target, user, sent, received, duration, result
+Record = Tuple[float, Address, Address, str, int, int, float, str]
+
+
+class AccessLog:
+    """
+    One JSON line per connection, written by a background thread.
+
+    ``record`` only appends a tuple to a bounded queue, so the event loop
+    neither formats nor blocks on the file. Past ``max_queue`` waiting
+    records new ones are dropped and counted. Addresses are (host, port)
+    tuples, or empty when unknown. The thread writes whenever
+    ``batch_size`` records are waiting or ``flush_interval`` seconds have
+    passed, and rotates the file to ``path.1`` ... ``path.<backups>`` once it
+    is over ``max_bytes``.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_queue: int = 65536,
+        batch_size: int = 1024,
+        flush_interval: float = 1.0,
+        max_bytes: int = 100 * 1024 * 1024,
+        backups: int = 5,
+    ):
+        self.path = path
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.stats: Counter = Counter()
+
+        # deque appends and pops are atomic, the queue needs no lock
+        self.queue: Deque[Record] = deque()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.file = open(path, "ab")
+        self.thread = threading.Thread(target=self.run, name="access-log", daemon=True)
+        self.thread.start()
+
+    def record(
+        self,
+        client: Address,
+        target: Address,
+        user: str,
+        sent: int,
+        received: int,
+        duration: float,
+        result: str,
+    ):
+        queue = self.queue
+        if len(queue) >= self.max_queue:
+            self.stats["dropped"] += 1
+            return
+        queue.append(
+            (time.time(), client, target, user, sent, received, duration, result)
+        )
+        if len(queue) == self.batch_size:
+            self.wakeup.set()
+
+    def run(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        queue = self.queue
+        while queue:
+            batch: List[bytes] = []
+            while queue and len(batch) < self.batch_size:
+                batch.append(format_record(queue.popleft()))
+            self.file.write(b"".join(batch))
+            self.stats["written"] += len(batch)
+            self.stats["batches"] += 1
+            if self.file.tell() >= self.max_bytes:
+                self.rotate()
+        self.file.flush()
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists(f"{self.path}.{i}"):
+                os.replace(f"{self.path}.{i}", f"{self.path}.{i + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, "ab")
+        self.stats["rotations"] += 1
+
+    def close(self, timeout: Optional[float] = None):
+        """
+        Writes what is still queued and stops the thread.
+        """
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join(timeout)
+        self.file.close()
+
+
+def format_record(record: Record) -> bytes:
+    at, client, target, user, sent, received, duration, result = record
+    return (
+        json.dumps(
+            {
+                "time": round(at, 3),
+                "client": format_address(client),
+                "target": format_address(target),
+                "user": user,
+                "sent": sent,
+                "received": received,
+                "duration": round(duration, 6),
+                "result": result,
+            }
+        ).encode()
+        + b"\n"
+    )
+
+
+def format_address(address: Address) -> str:
+    if not address:
+        return ""
+    host, port = address[:2]
+    return f"[{host}]:{port}" if ":" in host else f"{host}:{port}"
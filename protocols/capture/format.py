@@ -0,0 +1,99 @@
+import mmap
+import struct
+from enum import Enum
+from typing import Dict, Iterator, List, NamedTuple
+
+# +-------+-----------------+
+# | MAGIC | START (ns, UTC) |
+# +-------+-----------------+
+# |   8   |        8        |
+# +-------+-----------------+
+MAGIC = b"PRXCAP01"
+FILE_HEADER = struct.Struct("!8sQ")
+
+# +-----------+---------+------+--------+---------+
+# | TIMESTAMP | CONN ID | TYPE | LENGTH | PAYLOAD |
+# +-----------+---------+------+--------+---------+
+# |     8     |    4    |  1   |   4    | LENGTH  |
+# +-----------+---------+------+--------+---------+
+# TIMESTAMP is in nanoseconds since the capture started
+RECORD_HEADER = struct.Struct("!QIBI")
+
+
+class RecordType(Enum):
+    # payload is the peer address as "host:port", or a unix socket's path
+    OPEN = 0x00
+    # bytes the client sent to the proxy
+    CLIENT = 0x01
+    # bytes the proxy sent back to the client
+    SERVER = 0x02
+    CLOSE = 0x03
+
+
+class Record(NamedTuple):
+    timestamp: int
+    conn_id: int
+    type: RecordType
+    payload: memoryview
+
+
+def pack_record_header(
+    timestamp: int, conn_id: int, record_type: RecordType, length: int
+) -> bytes:
+    return RECORD_HEADER.pack(timestamp, conn_id, record_type.value, length)
+
+
+class Capture:
+    """
+    A capture file mapped into memory; record payloads are views into the
+    mapping, so reading a capture of any size copies nothing. Records still
+    referenced when the capture is closed keep the mapping alive.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.started = FILE_HEADER.unpack_from(self.mmap)
+        if magic != MAGIC:
+            self.mmap.close()
+            raise ValueError(f"{path} is not a capture file")
+        self.view = memoryview(self.mmap)
+
+    def __iter__(self) -> Iterator[Record]:
+        offset = FILE_HEADER.size
+        end = len(self.mmap)
+        while offset + RECORD_HEADER.size <= end:
+            timestamp, conn_id, record_type, length = RECORD_HEADER.unpack_from(
+                self.mmap, offset
+            )
+            offset += RECORD_HEADER.size
+            if offset + length > end:
+                # the recorder was killed halfway through a record
+                break
+            yield Record(
+                timestamp,
+                conn_id,
+                RecordType(record_type),
+                self.view[offset : offset + length],
+            )
+            offset += length
+
+    def connections(self) -> Dict[int, List[Record]]:
+        connections: Dict[int, List[Record]] = {}
+        for record in self:
+            connections.setdefault(record.conn_id, []).append(record)
+        return connections
+
+    def close(self):
+        self.view.release()
+        try:
+            self.mmap.close()
+        except BufferError:
+            # unmapped once the last record is collected
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
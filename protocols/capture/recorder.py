@@ -0,0 +1,234 @@
+import asyncio
+import itertools
+import random
+import threading
+import time
+from collections import Counter, deque
+from typing import Any, Callable, Deque, Optional, Tuple
+
+from protocols.capture.format import (
+    FILE_HEADER,
+    MAGIC,
+    RECORD_HEADER,
+    Capture,
+    RecordType,
+    pack_record_header,
+)
+
+PendingRecord = Tuple[int, int, RecordType, bytes]
+
+
+class Recorder:
+    """
+    Appends connection traffic to a capture file.
+
+    The event loop only stamps and queues each chunk; a background thread
+    packs and writes the queue every ``flush_interval`` seconds. Only
+    ``sample_rate`` of the connections are recorded, and records are dropped
+    (and counted in ``stats``) while more than ``max_pending`` are queued.
+
+    Appending to an existing capture continues its connection ids and
+    timestamps, after dropping a record left incomplete by a crash.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        sample_rate: float = 1.0,
+        max_pending: int = 65536,
+        flush_interval: float = 0.1,
+    ):
+        self.sample_rate = sample_rate
+        self.max_pending = max_pending
+        self.flush_interval = flush_interval
+        self.pending: Deque[PendingRecord] = deque()
+        self.conn_ids = itertools.count(1)
+        self.stats: Counter = Counter()
+        self.started = time.monotonic_ns()
+
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(FILE_HEADER.pack(MAGIC, time.time_ns()))
+        else:
+            try:
+                self.resume(path)
+            except BaseException:
+                self.file.close()
+                raise
+        self.stopped = threading.Event()
+        self.writer = threading.Thread(target=self.run, daemon=True)
+        self.writer.start()
+
+    def resume(self, path: str):
+        last_id = last_timestamp = 0
+        end = FILE_HEADER.size
+        with Capture(path) as capture:
+            for timestamp, conn_id, _, payload in capture:
+                last_id = max(last_id, conn_id)
+                last_timestamp = timestamp
+                end += RECORD_HEADER.size + len(payload)
+        self.file.truncate(end)
+        self.conn_ids = itertools.count(last_id + 1)
+        self.started = time.monotonic_ns() - last_timestamp
+
+    def open(self, peer: str = "") -> Optional[int]:
+        """
+        Start recording a connection; returns None if it wasn't sampled.
+        """
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return None
+        conn_id = next(self.conn_ids)
+        self.stats["connections"] += 1
+        self.record(conn_id, RecordType.OPEN, peer.encode())
+        return conn_id
+
+    def record(self, conn_id: int, record_type: RecordType, data=b""):
+        if len(self.pending) >= self.max_pending:
+            self.stats["dropped"] += 1
+            return
+        self.pending.append(
+            (time.monotonic_ns() - self.started, conn_id, record_type, bytes(data))
+        )
+
+    def run(self):
+        while not self.stopped.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        chunks = []
+        while self.pending:
+            timestamp, conn_id, record_type, data = self.pending.popleft()
+            chunks.append(
+                pack_record_header(timestamp, conn_id, record_type, len(data))
+            )
+            chunks.append(data)
+        if chunks:
+            self.file.write(b"".join(chunks))
+            self.file.flush()
+
+    def close(self):
+        self.stopped.set()
+        self.writer.join()
+        self.file.close()
+
+
+class RecordingTransport(asyncio.Transport):
+    """
+    Stands in for the accepted transport, so whatever protocol ends up on it
+    (including a spliced relay) has its writes recorded.
+    """
+
+    def __init__(self, transport: asyncio.Transport, tap: "RecordingProtocol"):
+        super().__init__()
+        self.transport = transport
+        self.tap = tap
+
+    def write(self, data):
+        self.tap.record(RecordType.SERVER, data)
+        self.transport.write(data)
+
+    def writelines(self, list_of_data):
+        for data in list_of_data:
+            self.write(data)
+
+    def write_eof(self):
+        self.transport.write_eof()
+
+    def can_write_eof(self):
+        return self.transport.can_write_eof()
+
+    def close(self):
+        self.transport.close()
+
+    def abort(self):
+        self.transport.abort()
+
+    def is_closing(self):
+        return self.transport.is_closing()
+
+    def get_extra_info(self, name, default=None):
+        return self.transport.get_extra_info(name, default)
+
+    def pause_reading(self):
+        self.transport.pause_reading()
+
+    def resume_reading(self):
+        self.transport.resume_reading()
+
+    def is_reading(self):
+        return self.transport.is_reading()
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        self.transport.set_write_buffer_limits(high, low)
+
+    def get_write_buffer_size(self):
+        return self.transport.get_write_buffer_size()
+
+    def get_write_buffer_limits(self):
+        return self.transport.get_write_buffer_limits()
+
+    def set_protocol(self, protocol):
+        self.tap.protocol = protocol
+
+    def get_protocol(self):
+        return self.tap.protocol
+
+
+class RecordingProtocol(asyncio.Protocol):
+    def __init__(self, protocol: Any, recorder: Recorder):
+        self.protocol = protocol
+        self.recorder = recorder
+        self.conn_id = 0
+
+    def record(self, record_type: RecordType, data=b""):
+        self.recorder.record(self.conn_id, record_type, data)
+
+    def connection_made(self, transport):
+        peername = transport.get_extra_info("peername")
+        if isinstance(peername, tuple):
+            peer = f"{peername[0]}:{peername[1]}"
+        else:
+            # a unix socket client, usually unnamed
+            peer = peername or ""
+        self.conn_id = self.recorder.open(peer) or 0
+        if self.conn_id:
+            transport = RecordingTransport(transport, self)
+        self.protocol.connection_made(transport)
+
+    def data_received(self, data):
+        if self.conn_id:
+            self.record(RecordType.CLIENT, data)
+        if not isinstance(self.protocol, asyncio.BufferedProtocol):
+            self.protocol.data_received(data)
+            return
+        data = memoryview(data)
+        while data:
+            buffer = memoryview(self.protocol.get_buffer(len(data)))
+            n = min(len(buffer), len(data))
+            buffer[:n] = data[:n]
+            self.protocol.buffer_updated(n)
+            data = data[n:]
+
+    def eof_received(self):
+        return self.protocol.eof_received()
+
+    def connection_lost(self, exc):
+        if self.conn_id:
+            self.record(RecordType.CLOSE)
+        self.protocol.connection_lost(exc)
+
+    def pause_writing(self):
+        self.protocol.pause_writing()
+
+    def resume_writing(self):
+        self.protocol.resume_writing()
+
+
+def recording(
+    protocol_factory: Callable[[], Any], recorder: Recorder
+) -> Callable[[], RecordingProtocol]:
+    """
+    Wrap a server protocol factory so the accepted connections are recorded.
+    """
+    return lambda: RecordingProtocol(protocol_factory(), recorder)
@@ -0,0 +1,131 @@
+"""
+Replay a capture against a proxy.
+
+    python -m protocols.capture.replay CAPTURE --port 1080 [--speed 1]
+
+Every recorded connection is opened again at its recorded offset and sends
+its client bytes in the recorded chunks. ``--speed 10`` replays ten times
+faster, ``--speed 0`` as fast as the proxy answers.
+"""
+import argparse
+import asyncio
+import time
+from asyncio import StreamReader
+from collections import Counter
+from typing import List
+
+from protocols.capture.format import Capture, Record, RecordType
+
+READ_SIZE = 64 * 1024
+
+
+class Replayer:
+    def __init__(
+        self,
+        capture: Capture,
+        host: str,
+        port: int,
+        speed: float = 1.0,
+        concurrency: int = 1000,
+        timeout: float = 30,
+    ):
+        self.capture = capture
+        self.host = host
+        self.port = port
+        self.speed = speed
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.stats: Counter = Counter()
+        self.started = 0.0
+
+    async def run(self):
+        self.started = asyncio.get_running_loop().time()
+        # made here, bound to the loop that runs the replay
+        concurrency = asyncio.Semaphore(self.concurrency)
+        await asyncio.gather(
+            *(
+                self.replay_connection(records, concurrency)
+                for records in self.capture.connections().values()
+            )
+        )
+
+    async def wait_until(self, timestamp: int):
+        if not self.speed:
+            return
+        at = self.started + timestamp / 1e9 / self.speed
+        delay = at - asyncio.get_running_loop().time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def receive(self, reader: StreamReader, received: int, expected: int) -> int:
+        while received < expected:
+            data = await reader.read(READ_SIZE)
+            if not data:
+                break
+            received += len(data)
+        return received
+
+    async def replay_connection(
+        self, records: List[Record], concurrency: asyncio.Semaphore
+    ):
+        await self.wait_until(records[0].timestamp)
+        async with concurrency:
+            try:
+                reader, writer = await asyncio.open_connection(self.host, self.port)
+            except OSError:
+                self.stats["failed"] += 1
+                return
+
+            self.stats["connections"] += 1
+            sent = received = expected = 0
+            try:
+                for record in records:
+                    if record.type == RecordType.SERVER:
+                        expected += len(record.payload)
+                    elif record.type == RecordType.CLIENT:
+                        # keep the conversation in order: the client only said
+                        # this after it had seen the answers recorded before it
+                        received = await asyncio.wait_for(
+                            self.receive(reader, received, expected), self.timeout
+                        )
+                        await self.wait_until(record.timestamp)
+                        writer.write(record.payload)
+                        await writer.drain()
+                        sent += len(record.payload)
+                    elif record.type == RecordType.CLOSE:
+                        await self.wait_until(record.timestamp)
+                received = await asyncio.wait_for(
+                    self.receive(reader, received, expected), self.timeout
+                )
+            except (OSError, asyncio.TimeoutError):
+                self.stats["failed"] += 1
+            finally:
+                writer.close()
+                self.stats["sent_bytes"] += sent
+                self.stats["received_bytes"] += received
+                if received < expected:
+                    self.stats["short_responses"] += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("capture")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1080)
+    parser.add_argument("--speed", type=float, default=1.0)
+    parser.add_argument("--concurrency", type=int, default=1000)
+    args = parser.parse_args()
+
+    with Capture(args.capture) as capture:
+        replayer = Replayer(capture, args.host, args.port, args.speed, args.concurrency)
+        start = time.monotonic()
+        asyncio.run(replayer.run())
+        elapsed = time.monotonic() - start
+
+    print(f"replayed in {elapsed:.2f}s")
+    for name, value in sorted(replayer.stats.items()):
+        print(f"{name:16} {value}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import asyncio
+import os
+import socket
+import struct
+import tempfile
+import unittest
+
+from protocols.capture.format import Capture, RecordType
+from protocols.capture.recorder import Recorder, recording
+from protocols.capture.replay import Replayer
+from protocols.socks5_server.server import Socks5ProxyServerProtocol
+from protocols.stream_utils import create_stream_reader_from_capture
+from protocols.unix import create_unix_server, open_unix_connection
+
+
+class Echo(asyncio.Protocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.transport.write(data)
+
+
+class TestCapture(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "capture.bin")
+
+        async def setup():
+            self.origin = await self.loop.create_server(Echo, "127.0.0.1", 0)
+            self.proxy = await self.loop.create_server(
+                Socks5ProxyServerProtocol, "127.0.0.1", 0
+            )
+
+        self.loop.run_until_complete(setup())
+        self.origin_port = self.origin.sockets[0].getsockname()[1]
+
+    def tearDown(self):
+        self.origin.close()
+        self.proxy.close()
+        self.loop.run_until_complete(self.proxy.wait_closed())
+        self.loop.close()
+        self.directory.cleanup()
+
+    def connect_request(self) -> bytes:
+        return (
+            b"\x05\x01\x00\x05\x01\x00\x01"
+            + socket.inet_aton("127.0.0.1")
+            + struct.pack("!H", self.origin_port)
+        )
+
+    async def record(self, recorder: Recorder, connections: int = 1):
+        server = await self.loop.create_server(
+            recording(Socks5ProxyServerProtocol, recorder), "127.0.0.1", 0
+        )
+        for _ in range(connections):
+            reader, writer = await asyncio.open_connection(
+                "127.0.0.1", server.sockets[0].getsockname()[1]
+            )
+            writer.write(self.connect_request())
+            await reader.readexactly(12)
+            writer.write(b"hello")
+            self.assertEqual(b"hello", await reader.readexactly(5))
+            writer.close()
+            self.assertEqual(b"", await reader.read())
+        # let the proxy side see its connection_lost
+        await asyncio.sleep(0.1)
+        server.close()
+        await server.wait_closed()
+        recorder.close()
+
+    def test_record_and_replay(self):
+        recorder = Recorder(self.path)
+        self.loop.run_until_complete(self.record(recorder))
+
+        with Capture(self.path) as capture:
+            records = capture.connections()[1]
+            types = [record.type for record in records]
+            self.assertEqual(RecordType.OPEN, types[0])
+            self.assertEqual(RecordType.CLOSE, types[-1])
+            self.assertEqual(
+                self.connect_request() + b"hello",
+                b"".join(r.payload for r in records if r.type == RecordType.CLIENT),
+            )
+            server_bytes = b"".join(
+                r.payload for r in records if r.type == RecordType.SERVER
+            )
+            self.assertEqual(12 + 5, len(server_bytes))
+            self.assertTrue(server_bytes.endswith(b"hello"))
+            timestamps = [record.timestamp for record in records]
+            self.assertEqual(sorted(timestamps), timestamps)
+            del records
+
+            replayer = Replayer(
+                capture, "127.0.0.1", self.proxy.sockets[0].getsockname()[1], speed=0
+            )
+            self.loop.run_until_complete(replayer.run())
+
+        self.assertEqual(1, replayer.stats["connections"])
+        self.assertEqual(0, replayer.stats["failed"])
+        self.assertEqual(0, replayer.stats["short_responses"])
+        self.assertEqual(17, replayer.stats["received_bytes"])
+
+        async def read_back():
+            reader = create_stream_reader_from_capture(self.path, 1)
+            return await reader.read()
+
+        self.assertEqual(server_bytes, self.loop.run_until_complete(read_back()))
+
+    def test_replay_on_other_loops(self):
+        recorder = Recorder(self.path)
+        self.loop.run_until_complete(self.record(recorder, connections=3))
+
+        with Capture(self.path) as capture:
+            replayer = Replayer(
+                capture,
+                "127.0.0.1",
+                self.proxy.sockets[0].getsockname()[1],
+                speed=0,
+                concurrency=1,
+            )
+
+            async def replay_twice():
+                # each run on a loop of its own, the proxy on this one
+                for _ in range(2):
+                    await self.loop.run_in_executor(
+                        None, lambda: asyncio.run(replayer.run())
+                    )
+
+            self.loop.run_until_complete(replay_twice())
+
+        self.assertEqual(6, replayer.stats["connections"])
+        self.assertEqual(0, replayer.stats["failed"])
+        self.assertEqual(0, replayer.stats["short_responses"])
+
+    def test_sampling(self):
+        recorder = Recorder(self.path, sample_rate=0)
+        self.loop.run_until_complete(self.record(recorder, connections=3))
+
+        self.assertEqual(0, recorder.stats["connections"])
+        with Capture(self.path) as capture:
+            self.assertEqual({}, capture.connections())
+
+    def test_truncated_capture(self):
+        recorder = Recorder(self.path)
+        self.loop.run_until_complete(self.record(recorder))
+        with open(self.path, "ab") as f:
+            f.write(b"\x00" * 5)
+
+        with Capture(self.path) as capture:
+            self.assertEqual([1], list(capture.connections()))
+
+    def test_append(self):
+        for _ in range(2):
+            recorder = Recorder(self.path)
+            self.loop.run_until_complete(self.record(recorder))
+            with open(self.path, "ab") as f:
+                f.write(b"\x00" * 5)
+
+        with Capture(self.path) as capture:
+            connections = capture.connections()
+            timestamps = [record.timestamp for record in capture]
+        self.assertEqual([1, 2], list(connections))
+        self.assertEqual(sorted(timestamps), timestamps)
+        self.assertEqual(RecordType.CLOSE, connections[2][-1].type)
+        self.assertEqual(b"hello", connections[2][-2].payload)
+
+    def test_unix_socket_client(self):
+        recorder = Recorder(self.path)
+
+        async def test():
+            server = await create_unix_server(
+                recording(Echo, recorder), os.path.join(self.directory.name, "sock")
+            )
+            reader, writer = await open_unix_connection(
+                os.path.join(self.directory.name, "sock")
+            )
+            writer.write(b"hello")
+            self.assertEqual(b"hello", await reader.readexactly(5))
+            writer.close()
+            await asyncio.sleep(0.1)
+            server.close()
+            await server.wait_closed()
+            recorder.close()
+
+        self.loop.run_until_complete(test())
+        with Capture(self.path) as capture:
+            records = capture.connections()[1]
+        self.assertEqual(RecordType.OPEN, records[0].type)
+        self.assertEqual(b"", records[0].payload)
+        self.assertEqual(b"hello", records[1].payload)
+
+
+if __name__ == "__main__":
+    unittest.main()
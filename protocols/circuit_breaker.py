@@ -0,0 +1,138 @@
+import asyncio
+import threading
+import time
+from collections import Counter, OrderedDict
+from typing import Awaitable, Callable, Optional, Tuple
+
+from protocols.forward import StreamPair
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpen(ConnectionError):
+    """
+    Raised instead of dialing a destination whose breaker is open.
+    ``timed_out`` tells whether its last failure was a timeout rather than
+    a refusal, which picks the error the client gets.
+    """
+
+    def __init__(self, host: str, port: int, timed_out: bool):
+        super().__init__(f"circuit open for {host}:{port}")
+        self.timed_out = timed_out
+
+
+class Breaker:
+    __slots__ = ("state", "failures", "opened", "timed_out")
+
+    def __init__(self):
+        self.state = CLOSED
+        # consecutive failed or slow connects
+        self.failures = 0
+        self.opened = 0.0
+        self.timed_out = False
+
+
+class CircuitBreakers:
+    """
+    A breaker per upstream (host, port). ``failure_threshold`` consecutive
+    failed connects, or connects slower than ``slow_connect`` seconds, open
+    it: dials then fail right away for ``reset_timeout`` seconds, after
+    which a single probe is let through (half open) and either closes the
+    breaker or opens it again.
+
+    Only destinations with recent failures have an entry, at most
+    ``max_entries`` of them; the least recently used go first. One instance
+    may serve the loops of several threads; a lock guards the entries, never
+    held across the dial.
+    """
+
+    def __init__(
+        self,
+        failure_threshold: int = 5,
+        reset_timeout: float = 10.0,
+        slow_connect: Optional[float] = 5.0,
+        max_entries: int = 10000,
+    ):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.slow_connect = slow_connect
+        self.max_entries = max_entries
+        self.breakers: "OrderedDict[Tuple[str, int], Breaker]" = OrderedDict()
+        self.stats: Counter = Counter()
+        self.lock = threading.Lock()
+
+    def state(self, host: str, port: int) -> str:
+        breaker = self.breakers.get((host, port))
+        return breaker.state if breaker else CLOSED
+
+    async def connect(
+        self, host: str, port: int, dial: Callable[[], Awaitable[StreamPair]]
+    ) -> StreamPair:
+        key = (host, port)
+        with self.lock:
+            breaker = self.breakers.get(key)
+            if breaker:
+                self.breakers.move_to_end(key)
+                if breaker.state == OPEN:
+                    if time.monotonic() - breaker.opened < self.reset_timeout:
+                        self.stats["rejected"] += 1
+                        raise CircuitOpen(host, port, breaker.timed_out)
+                    breaker.state = HALF_OPEN
+                    self.stats["probes"] += 1
+                elif breaker.state == HALF_OPEN:
+                    # the probe is still out
+                    self.stats["rejected"] += 1
+                    raise CircuitOpen(host, port, breaker.timed_out)
+
+        started = time.monotonic()
+        try:
+            stream = await dial()
+        except (OSError, asyncio.TimeoutError) as e:
+            self.failed(key, isinstance(e, asyncio.TimeoutError))
+            raise
+        except BaseException:
+            with self.lock:
+                if breaker and breaker.state == HALF_OPEN:
+                    # cancelled, let the next dial probe instead
+                    breaker.state = OPEN
+            raise
+
+        if (
+            self.slow_connect is not None
+            and time.monotonic() - started > self.slow_connect
+        ):
+            self.failed(key, True)
+        elif breaker:
+            with self.lock:
+                self.breakers.pop(key, None)
+                if breaker.state != CLOSED:
+                    self.stats["closed"] += 1
+        return stream
+
+    def failed(self, key: Tuple[str, int], timed_out: bool):
+        with self.lock:
+            breaker = self.breakers.get(key)
+            if breaker is None:
+                breaker = self.breakers[key] = Breaker()
+                if len(self.breakers) > self.max_entries:
+                    self.breakers.popitem(last=False)
+            breaker.failures += 1
+            breaker.timed_out = timed_out
+            if breaker.state == HALF_OPEN or (
+                breaker.state == CLOSED and breaker.failures >= self.failure_threshold
+            ):
+                breaker.state = OPEN
+                breaker.opened = time.monotonic()
+                self.stats["opened"] += 1
+
+    def metrics(self) -> dict:
+        with self.lock:
+            states = Counter(breaker.state for breaker in self.breakers.values())
+        return {
+            "tracked": len(self.breakers),
+            "open": states[OPEN],
+            "half_open": states[HALF_OPEN],
+            **self.stats,
+        }
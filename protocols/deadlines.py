@@ -0,0 +1,129 @@
+import asyncio
+import threading
+from collections import Counter
+from typing import Dict, Optional, Protocol, Tuple
+from weakref import WeakKeyDictionary
+
+import async_timeout  # type:ignore
+
+HANDSHAKE = "handshake"
+AUTH = "auth"
+CONNECT = "connect"
+IDLE = "idle"
+
+
+class PhaseTimeout(asyncio.TimeoutError):
+    def __init__(self, phase: str):
+        super().__init__(phase)
+        self.phase = phase
+
+
+class Idle(Protocol):
+    def activity(self) -> int:
+        ...
+
+    def abort(self):
+        ...
+
+
+class _Phase:
+    __slots__ = ("deadlines", "phase", "timeout")
+
+    def __init__(self, deadlines: "Deadlines", phase: str, delay: Optional[float]):
+        self.deadlines = deadlines
+        self.phase = phase
+        self.timeout = async_timeout.timeout(delay)
+
+    async def __aenter__(self):
+        await self.timeout.__aenter__()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self.timeout.__aexit__(exc_type, exc, tb)
+        except asyncio.TimeoutError:
+            self.deadlines.stats[self.phase] += 1
+            raise PhaseTimeout(self.phase) from None
+
+
+class Deadlines:
+    """
+    Time limits in seconds for the phases of a proxied connection, ``None``
+    for no limit: ``handshake`` for the greeting and request header,
+    ``auth`` for the credentials exchange, ``connect`` for the upstream
+    dial, and ``idle`` for a tunnel where neither side sent anything.
+
+    A phase is one timer handle, cancelled on the way out. Idle tunnels
+    cost nothing per byte: registered relays are swept every ``idle / 2``
+    seconds and aborted once their byte counts stopped moving for a whole
+    ``idle``. Timeouts are counted by phase in ``stats``.
+    """
+
+    def __init__(
+        self,
+        handshake: Optional[float] = 30.0,
+        auth: Optional[float] = 30.0,
+        connect: Optional[float] = 30.0,
+        idle: Optional[float] = None,
+    ):
+        self.handshake = handshake
+        self.auth = auth
+        self.connect = connect
+        self.idle = idle
+        self.stats: Counter = Counter()
+        # activity at the last sweep, and the sweeps it has not moved since
+        self.relays: Dict[Idle, Tuple[int, int]] = {}
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def phase(self, phase: str) -> _Phase:
+        return _Phase(self, phase, getattr(self, phase))
+
+    def register(self, relay: Idle):
+        if self.idle is None:
+            return
+        self.relays[relay] = (relay.activity(), 0)
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(
+                self.idle / 2, self.sweep
+            )
+
+    def unregister(self, relay: Idle):
+        self.relays.pop(relay, None)
+
+    def sweep(self):
+        self.timer = None
+        for relay, (last, sweeps) in list(self.relays.items()):
+            activity = relay.activity()
+            if activity != last:
+                self.relays[relay] = (activity, 0)
+            elif sweeps >= 1:
+                # still at the count of two sweeps ago, a full ``idle`` ago
+                self.unregister(relay)
+                relay.abort()
+                self.stats[IDLE] += 1
+            else:
+                self.relays[relay] = (activity, sweeps + 1)
+        if self.relays and self.idle is not None:
+            self.timer = asyncio.get_running_loop().call_later(
+                self.idle / 2, self.sweep
+            )
+
+
+# the deadlines of protocols given none, one per event loop since they keep
+# a timer and counters
+_defaults: "WeakKeyDictionary[asyncio.AbstractEventLoop, Deadlines]" = (
+    WeakKeyDictionary()
+)
+# servers on several threads' loops look them up at once
+_defaults_lock = threading.Lock()
+
+
+def default_deadlines() -> Deadlines:
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        return Deadlines()
+    with _defaults_lock:
+        deadlines = _defaults.get(loop)
+        if deadlines is None:
+            deadlines = _defaults[loop] = Deadlines()
+    return deadlines
@@ -0,0 +1,89 @@
+import asyncio
+import socket
+import ssl
+from typing import Awaitable, Callable, Optional
+
+from protocols.forward import StreamPair
+from protocols.socket_options import SocketOptions
+from protocols.tracing import ConnectionTrace, Phase
+
+# Anything that can reach ``(host, port)`` and hand back a stream pair, e.g.
+# ``MuxClient.open_connection`` to tunnel through another instance.
+Dialer = Callable[[str, int], Awaitable[StreamPair]]
+
+
+class ProxyError(ConnectionError):
+    """
+    The proxy dialed through failed by itself: it rejected the credentials,
+    or could not or would not serve the request.
+    """
+
+
+class DestinationError(ConnectionError):
+    """
+    The proxy dialed through answered for the destination: it refused the
+    connection, was unreachable or is not allowed.
+    """
+
+
+async def open_connection(
+    host: str,
+    port: int,
+    dialer: Optional[Dialer] = None,
+    trace: Optional[ConnectionTrace] = None,
+    socket_options: Optional[SocketOptions] = None,
+) -> StreamPair:
+    if trace:
+        trace.target = f"{host}:{port}"
+    if dialer:
+        stream = await dialer(host, port)
+    elif trace or socket_options:
+        stream = await open_tuned_connection(host, port, trace, socket_options)
+    else:
+        stream = await asyncio.open_connection(host, port)
+    if trace:
+        trace.mark(Phase.CONNECT)
+    return stream
+
+
+async def open_tuned_connection(
+    host: str,
+    port: int,
+    trace: Optional[ConnectionTrace] = None,
+    socket_options: Optional[SocketOptions] = None,
+    ssl_context: Optional[ssl.SSLContext] = None,
+    server_hostname: Optional[str] = None,
+) -> StreamPair:
+    # resolve separately to tell DNS time from connect time and to set the
+    # socket options before the handshake, then try the addresses in order
+    # like asyncio.open_connection does
+    loop = asyncio.get_running_loop()
+    infos = await loop.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    if trace:
+        trace.mark(Phase.RESOLVE)
+    if ssl_context:
+        server_hostname = server_hostname or host
+    error: Optional[OSError] = None
+    for family, _, _, _, address in infos:
+        try:
+            if not socket_options:
+                return await asyncio.open_connection(
+                    address[0],
+                    address[1],
+                    ssl=ssl_context,
+                    server_hostname=server_hostname,
+                )
+            sock = await socket_options.connect(address, family)
+            stream = await asyncio.open_connection(
+                sock=sock, ssl=ssl_context, server_hostname=server_hostname
+            )
+            # the transport turns TCP_NODELAY on, which may be what the
+            # options turned off
+            socket_options.apply(stream[1])
+            return stream
+        except ssl.SSLError:
+            # the backend answered, another address would not help
+            raise
+        except OSError as e:
+            error = e
+    raise error or OSError(f"getaddrinfo returned nothing for {host}")
@@ -0,0 +1,185 @@
+"""
+A flight recorder of connection events.
+
+Every event is packed into a fixed 64 byte slot of a preallocated ring, so
+recording costs a clock read and a ``pack_into``. ``dump`` copies the ring
+on the loop and leaves ordering and writing it to a thread; install it on
+SIGUSR1 with ``install_signal_handler``. Read a dump back with
+
+    python -m protocols.flight_recorder DUMP
+"""
+import asyncio
+import errno
+import itertools
+import os
+import signal
+import struct
+import sys
+import time
+from enum import IntEnum
+from typing import Iterator, NamedTuple, Optional
+
+# +------+---------+-------+------+------+---+---+------+
+# | TIME | CONN ID | EVENT | CODE | PORT | A | B | TEXT |
+# +------+---------+-------+------+------+---+---+------+
+# |  8   |    4    |   1   |  1   |  2   | 8 | 8 |  32  |
+# +------+---------+-------+------+------+---+---+------+
+# TIME is wall clock nanoseconds, TEXT a NUL padded host or user name
+RECORD = struct.Struct("<qIBBHQQ32s")
+
+MAGIC = b"PRXFLT01"
+# magic, slots, events recorded in total
+DUMP_HEADER = struct.Struct("<8sQQ")
+
+
+class Event(IntEnum):
+    # TEXT, PORT: the peer
+    ACCEPT = 1
+    # CODE: 1 if the credentials were accepted, TEXT: the user name
+    AUTH = 2
+    # TEXT, PORT: where the client wants to go
+    TARGET = 3
+    # CODE: 0 on success, the errno otherwise
+    CONNECT = 4
+    # CODE: a CloseReason, A/B: bytes relayed to/from the target
+    CLOSE = 5
+
+
+class CloseReason(IntEnum):
+    DONE = 0
+    REJECTED = 1
+    ERROR = 2
+    TIMEOUT = 3
+
+
+class EventRecord(NamedTuple):
+    time: int
+    conn_id: int
+    event: Event
+    code: int
+    port: int
+    a: int
+    b: int
+    text: str
+
+
+class FlightRecorder:
+    def __init__(self, slots: int = 65536):
+        self.slots = slots
+        self.buffer = bytearray(RECORD.size * slots)
+        self.recorded = 0
+        self.conn_ids = itertools.count(1)
+
+    def next_conn_id(self) -> int:
+        return next(self.conn_ids)
+
+    def record(
+        self,
+        conn_id: int,
+        event: Event,
+        code: int = 0,
+        port: int = 0,
+        a: int = 0,
+        b: int = 0,
+        text: str = "",
+    ):
+        RECORD.pack_into(
+            self.buffer,
+            self.recorded % self.slots * RECORD.size,
+            time.time_ns(),
+            conn_id,
+            event,
+            code,
+            port,
+            a,
+            b,
+            text.encode()[:32],
+        )
+        self.recorded += 1
+
+    def snapshot(self) -> bytes:
+        """
+        The recorded events, oldest first, behind a DUMP_HEADER.
+        """
+        return self.serialize(bytes(self.buffer), self.recorded)
+
+    def serialize(self, ring: bytes, recorded: int) -> bytes:
+        start = recorded % self.slots * RECORD.size if recorded > self.slots else 0
+        used = min(recorded, self.slots) * RECORD.size
+        ordered = (ring[start:] + ring[:start])[:used]
+        return DUMP_HEADER.pack(MAGIC, self.slots, recorded) + ordered
+
+    async def dump(self, path: str):
+        # the copy is the only part that has to happen on the loop
+        ring, recorded = bytes(self.buffer), self.recorded
+        await asyncio.get_running_loop().run_in_executor(
+            None, self.write, path, ring, recorded
+        )
+
+    def write(self, path: str, ring: bytes, recorded: int):
+        data = self.serialize(ring, recorded)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def install_signal_handler(self, directory: str = ".", signum=signal.SIGUSR1):
+        loop = asyncio.get_running_loop()
+
+        def dump():
+            name = f"flight-{os.getpid()}-{time.strftime('%Y%m%d-%H%M%S')}.bin"
+            loop.create_task(self.dump(os.path.join(directory, name)))
+
+        loop.add_signal_handler(signum, dump)
+
+
+def error_code(e: BaseException) -> int:
+    code = getattr(e, "errno", None)
+    if isinstance(e, asyncio.TimeoutError):
+        return errno.ETIMEDOUT
+    if isinstance(e, asyncio.CancelledError):
+        return errno.ECANCELED
+    return code if isinstance(code, int) and 0 < code < 256 else errno.EIO
+
+
+def read_dump(path: str) -> Iterator[EventRecord]:
+    with open(path, "rb") as f:
+        data = f.read()
+    magic, slots, recorded = DUMP_HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError(f"{path} is not a flight recorder dump")
+    for offset in range(DUMP_HEADER.size, len(data), RECORD.size):
+        when, conn_id, event, code, port, a, b, text = RECORD.unpack_from(data, offset)
+        yield EventRecord(
+            when,
+            conn_id,
+            Event(event),
+            code,
+            port,
+            a,
+            b,
+            text.rstrip(b"\0").decode(errors="replace"),
+        )
+
+
+def format_event(record: EventRecord) -> str:
+    when = time.strftime("%H:%M:%S", time.localtime(record.time / 1e9))
+    line = f"{when}.{record.time % 10**9 // 1000:06d} #{record.conn_id} "
+    if record.event in (Event.ACCEPT, Event.TARGET):
+        return line + f"{record.event.name.lower()} {record.text}:{record.port}"
+    if record.event == Event.AUTH:
+        result = "ok" if record.code else "failed"
+        return line + f"auth {record.text} {result}"
+    if record.event == Event.CONNECT:
+        result = os.strerror(record.code) if record.code else "ok"
+        return line + f"connect {result}"
+    reason = CloseReason(record.code).name.lower()
+    return line + f"close {reason} sent={record.a} received={record.b}"
+
+
+def main(path: Optional[str] = None):
+    for record in read_dump(path or sys.argv[1]):
+        print(format_event(record))
+
+
+if __name__ == "__main__":
+    main()
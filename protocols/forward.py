@@ -1,33 +1,285 @@
 import asyncio
-from asyncio import StreamReader, StreamWriter, Event
-from contextlib import closing
-from typing import Tuple
+import threading
+from asyncio import StreamReader, StreamWriter
+from contextlib import closing, contextmanager
+from typing import Callable, List, Optional, Tuple, cast
+
+from protocols.deadlines import IDLE, Deadlines
+from protocols.memory import MemoryBudget, MemoryGovernor
 
 StreamPair = Tuple[StreamReader, StreamWriter]
 
+# called with the number of bytes relayed local -> remote and remote -> local
+OnClose = Callable[[int, int], None]
+OnFirstByte = Callable[[], None]
+
+READ_SIZE = 64 * 1024
+
+
+class _ReadBuffer(threading.local):
+    """
+    The buffer every spliced connection of a thread reads into; the data is
+    handed to the peer transport (which copies what it cannot send) before
+    the next read. One per thread, as loops in other threads read while
+    this one holds the data.
+    """
+
+    def __init__(self):
+        self.buffer = bytearray(READ_SIZE)
+        self.view = memoryview(self.buffer)
+
+
+_read = _ReadBuffer()
+
+
+class _RelayEnd(asyncio.BufferedProtocol):
+    __slots__ = ("relay", "transport", "peer", "received", "on_first_byte")
+
+    def __init__(self, relay: "Relay", transport: asyncio.Transport):
+        self.relay = relay
+        self.transport = transport
+        self.peer: "_RelayEnd"
+        self.received = 0
+        self.on_first_byte: Optional[OnFirstByte] = None
+
+    def get_buffer(self, sizehint: int):
+        return _read.view
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self.data_received(_read.buffer[:nbytes])
+
+    def data_received(self, data) -> None:
+        self.received += len(data)
+        self.peer.transport.write(data)
+        if self.on_first_byte:
+            self.on_first_byte()
+            self.on_first_byte = None
+
+    def eof_received(self):
+        # like the stream relay, the first EOF ends the whole relay
+        self.relay.close()
+        return False
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.relay.close()
+
+    def pause_writing(self) -> None:
+        self.peer.transport.pause_reading()
+
+    def resume_writing(self) -> None:
+        self.peer.transport.resume_reading()
+
+
+class Relay:
+    """
+    A relay that lives only in the two transports' protocol slots: while the
+    connection is idle there is no task, future or timer behind it.
 
-async def forward_stream(reader: StreamReader, writer: StreamWriter, event: Event):
-    while not event.is_set():
-        try:
-            data = await asyncio.wait_for(reader.read(1024), 2)
-        except asyncio.TimeoutError:
-            continue
-        if data == b"":
-            event.set()
-            break
+    The stream writers are kept because ``StreamWriter`` closes its transport
+    when it is garbage collected, but once the transports are spliced they
+    are cut loose from their stream protocols and readers, which can go.
+    """
 
+    __slots__ = (
+        "local",
+        "remote",
+        "writers",
+        "on_close",
+        "closed",
+        "governor",
+        "deadlines",
+    )
+
+    def __init__(
+        self,
+        local_writer: StreamWriter,
+        remote_writer: StreamWriter,
+        on_close: Optional[OnClose] = None,
+        on_first_byte: Optional[OnFirstByte] = None,
+        budget: Optional[MemoryBudget] = None,
+        deadlines: Optional[Deadlines] = None,
+    ):
+        self.local = _RelayEnd(self, cast(asyncio.Transport, local_writer.transport))
+        self.remote = _RelayEnd(self, cast(asyncio.Transport, remote_writer.transport))
+        self.local.peer = self.remote
+        self.remote.peer = self.local
+        self.remote.on_first_byte = on_first_byte
+        self.writers: Tuple[StreamWriter, ...] = (local_writer, remote_writer)
+        self.on_close = on_close
+        self.closed = False
+        self.governor: Optional[MemoryGovernor] = None
+        if budget:
+            self.governor = budget.governor
+            if self.governor:
+                self.governor.register(self)
+        self.deadlines = deadlines
+        if deadlines:
+            deadlines.register(self)
+
+    def activity(self) -> int:
+        return self.local.received + self.remote.received
+
+    def memory_usage(self) -> int:
+        return (
+            self.local.transport.get_write_buffer_size()
+            + self.remote.transport.get_write_buffer_size()
+        )
+
+    def abort(self):
+        # drop what is buffered rather than wait for a slow peer to take it
+        self.local.transport.abort()
+        self.remote.transport.abort()
+        self.close()
+
+    def start(
+        self,
+        local_reader: StreamReader,
+        remote_reader: StreamReader,
+        budget: Optional[MemoryBudget] = None,
+    ):
+        for end, reader in ((self.local, local_reader), (self.remote, remote_reader)):
+            # whatever the handshake read ahead goes first
+            buffered = bytes(reader._buffer)  # type: ignore[attr-defined]
+            reader._buffer.clear()  # type: ignore[attr-defined]
+            end.transport.set_protocol(end)
+            if buffered:
+                end.data_received(buffered)
+            if reader.at_eof() or reader.exception():
+                self.close()
+                return
+            if not end.transport.is_reading():
+                end.transport.resume_reading()
+
+        for end in (self.local, self.remote):
+            # only now, so that a transport already over the limit pauses
+            # the relay rather than the stream protocol it replaced
+            if budget:
+                budget.limit(end.transport)
+            _, high = end.transport.get_write_buffer_limits()
+            if end.transport.get_write_buffer_size() > high:
+                end.pause_writing()
+
+        for writer in self.writers:
+            writer._protocol = None  # type: ignore[attr-defined]
+            writer._reader = None  # type: ignore[attr-defined]
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.governor:
+            self.governor.unregister(self)
+        if self.deadlines:
+            self.deadlines.unregister(self)
+        self.local.transport.close()
+        self.remote.transport.close()
+        if self.on_close:
+            self.on_close(self.local.received, self.remote.received)
+        self.writers = ()
+
+
+def is_relayed(writer: StreamWriter) -> bool:
+    return isinstance(writer.transport.get_protocol(), _RelayEnd)
+
+
+@contextmanager
+def closing_stream(writer: StreamWriter):
+    """
+    ``closing`` for the accepted connection, except when it was handed over
+    to a ``Relay``, which then owns the transport.
+    """
+    try:
+        yield writer
+    finally:
+        if not is_relayed(writer):
+            writer.close()
+
+
+def can_splice(writer: StreamWriter) -> bool:
+    transport = writer.transport
+    return (
+        isinstance(transport, asyncio.Transport)
+        and not transport.is_closing()
+        and isinstance(transport.get_protocol(), asyncio.StreamReaderProtocol)
+    )
+
+
+async def forward_stream(
+    reader: StreamReader,
+    writer: StreamWriter,
+    totals: List[int],
+    index: int,
+    on_first_byte: Optional[OnFirstByte] = None,
+):
+    while data := await reader.read(READ_SIZE):
+        totals[index] += len(data)
         writer.write(data)
+        if on_first_byte:
+            on_first_byte()
+            on_first_byte = None
         await writer.drain()
 
 
-async def relay_stream(local_stream: StreamPair, remote_stream: StreamPair):
+async def relay_stream(
+    local_stream: StreamPair,
+    remote_stream: StreamPair,
+    on_close: Optional[OnClose] = None,
+    on_first_byte: Optional[OnFirstByte] = None,
+    budget: Optional[MemoryBudget] = None,
+    deadlines: Optional[Deadlines] = None,
+):
+    """
+    Relay until either side closes. Real transports are spliced and this
+    returns right away; ``on_close`` reports the totals once it is over, and
+    ``on_first_byte`` fires when the remote side first sends something.
+    ``budget`` bounds the write buffers of both directions, and the idle
+    deadline, if any, ends a relay that stopped moving.
+    """
     local_reader, local_writer = local_stream
     remote_reader, remote_writer = remote_stream
 
-    close_event = asyncio.Event()
+    if can_splice(local_writer) and can_splice(remote_writer):
+        relay = Relay(
+            local_writer, remote_writer, on_close, on_first_byte, budget, deadlines
+        )
+        relay.start(local_reader, remote_reader, budget)
+        return
+
+    if budget:
+        budget.limit(local_writer.transport)
+        budget.limit(remote_writer.transport)
+
+    totals = [0, 0]
     with closing(remote_writer):
         with closing(local_writer):
-            await asyncio.gather(
-                forward_stream(local_reader, remote_writer, close_event),
-                forward_stream(remote_reader, local_writer, close_event),
-            )
+            tasks = [
+                asyncio.ensure_future(
+                    forward_stream(local_reader, remote_writer, totals, 0)
+                ),
+                asyncio.ensure_future(
+                    forward_stream(
+                        remote_reader, local_writer, totals, 1, on_first_byte
+                    )
+                ),
+            ]
+            idle = deadlines.idle if deadlines else None
+            try:
+                while True:
+                    last = sum(totals)
+                    done, _ = await asyncio.wait(
+                        tasks, timeout=idle, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    if done:
+                        break
+                    if sum(totals) == last:
+                        cast(Deadlines, deadlines).stats[IDLE] += 1
+                        break
+                for task in done:
+                    # a reset is just another way for the relay to end
+                    task.exception()
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+    if on_close:
+        on_close(*totals)
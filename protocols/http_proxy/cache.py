@@ -0,0 +1,625 @@
+"""
+A disk-backed response cache for plain-HTTP GETs through the forward proxy.
+
+Every response lives in one file under ``directory/objects``: a JSON line
+with the status, headers and freshness, then the body, so a replacement
+is a single atomic rename and hits are sent with ``loop.sendfile``. Each
+process keeps an index of the entries it has seen and falls back to the
+disk for the others, which is what lets several workers share a directory.
+Recency is the file's mtime, and the byte total lives in ``directory/size``
+updated under an ``flock``, so the LRU bound holds across all of them. Once
+the total passes ``max_bytes``, the least recent entries are evicted down
+to ``low_watermark`` of it, so that the scan is rare. The disk is only
+touched in the default executor, off the loop, except for ``sendfile``.
+
+A response with ``Vary`` is stored with the values the request had for the
+listed headers, and only served to requests with the same values; there
+is one variant per URL. ``Vary: *`` is never stored.
+
+Stale entries are revalidated with If-None-Match / If-Modified-Since and
+a 304 is answered from the disk. The entry is rewritten with the 304's
+headers and time, so the other workers see it fresh as well.
+"""
+import asyncio
+import contextlib
+import fcntl
+import hashlib
+import json
+import os
+import re
+import shutil
+import struct
+import threading
+import time
+from asyncio import StreamReader, StreamWriter
+from collections import Counter, OrderedDict
+from email.utils import parsedate_to_datetime
+from typing import (
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+from urllib.parse import urlsplit
+
+from protocols.forward import StreamPair
+from protocols.http_proxy.parser import HttpRequest, hopHeaders, parse_headers
+
+READ_SIZE = 64 * 1024
+
+# requests carrying these are passed through untouched
+BYPASS_HEADERS = ("authorization", "range", "if-none-match", "if-modified-since")
+
+pack_size = struct.Struct("<q")
+
+# not stored: the hop-by-hop headers, in any case, and the framing, which
+# the stored copy replaces with its own length
+UNSTORED_HEADERS = {name.lower() for name in hopHeaders} | {
+    "content-length",
+    "keep-alive",
+}
+
+
+class CacheEntry:
+    __slots__ = (
+        "path",
+        "inode",
+        "offset",
+        "size",
+        "status",
+        "headers",
+        "validated",
+        "varied",
+    )
+
+    def __init__(
+        self,
+        path: str,
+        inode: int,
+        offset: int,
+        size: int,
+        status: str,
+        headers: List[Tuple[str, str]],
+        validated: float,
+        varied: Dict[str, Optional[str]],
+    ):
+        self.path = path
+        self.inode = inode
+        self.offset = offset
+        self.size = size
+        # "200 OK"
+        self.status = status
+        self.headers = headers
+        self.validated = validated
+        # the request's values of the headers named by Vary
+        self.varied = varied
+
+    def header(self, name: str) -> Optional[str]:
+        name = name.lower()
+        for key, value in self.headers:
+            if key.lower() == name:
+                return value
+        return None
+
+    def is_fresh(self, now: float) -> bool:
+        max_age = freshness(dict(self.headers))
+        return max_age is not None and now - self.validated < max_age
+
+    def matches(self, request: HttpRequest) -> bool:
+        return not self.varied or varied_headers(self.varied, request) == self.varied
+
+    def validators(self) -> Dict[str, str]:
+        validators = {}
+        if etag := self.header("ETag"):
+            validators["If-None-Match"] = etag
+        if last_modified := self.header("Last-Modified"):
+            validators["If-Modified-Since"] = last_modified
+        return validators
+
+
+def freshness(headers: Dict[str, str]) -> Optional[float]:
+    """
+    Seconds a response may be served without revalidation, 0 if it has to
+    be revalidated every time, None if it must not be stored.
+    """
+    lowered = {k.lower(): v for k, v in headers.items()}
+    directives = lowered.get("cache-control", "").lower()
+    if "no-store" in directives or "private" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0
+    for name in ("s-maxage", "max-age"):
+        if match := re.search(rf"{name}=(\d+)", directives):
+            return int(match[1])
+    if "expires" in lowered:
+        try:
+            expires = parsedate_to_datetime(lowered["expires"]).timestamp()
+        except (TypeError, ValueError):
+            return 0
+        return max(0.0, expires - time.time())
+    return 0
+
+
+def is_storable(headers: Dict[str, str]) -> bool:
+    # worth keeping if it can be served as is or revalidated
+    max_age = freshness(headers)
+    if max_age is None:
+        return False
+    lowered = {k.lower(): v for k, v in headers.items()}
+    if lowered.get("vary", "").strip() == "*":
+        return False
+    return max_age > 0 or "etag" in lowered or "last-modified" in lowered
+
+
+def varied_headers(
+    names: Iterable[str], request: HttpRequest
+) -> Dict[str, Optional[str]]:
+    lowered = {k.lower(): v for k, v in request.headers.items()}
+    return {name: lowered.get(name) for name in names}
+
+
+def vary(headers: Dict[str, str]) -> List[str]:
+    values = [v for k, v in headers.items() if k.lower() == "vary"]
+    return [
+        name.strip().lower() for value in values for name in value.split(",") if name
+    ]
+
+
+class HttpCache:
+    def __init__(
+        self,
+        directory: str,
+        max_bytes: int = 1024**3,
+        max_object_size: Optional[int] = None,
+        max_entries: int = 65536,
+        low_watermark: float = 0.9,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.low_watermark = low_watermark
+        self.max_object_size = max_object_size or max_bytes // 8
+        self.max_entries = max_entries
+        self.stats: Counter = Counter()
+        # an LRU of this process's view; the disk is the shared truth
+        self.index: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        # for a cache shared by the loops of a MultiLoopServer
+        self.index_lock = threading.Lock()
+
+        os.makedirs(os.path.join(directory, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(directory, "tmp"), exist_ok=True)
+        self.size_path = os.path.join(directory, "size")
+        self.lock_path = os.path.join(directory, "lock")
+
+    def accepts(self, request: HttpRequest) -> bool:
+        if request.method != "GET":
+            return False
+        headers = {k.lower() for k in request.headers}
+        return not any(name in headers for name in BYPASS_HEADERS)
+
+    def path(self, url: str) -> str:
+        digest = hashlib.sha256(url.encode()).hexdigest()
+        return os.path.join(self.directory, "objects", digest[:2], digest)
+
+    async def lookup(self, url: str) -> Optional[CacheEntry]:
+        with self.index_lock:
+            entry = self.index.get(url)
+            if entry is not None:
+                self.index.move_to_end(url)
+                return entry
+        loop = asyncio.get_running_loop()
+        entry = await loop.run_in_executor(None, self.load, url)
+        if entry is not None:
+            self.remember(url, entry)
+        return entry
+
+    def load(self, url: str) -> Optional[CacheEntry]:
+        path = self.path(url)
+        try:
+            with open(path, "rb") as f:
+                return read_entry(path, f)
+        except (OSError, ValueError):
+            return None
+
+    def remember(self, url: str, entry: CacheEntry):
+        with self.index_lock:
+            self.index[url] = entry
+            self.index.move_to_end(url)
+            while len(self.index) > self.max_entries:
+                self.index.popitem(last=False)
+
+    def forget(self, url: str):
+        with self.index_lock:
+            self.index.pop(url, None)
+
+    async def serve(self, url: str, entry: CacheEntry, writer: StreamWriter) -> bool:
+        """
+        Sends a cached response; False if the entry is gone or was replaced
+        by another worker in the meantime.
+        """
+        loop = asyncio.get_running_loop()
+        f = await loop.run_in_executor(None, open_entry, entry)
+        if f is None:
+            self.forget(url)
+            return False
+        with f:
+            writer.write(response_head(entry.status, entry.headers, entry.size))
+            await writer.drain()
+            await loop.sendfile(writer.transport, f, entry.offset, entry.size)
+        return True
+
+    def refresh(
+        self, url: str, entry: CacheEntry, headers: List[Tuple[str, str]]
+    ) -> Optional[CacheEntry]:
+        """
+        Rewrites an entry revalidated just now with its updated headers; None
+        if it is gone or was replaced meanwhile.
+        """
+        tmp = self.tmp_path()
+        try:
+            with open(entry.path, "rb") as f:
+                if os.fstat(f.fileno()).st_ino != entry.inode:
+                    return None
+                meta = entry_meta(url, entry.status, headers, entry.varied)
+                with open(tmp, "wb") as out:
+                    out.write(meta)
+                    f.seek(entry.offset)
+                    shutil.copyfileobj(f, out, READ_SIZE)
+            self.replace(url, tmp, len(meta) + entry.size)
+        except OSError:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(tmp)
+            return None
+        return self.load(url)
+
+    def tmp_path(self) -> str:
+        return os.path.join(
+            self.directory, "tmp", f"{os.getpid()}-{os.urandom(6).hex()}"
+        )
+
+    async def create(
+        self,
+        url: str,
+        status: str,
+        headers: List[Tuple[str, str]],
+        varied: Dict[str, Optional[str]],
+    ) -> "CacheWriter":
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            None, CacheWriter, self, url, status, headers, varied
+        )
+
+    @contextlib.contextmanager
+    def locked(self) -> Iterator[None]:
+        with open(self.lock_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def read_size(self) -> int:
+        try:
+            with open(self.size_path, "rb") as f:
+                return pack_size.unpack(f.read(pack_size.size))[0]
+        except (OSError, struct.error):
+            return self.scan()[1]
+
+    def write_size(self, size: int):
+        tmp = f"{self.size_path}.{os.getpid()}"
+        with open(tmp, "wb") as f:
+            f.write(pack_size.pack(max(size, 0)))
+        os.replace(tmp, self.size_path)
+
+    def scan(self) -> Tuple[List[Tuple[float, int, str]], int]:
+        files = []
+        total = 0
+        root = os.path.join(self.directory, "objects")
+        for prefix in os.scandir(root):
+            for item in os.scandir(prefix.path):
+                try:
+                    stat = item.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, item.path))
+                total += stat.st_size
+        return files, total
+
+    def commit(self, url: str, tmp: str, size: int):
+        self.replace(url, tmp, size)
+        self.stats["stored"] += 1
+
+    def replace(self, url: str, tmp: str, size: int):
+        path = self.path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.locked():
+            total = self.read_size()
+            try:
+                total -= os.stat(path).st_size
+            except FileNotFoundError:
+                pass
+            os.replace(tmp, path)
+            total += size
+            if total > self.max_bytes:
+                total = self.evict(keep=path)
+            self.write_size(total)
+
+    def evict(self, keep: str) -> int:
+        # called with the lock held; the scan also repairs the total
+        files, total = self.scan()
+        files.sort()
+        low = self.max_bytes * self.low_watermark
+        for _, size, path in files:
+            if total <= low:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            self.stats["evicted"] += 1
+        return total
+
+
+class CacheWriter:
+    """
+    Collects a body in a temporary file, published by ``commit``. Created
+    with ``HttpCache.create``; the writes run in the default executor.
+    """
+
+    def __init__(
+        self,
+        cache: HttpCache,
+        url: str,
+        status: str,
+        headers: List[Tuple[str, str]],
+        varied: Dict[str, Optional[str]],
+    ):
+        self.cache = cache
+        self.url = url
+        self.tmp = cache.tmp_path()
+        self.file = open(self.tmp, "wb")
+        meta = entry_meta(url, status, headers, varied)
+        self.file.write(meta)
+        self.size = len(meta)
+        self.failed = False
+
+    async def write(self, data: bytes):
+        if self.failed:
+            return
+        self.size += len(data)
+        if self.size > self.cache.max_object_size:
+            self.abort()
+            return
+        await asyncio.get_running_loop().run_in_executor(None, self.file.write, data)
+
+    async def commit(self):
+        if self.failed:
+            return
+        await asyncio.get_running_loop().run_in_executor(None, self.publish)
+        self.cache.forget(self.url)
+
+    def publish(self):
+        self.file.close()
+        self.cache.commit(self.url, self.tmp, self.size)
+
+    def abort(self):
+        if self.failed:
+            return
+        self.failed = True
+        # not awaited, it may run while the caller is being cancelled
+        asyncio.get_running_loop().run_in_executor(None, self.discard)
+
+    def discard(self):
+        self.file.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(self.tmp)
+
+
+def entry_meta(
+    url: str,
+    status: str,
+    headers: List[Tuple[str, str]],
+    varied: Dict[str, Optional[str]],
+) -> bytes:
+    meta = {
+        "url": url,
+        "status": status,
+        "headers": headers,
+        "validated": time.time(),
+        "varied": varied,
+    }
+    return json.dumps(meta).encode() + b"\n"
+
+
+def open_entry(entry: CacheEntry):
+    """
+    Opens an entry's file, unless it is gone or was replaced.
+    """
+    try:
+        f = open(entry.path, "rb")
+    except FileNotFoundError:
+        return None
+    try:
+        if os.fstat(f.fileno()).st_ino != entry.inode:
+            f.close()
+            return None
+        # shared recency for the LRU
+        os.utime(f.fileno())
+    except OSError:
+        f.close()
+        return None
+    return f
+
+
+def read_entry(path: str, f) -> CacheEntry:
+    meta_line = f.readline()
+    meta = json.loads(meta_line)
+    stat = os.fstat(f.fileno())
+    return CacheEntry(
+        path,
+        stat.st_ino,
+        len(meta_line),
+        stat.st_size - len(meta_line),
+        meta["status"],
+        [(k, v) for k, v in meta["headers"]],
+        meta["validated"],
+        meta.get("varied", {}),
+    )
+
+
+def response_head(status: str, headers: List[Tuple[str, str]], length: int) -> bytes:
+    lines = [f"HTTP/1.1 {status}"]
+    lines += [f"{k}: {v}" for k, v in headers]
+    lines += [f"Content-Length: {length}", "Connection: close"]
+    return ("\r\n".join(lines) + "\r\n\r\n").encode()
+
+
+def end_to_end(headers: Dict[str, str]) -> List[Tuple[str, str]]:
+    return [(k, v) for k, v in headers.items() if k.lower() not in UNSTORED_HEADERS]
+
+
+def updated_headers(
+    stored: List[Tuple[str, str]], headers: Dict[str, str]
+) -> List[Tuple[str, str]]:
+    # the headers of a 304 replace the stored ones of the same name
+    fresh = end_to_end(headers)
+    names = {k.lower() for k, _ in fresh}
+    return [(k, v) for k, v in stored if k.lower() not in names] + fresh
+
+
+async def forward_cached(
+    cache: HttpCache,
+    request: HttpRequest,
+    connect: Callable[[str, int], Awaitable[StreamPair]],
+    writer: StreamWriter,
+):
+    """
+    Answers a GET from the cache, revalidating it with the origin if it is
+    stale, or fetches it and stores it on the way through. The client
+    connection is closed afterwards.
+    """
+    url = request.url or ""
+    entry = await cache.lookup(url)
+    if entry and not entry.matches(request):
+        # another variant, which the response will replace
+        entry = None
+    now = time.time()
+    if entry and entry.is_fresh(now) and await cache.serve(url, entry, writer):
+        cache.stats["hits"] += 1
+        return
+
+    extra = entry.validators() if entry else {}
+    remote_reader, remote_writer = await connect(request.host, request.port)
+    try:
+        headers = {**request.headers_to_send, **extra, "Connection": "close"}
+        target = urlsplit(url)
+        path = (target.path or "/") + (f"?{target.query}" if target.query else "")
+        remote_writer.write(
+            (
+                f"GET {path} HTTP/1.1\r\n"
+                + "".join(f"{k}: {v}\r\n" for k, v in headers.items())
+                + "\r\n"
+            ).encode()
+        )
+        await remote_writer.drain()
+
+        head = await remote_reader.readuntil(b"\r\n\r\n")
+        lines = head.splitlines()
+        _, code, reason = (lines[0].decode().split(" ", 2) + [""])[:3]
+        response_headers = parse_headers(lines)
+
+        if code == "304" and entry:
+            loop = asyncio.get_running_loop()
+            updated = updated_headers(entry.headers, response_headers)
+            entry = await loop.run_in_executor(None, cache.refresh, url, entry, updated)
+            if entry:
+                cache.remember(url, entry)
+            if entry and await cache.serve(url, entry, writer):
+                cache.stats["revalidated"] += 1
+                return
+            # replaced or evicted meanwhile, fetch it for real
+            remote_writer.close()
+            cache.forget(url)
+            return await forward_cached(cache, request, connect, writer)
+
+        cache.stats["misses"] += 1
+        store = None
+        if code == "200" and is_storable(response_headers):
+            status = f"{code} {reason}".strip()
+            store = await cache.create(
+                url,
+                status,
+                end_to_end(response_headers),
+                varied_headers(vary(response_headers), request),
+            )
+        try:
+            await forward_body(head, response_headers, remote_reader, writer, store)
+        except BaseException:
+            if store:
+                store.abort()
+            raise
+        if store:
+            await store.commit()
+    finally:
+        remote_writer.close()
+
+
+async def forward_body(
+    head: bytes,
+    headers: Dict[str, str],
+    reader: StreamReader,
+    writer: StreamWriter,
+    store: Optional[CacheWriter],
+):
+    """
+    Passes the origin's response on as it is, de-chunking a copy for the
+    store.
+    """
+    lowered = {k.lower(): v for k, v in headers.items()}
+    chunked = "chunked" in lowered.get("transfer-encoding", "").lower()
+    lines = head.rstrip(b"\r\n").split(b"\r\n")
+    # the client connection ends with this response
+    lines = [line for line in lines if not line.lower().startswith(b"connection:")]
+    writer.write(b"\r\n".join(lines) + b"\r\nConnection: close\r\n\r\n")
+
+    if chunked:
+        while True:
+            size_line = await reader.readuntil(b"\r\n")
+            size = int(size_line.split(b";", 1)[0], 16)
+            writer.write(size_line)
+            if not size:
+                break
+            data = await reader.readexactly(size + 2)
+            writer.write(data)
+            if store:
+                await store.write(data[:-2])
+            await writer.drain()
+        # trailers, up to the empty line
+        while (line := await reader.readuntil(b"\r\n")) != b"\r\n":
+            writer.write(line)
+        writer.write(b"\r\n")
+    else:
+        remaining = (
+            int(lowered["content-length"]) if "content-length" in lowered else -1
+        )
+        while remaining:
+            data = await reader.read(
+                min(remaining, READ_SIZE) if remaining > 0 else READ_SIZE
+            )
+            if not data:
+                if remaining > 0:
+                    raise asyncio.IncompleteReadError(b"", remaining)
+                break
+            if remaining > 0:
+                remaining -= len(data)
+            writer.write(data)
+            if store:
+                await store.write(data)
+            await writer.drain()
+    await writer.drain()
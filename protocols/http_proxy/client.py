@@ -0,0 +1,123 @@
+import asyncio
+import base64
+from asyncio import StreamReader, StreamWriter
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+from protocols.dialer import DestinationError, ProxyError
+from protocols.forward import StreamPair
+from protocols.http_proxy.parser import parse_headers
+
+READ_SIZE = 64 * 1024
+
+
+# the statuses about the destination rather than the proxy: forbidden, and
+# the gateway errors
+DESTINATION_STATUSES = {403, 502, 504}
+
+
+def status_error(status: int, reason: str) -> ConnectionError:
+    if status in DESTINATION_STATUSES:
+        return DestinationError(f"proxy replied {status} {reason}")
+    return ProxyError(f"proxy replied {status} {reason}")
+
+
+def proxy_authorization(username: Optional[str], password: Optional[str]) -> bytes:
+    if username is None:
+        return b""
+    credentials = base64.b64encode(f"{username}:{password or ''}".encode())
+    return b"Proxy-Authorization: Basic " + credentials + b"\r\n"
+
+
+async def read_response_head(reader: StreamReader) -> Tuple[int, str, Dict[str, str]]:
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.splitlines()
+    _, status, reason = (lines[0].decode().split(" ", 2) + [""])[:3]
+    return int(status), reason, parse_headers(lines)
+
+
+async def read_body(reader: StreamReader, headers: Dict[str, str]) -> int:
+    """
+    Read and discard a response body, returning its length.
+    """
+    lowered = {k.lower(): v for k, v in headers.items()}
+    length = 0
+    if "chunked" in lowered.get("transfer-encoding", "").lower():
+        while size := int((await reader.readuntil(b"\r\n")).split(b";", 1)[0], 16):
+            await reader.readexactly(size + 2)
+            length += size
+        while await reader.readuntil(b"\r\n") != b"\r\n":
+            pass
+    elif "content-length" in lowered:
+        remaining = int(lowered["content-length"])
+        while remaining:
+            data = await reader.read(min(remaining, READ_SIZE))
+            if not data:
+                raise asyncio.IncompleteReadError(b"", remaining)
+            remaining -= len(data)
+            length += len(data)
+    else:
+        while data := await reader.read(READ_SIZE):
+            length += len(data)
+    return length
+
+
+async def http_connect(
+    reader: StreamReader,
+    writer: StreamWriter,
+    host: str,
+    port: int,
+    username: Optional[str] = None,
+    password: Optional[str] = None,
+):
+    """
+    Open a CONNECT tunnel to host:port through an already connected proxy.
+    Raises ``DestinationError`` for the proxy's answer about host:port and
+    ``ProxyError`` when the proxy itself fails, e.g. 407.
+    """
+    writer.write(
+        f"CONNECT {host}:{port} HTTP/1.1\r\nHost: {host}:{port}\r\n".encode()
+        + proxy_authorization(username, password)
+        + b"\r\n"
+    )
+    status, reason, _ = await read_response_head(reader)
+    if not 200 <= status < 300:
+        raise status_error(status, reason)
+
+
+async def http_get(
+    reader: StreamReader,
+    writer: StreamWriter,
+    url: str,
+    username: Optional[str] = None,
+    password: Optional[str] = None,
+) -> Tuple[int, int]:
+    """
+    GET an absolute URL through an already connected proxy and return the
+    status and the body length.
+    """
+    parsed = urlparse(url)
+    writer.write(
+        f"GET {url} HTTP/1.1\r\nHost: {parsed.netloc}\r\n".encode()
+        + proxy_authorization(username, password)
+        + b"Connection: close\r\n\r\n"
+    )
+    status, _, headers = await read_response_head(reader)
+    return status, await read_body(reader, headers)
+
+
+async def open_http_connection(
+    proxy_host: str,
+    proxy_port: int,
+    host: str,
+    port: int,
+    username: Optional[str] = None,
+    password: Optional[str] = None,
+) -> StreamPair:
+    reader, writer = await asyncio.open_connection(proxy_host, proxy_port)
+    try:
+        await http_connect(reader, writer, host, port, username, password)
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer
@@ -0,0 +1,491 @@
+import asyncio
+import logging
+from asyncio import StreamReader, StreamWriter
+from typing import Callable, Dict, Optional, List, Tuple
+from urllib.parse import urlparse
+
+import h2.config
+import h2.connection
+import h2.events
+import h2.exceptions
+import h2.settings
+
+from protocols.circuit_breaker import CircuitOpen
+from protocols.deadlines import CONNECT, Deadlines, default_deadlines
+from protocols.dialer import Dialer, open_connection
+from protocols.forward import StreamPair
+from protocols.http_proxy.parser import (
+    HttpRequest,
+    extract_username_password,
+    parse_headers,
+)
+from protocols.observer import ObservedProtocol
+
+logger = logging.getLogger(__name__)
+
+PREFACE = b"PRI * HTTP/2.0\r\n\r\nSM\r\n\r\n"
+
+# connection-specific fields are not allowed in HTTP/2 and not forwarded
+H2_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-connection",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailers",
+    "transfer-encoding",
+    "upgrade",
+    "http2-settings",
+}
+
+RECEIVE_WINDOW = 256 * 1024
+# shared by the streams of a connection, the protocol default is only 64 KiB
+CONNECTION_WINDOW = 1024 * 1024
+READ_SIZE = 64 * 1024
+
+
+class H2Stream:
+    def __init__(self, stream_id: int, headers: List[Tuple[str, str]], ended: bool):
+        self.stream_id = stream_id
+        self.headers = headers
+        self.pseudo = {k: v for k, v in headers if k.startswith(":")}
+        self.method = self.pseudo.get(":method", "")
+        # request body (or CONNECT upload), bounded by our receive window
+        self.body = StreamReader()
+        if ended:
+            self.body.feed_eof()
+        self.window_open = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def header(self, name: str) -> Optional[str]:
+        for k, v in self.headers:
+            if k == name:
+                return v
+        return None
+
+
+class H2ProxyConnection:
+    """
+    Serves one client connection that speaks HTTP/2 (prior knowledge or
+    after an ``Upgrade: h2c``). Every stream, CONNECT included, gets its own
+    upstream HTTP/1.1 connection; upstream reads only continue while the
+    client's flow-control window has room. Client DATA is credited to the
+    connection as soon as it is buffered, and to its stream once the
+    upstream has taken it, so one slow upstream only stalls its own stream.
+
+    With the ``observer``, the server protocol the connection came in on,
+    streams dial through its ``connect``: its circuit breakers, socket
+    options, deadlines, trace and flight recorder. Its memory budget bounds
+    the write buffers, and with its ``early_reply`` a CONNECT stream is
+    answered before the dial, and reset if that fails.
+    """
+
+    def __init__(
+        self,
+        reader: StreamReader,
+        writer: StreamWriter,
+        dialer: Optional[Dialer] = None,
+        on_auth: Optional[Callable[[str, str], bool]] = None,
+        on_connect: Optional[Callable[[str, int], bool]] = None,
+        max_concurrent_streams: int = 100,
+        deadlines: Optional[Deadlines] = None,
+        observer: Optional[ObservedProtocol] = None,
+    ):
+        self.reader = reader
+        self.writer = writer
+        self.dialer = dialer
+        self.on_auth = on_auth
+        self.on_connect = on_connect
+        self.deadlines = deadlines or default_deadlines()
+        self.observer = observer
+        self.memory_budget = observer.memory_budget if observer else None
+        self.early_reply = observer.early_reply if observer else False
+
+        config = h2.config.H2Configuration(
+            client_side=False, header_encoding="utf-8", validate_inbound_headers=False
+        )
+        self.conn = h2.connection.H2Connection(config=config)
+        self.conn.local_settings = h2.settings.Settings(
+            client=False,
+            initial_values={
+                h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS: max_concurrent_streams,
+                h2.settings.SettingCodes.INITIAL_WINDOW_SIZE: RECEIVE_WINDOW,
+            },
+        )
+        self.streams: Dict[int, H2Stream] = {}
+        # connection credit not yet returned to the client
+        self.unacked = 0
+
+    async def serve(self, data: bytes = b"", upgrade: Optional[HttpRequest] = None):
+        if self.memory_budget:
+            self.memory_budget.limit(self.writer.transport)
+        if upgrade:
+            settings = upgrade_header(upgrade, "HTTP2-Settings") or ""
+            self.writer.write(
+                b"HTTP/1.1 101 Switching Protocols\r\n"
+                b"Connection: Upgrade\r\n"
+                b"Upgrade: h2c\r\n\r\n"
+            )
+            self.conn.initiate_upgrade_connection(settings.encode())
+            self.start_stream(1, upgrade_headers(upgrade), ended=True)
+        else:
+            self.conn.initiate_connection()
+        self.conn.increment_flow_control_window(
+            CONNECTION_WINDOW - self.conn.inbound_flow_control_window
+        )
+        self.flush()
+
+        try:
+            while True:
+                if not data:
+                    data = await self.reader.read(READ_SIZE)
+                    if not data:
+                        break
+                try:
+                    events = self.conn.receive_data(data)
+                except h2.exceptions.ProtocolError as e:
+                    logger.debug("HTTP/2 protocol error: %r", e)
+                    self.flush()
+                    break
+                data = b""
+                for event in events:
+                    self.handle_event(event)
+                self.flush()
+                await self.writer.drain()
+        finally:
+            for stream in list(self.streams.values()):
+                if stream.task:
+                    stream.task.cancel()
+
+    def flush(self):
+        data = self.conn.data_to_send()
+        if data and not self.writer.is_closing():
+            self.writer.write(data)
+
+    def handle_event(self, event):
+        if isinstance(event, h2.events.RequestReceived):
+            self.start_stream(
+                event.stream_id,
+                event.headers,
+                ended=event.stream_ended is not None,
+            )
+        elif isinstance(event, h2.events.DataReceived):
+            stream = self.streams.get(event.stream_id)
+            self.credit_connection(event.flow_controlled_length)
+            padding = event.flow_controlled_length - len(event.data)
+            if stream and not stream.body.at_eof():
+                if padding:
+                    self.credit_stream(stream, padding)
+                stream.body.feed_data(event.data)
+        elif isinstance(event, h2.events.StreamEnded):
+            stream = self.streams.get(event.stream_id)
+            if stream:
+                stream.body.feed_eof()
+        elif isinstance(event, h2.events.StreamReset):
+            stream = self.streams.pop(event.stream_id, None)
+            if stream and stream.task:
+                stream.task.cancel()
+        elif isinstance(event, h2.events.WindowUpdated):
+            if event.stream_id == 0:
+                for stream in self.streams.values():
+                    stream.window_open.set()
+            elif event.stream_id in self.streams:
+                self.streams[event.stream_id].window_open.set()
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            self.writer.close()
+
+    def start_stream(self, stream_id: int, headers, ended: bool):
+        stream = H2Stream(stream_id, list(headers), ended)
+        self.streams[stream_id] = stream
+        stream.task = asyncio.get_running_loop().create_task(self.handle_stream(stream))
+
+    # Stream handling
+
+    async def handle_stream(self, stream: H2Stream):
+        try:
+            await self._handle_stream(stream)
+        except Exception as e:
+            # one broken stream must not take the connection down
+            logger.debug("stream %d failed: %r", stream.stream_id, e)
+            self.reset(stream)
+        finally:
+            self.streams.pop(stream.stream_id, None)
+
+    async def _handle_stream(self, stream: H2Stream):
+        method = stream.method
+        authority = stream.pseudo.get(":authority") or stream.header("host") or ""
+        if method == "CONNECT":
+            host, _, port = authority.rpartition(":")
+            default_port = 443
+        else:
+            parsed = urlparse(f"//{authority}")
+            host, port = parsed.hostname or "", str(parsed.port or "")
+            default_port = 443 if stream.pseudo.get(":scheme") == "https" else 80
+        host = host.strip("[]")
+        if not host:
+            await self.respond(stream, 400)
+            return
+
+        if self.on_auth:
+            credentials = stream.header("proxy-authorization")
+            try:
+                username, password = extract_username_password(credentials)
+            except (AttributeError, ValueError, AssertionError):
+                username = password = ""
+            accepted = bool(credentials) and self.on_auth(username, password)
+            if self.observer:
+                self.observer.record_auth(username, accepted)
+            if not accepted:
+                await self.respond(
+                    stream, 407, [("proxy-authenticate", 'Basic realm="proxy"')]
+                )
+                return
+
+        target_port = int(port) if port else default_port
+        if self.on_connect:
+            if not self.on_connect(host, target_port):
+                await self.respond(stream, 403)
+                return
+
+        replied = method == "CONNECT" and self.early_reply
+        if replied:
+            self.conn.send_headers(stream.stream_id, [(":status", "200")])
+            self.flush()
+        try:
+            remote_reader, remote_writer = await self.dial(host, target_port)
+        except CircuitOpen as e:
+            status = 504 if e.timed_out else 502
+        except asyncio.TimeoutError:
+            status = 504
+        except OSError:
+            status = 502
+        else:
+            status = 0
+        if status:
+            if replied:
+                self.reset(stream)
+            else:
+                await self.respond(stream, status)
+            return
+        if self.memory_budget:
+            self.memory_budget.limit(remote_writer.transport)
+
+        try:
+            if method == "CONNECT":
+                await self.tunnel(stream, remote_reader, remote_writer, replied)
+            else:
+                await self.forward(stream, remote_reader, remote_writer)
+        finally:
+            remote_writer.close()
+
+    async def dial(self, host: str, port: int) -> StreamPair:
+        if self.observer:
+            return await self.observer.connect(host, port)
+        async with self.deadlines.phase(CONNECT):
+            return await open_connection(host, port, self.dialer)
+
+    async def tunnel(
+        self, stream: H2Stream, remote_reader, remote_writer, replied=False
+    ):
+        if not replied:
+            self.conn.send_headers(stream.stream_id, [(":status", "200")])
+            self.flush()
+
+        upload = asyncio.ensure_future(self.pump_body(stream, remote_writer))
+        try:
+            while data := await remote_reader.read(READ_SIZE):
+                await self.send_data(stream, data)
+            self.end_stream(stream)
+            # the tunnel ends with either side, as the relay does; a client
+            # still sending is told to stop without an error
+            if upload.done():
+                await upload
+            else:
+                self.reset(stream)
+        finally:
+            upload.cancel()
+
+    async def forward(self, stream: H2Stream, remote_reader, remote_writer):
+        path = stream.pseudo.get(":path", "/")
+        authority = stream.pseudo.get(":authority") or stream.header("host")
+        headers = [f"{stream.method} {path} HTTP/1.1", f"Host: {authority}"]
+        cookies = []
+        for k, v in stream.headers:
+            if k.startswith(":") or k in H2_HOP_HEADERS or k == "host":
+                continue
+            if k == "cookie":
+                cookies.append(v)
+                continue
+            headers.append(f"{k}: {v}")
+        if cookies:
+            headers.append(f"cookie: {'; '.join(cookies)}")
+
+        chunked = False
+        if not stream.body.at_eof() and stream.header("content-length") is None:
+            chunked = True
+            headers.append("Transfer-Encoding: chunked")
+        headers.append("Connection: close")
+        remote_writer.write(("\r\n".join(headers) + "\r\n\r\n").encode())
+
+        upload = asyncio.ensure_future(self.pump_body(stream, remote_writer, chunked))
+        try:
+            await self.forward_response(stream, remote_reader)
+            await upload
+        finally:
+            upload.cancel()
+
+    async def forward_response(self, stream: H2Stream, remote_reader: StreamReader):
+        while True:
+            head = await remote_reader.readuntil(b"\r\n\r\n")
+            lines = head.splitlines()
+            status = int(lines[0].split(b" ", 2)[1])
+            response_headers = parse_headers(lines)
+
+            headers = [(":status", str(status))]
+            for k, v in response_headers.items():
+                if k.lower() not in H2_HOP_HEADERS:
+                    headers.append((k.lower(), v))
+
+            if status == 101:
+                # nothing asked for an upgrade, and HTTP/2 has none
+                raise ValueError("unexpected 101 from upstream")
+            if status >= 200:
+                break
+            # interim responses (100 Continue, 103 Early Hints) go out as
+            # they come, the final one follows
+            self.conn.send_headers(stream.stream_id, headers)
+            self.flush()
+
+        no_body = stream.method == "HEAD" or status in (204, 304)
+        self.conn.send_headers(stream.stream_id, headers, end_stream=no_body)
+        self.flush()
+        if no_body:
+            return
+
+        lowered = {k.lower(): v for k, v in response_headers.items()}
+        if "chunked" in lowered.get("transfer-encoding", "").lower():
+            while True:
+                size_line = await remote_reader.readuntil(b"\r\n")
+                size = int(size_line.split(b";", 1)[0], 16)
+                if size == 0:
+                    # trailers are dropped
+                    while await remote_reader.readuntil(b"\r\n") != b"\r\n":
+                        pass
+                    break
+                await self.send_data(stream, await remote_reader.readexactly(size))
+                await remote_reader.readexactly(2)
+        elif "content-length" in lowered:
+            remaining = int(lowered["content-length"])
+            while remaining:
+                data = await remote_reader.read(min(remaining, READ_SIZE))
+                if not data:
+                    raise asyncio.IncompleteReadError(b"", remaining)
+                remaining -= len(data)
+                await self.send_data(stream, data)
+        else:
+            while data := await remote_reader.read(READ_SIZE):
+                await self.send_data(stream, data)
+        self.end_stream(stream)
+
+    async def pump_body(self, stream: H2Stream, remote_writer, chunked=False):
+        while data := await stream.body.read(READ_SIZE):
+            remote_writer.write(
+                b"%x\r\n%s\r\n" % (len(data), data) if chunked else data
+            )
+            await remote_writer.drain()
+            # only now the client may send more on this stream
+            if stream.stream_id in self.streams:
+                self.credit_stream(stream, len(data))
+                self.flush()
+        if chunked:
+            remote_writer.write(b"0\r\n\r\n")
+        elif stream.method == "CONNECT" and remote_writer.can_write_eof():
+            remote_writer.write_eof()
+
+    # Flow control
+
+    def credit_connection(self, size: int):
+        # batched, the client still has three quarters of the window
+        self.unacked += size
+        if self.unacked >= CONNECTION_WINDOW // 4:
+            self.conn.increment_flow_control_window(self.unacked)
+            self.unacked = 0
+
+    def credit_stream(self, stream: H2Stream, size: int):
+        try:
+            self.conn.increment_flow_control_window(size, stream.stream_id)
+        except h2.exceptions.StreamClosedError:
+            pass
+
+    # Sending
+
+    async def send_data(self, stream: H2Stream, data: bytes):
+        view = memoryview(data)
+        while view:
+            window = min(
+                self.conn.local_flow_control_window(stream.stream_id),
+                self.conn.max_outbound_frame_size,
+            )
+            if window <= 0:
+                stream.window_open.clear()
+                await stream.window_open.wait()
+                continue
+            self.conn.send_data(stream.stream_id, view[:window].tobytes())
+            view = view[window:]
+            self.flush()
+        await self.writer.drain()
+
+    def end_stream(self, stream: H2Stream):
+        self.conn.end_stream(stream.stream_id)
+        self.flush()
+
+    async def respond(self, stream: H2Stream, status: int, headers=None):
+        self.conn.send_headers(
+            stream.stream_id,
+            [(":status", str(status)), *(headers or [])],
+            end_stream=True,
+        )
+        self.flush()
+        await self.writer.drain()
+
+    def reset(self, stream: H2Stream):
+        try:
+            self.conn.reset_stream(stream.stream_id)
+        except h2.exceptions.StreamClosedError:
+            return
+        self.flush()
+
+
+def upgrade_header(request: HttpRequest, name: str) -> Optional[str]:
+    for k, v in request.headers.items():
+        if k.lower() == name.lower():
+            return v
+    return None
+
+
+def is_h2c_upgrade(request: HttpRequest) -> bool:
+    # requests with a body are served over HTTP/1.1, the body would have to
+    # be read before switching
+    return (
+        request.method != "CONNECT"
+        and (upgrade_header(request, "Upgrade") or "").lower() == "h2c"
+        and upgrade_header(request, "HTTP2-Settings") is not None
+        and int(upgrade_header(request, "Content-Length") or 0) == 0
+        and upgrade_header(request, "Transfer-Encoding") is None
+    )
+
+
+def upgrade_headers(request: HttpRequest) -> List[Tuple[str, str]]:
+    parsed = urlparse(request.target)
+    authority = parsed.netloc or upgrade_header(request, "Host") or ""
+    path = parsed.path or "/"
+    if parsed.query:
+        path += "?" + parsed.query
+    return [
+        (":method", request.method),
+        (":scheme", parsed.scheme or "http"),
+        (":authority", authority),
+        (":path", path),
+        *[(k.lower(), v) for k, v in request.headers.items()],
+    ]
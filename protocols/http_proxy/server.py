@@ -1,76 +1,178 @@
 import asyncio
 import logging
 from asyncio import StreamReader, StreamWriter
-from contextlib import closing
 from typing import Optional, Callable
 
-import async_timeout  # type:ignore
-
-from protocols.forward import relay_stream
+from protocols.access_log import AccessLog
+from protocols.circuit_breaker import CircuitBreakers, CircuitOpen
+from protocols.deadlines import HANDSHAKE, Deadlines, default_deadlines
+from protocols.dialer import Dialer
+from protocols.flight_recorder import FlightRecorder
+from protocols.forward import closing_stream, is_relayed
+from protocols.http_proxy.cache import HttpCache, forward_cached
 from protocols.http_proxy.parser import HttpRequest, extract_username_password
+from protocols.memory import MemoryBudget
+from protocols.observer import ObservedProtocol
+from protocols.socket_options import SocketOptions
+from protocols.tracing import Phase, Tracer
+
+try:
+    from protocols.http_proxy import http2
+except ImportError:  # h2 is optional
+    http2 = None  # type:ignore
 
 logger = logging.getLogger(__name__)
 
+HEADER_TOO_LARGE = (
+    b"HTTP/1.1 431 Request Header Fields Too Large\r\nConnection: close\r\n\r\n"
+)
+CONNECTION_ESTABLISHED = b"HTTP/1.1 200 Connection Established\r\n\r\n"
+BAD_GATEWAY = b"HTTP/1.1 502 Bad Gateway\r\nConnection: close\r\n\r\n"
+GATEWAY_TIMEOUT = b"HTTP/1.1 504 Gateway Timeout\r\nConnection: close\r\n\r\n"
+
+
+class HttpProxyServerProtocol(ObservedProtocol, asyncio.StreamReaderProtocol):
+    name = "http"
 
-class HttpProxyServerProtocol(asyncio.StreamReaderProtocol):
     def __init__(
         self,
         on_accept: Optional[Callable[[str, int], bool]] = None,
         on_auth: Optional[Callable[[str, str], bool]] = None,
         on_connect: Optional[Callable[[str, int], bool]] = None,
+        dialer: Optional[Dialer] = None,
+        http2: bool = True,
+        tracer: Optional[Tracer] = None,
+        flight_recorder: Optional[FlightRecorder] = None,
+        socket_options: Optional[SocketOptions] = None,
+        access_log: Optional[AccessLog] = None,
+        cache: Optional[HttpCache] = None,
+        memory_budget: Optional[MemoryBudget] = None,
+        deadlines: Optional[Deadlines] = None,
+        early_reply: bool = False,
+        circuit_breakers: Optional[CircuitBreakers] = None,
     ):
-        self.reader = StreamReader()
+        self.reader = (
+            StreamReader(limit=memory_budget.header_size)
+            if memory_budget
+            else StreamReader()
+        )
         super().__init__(self.reader, self.handler)
 
         self.on_accept = on_accept
         self.on_auth = on_auth
         self.on_connect = on_connect
+        self.dialer = dialer
+        self.http2 = http2
+        self.tracer = tracer
+        self.flight_recorder = flight_recorder
+        self.socket_options = socket_options
+        self.access_log = access_log
+        self.memory_budget = memory_budget
+        self.deadlines = deadlines or default_deadlines()
+        self.early_reply = early_reply
+        self.circuit_breakers = circuit_breakers
+        self.cache = cache
 
     async def handler(self, reader: StreamReader, writer: StreamWriter):
-        with closing(writer):
-            await self._handler(reader, writer)
+        with closing_stream(writer):
+            await self.observe(self._handler(reader, writer), writer)
 
     async def _handler(self, reader: StreamReader, writer: StreamWriter) -> None:
         addr = writer.get_extra_info("peername")
         if self.on_accept:
             if not self.on_accept(addr[0], addr[1]):
+                self.reject()
                 return
+            if self.trace:
+                self.trace.mark(Phase.ON_ACCEPT)
 
-        data = await reader.readuntil(b"\r\n\r\n")
+        try:
+            async with self.deadlines.phase(HANDSHAKE):
+                data = await reader.readuntil(b"\r\n\r\n")
+        except asyncio.LimitOverrunError:
+            # the header outgrew the reader limit, before any of it is parsed
+            writer.write(HEADER_TOO_LARGE)
+            self.reject()
+            return
+        if self.trace:
+            self.trace.mark(Phase.HEADER)
+
+        if self.http2 and http2 and data == http2.PREFACE[:18]:
+            # prior knowledge, the client starts right away with HTTP/2
+            async with self.deadlines.phase(HANDSHAKE):
+                data += await reader.readexactly(len(http2.PREFACE) - len(data))
+            if data == http2.PREFACE:
+                await self.serve_http2(reader, writer, data)
+            return
 
         request = HttpRequest(data)
-        logger.debug(f"Request {request} from {addr!r}")
+        logger.debug("Request %s from %r", request, addr)
+
+        if self.http2 and http2 and http2.is_h2c_upgrade(request):
+            await self.serve_http2(reader, writer, upgrade=request)
+            return
 
         if self.on_auth:
             credentials = request.headers["Proxy-Authorization"]
             username, password = extract_username_password(credentials)
-            if not self.on_auth(username, password):
+            accepted = self.on_auth(username, password)
+            self.record_auth(username, accepted)
+            if not accepted:
+                self.reject()
                 return
+            if self.trace:
+                self.trace.mark(Phase.AUTH)
 
         if self.on_connect:
             if not self.on_connect(request.host, request.port):
+                self.reject()
                 return
 
         await self.forward(request, reader, writer)
 
+    async def serve_http2(self, reader, writer, data=b"", upgrade=None):
+        # authentication and on_connect are checked per stream, which dial
+        # through self.connect
+        connection = http2.H2ProxyConnection(
+            reader,
+            writer,
+            on_auth=self.on_auth,
+            on_connect=self.on_connect,
+            deadlines=self.deadlines,
+            observer=self,
+        )
+        await connection.serve(data, upgrade)
+
     async def forward(self, request, reader, writer):
         try:
-            async with async_timeout.timeout(30):
-                if request.method == "CONNECT":
-                    await self.forward_https(
-                        request,
-                        reader,
-                        writer,
-                    )
-                else:
-                    await self.forward_http(
-                        request,
-                        reader,
-                        writer,
-                    )
-
+            if self.cache and self.cache.accepts(request):
+                await forward_cached(self.cache, request, self.connect, writer)
+            elif request.method == "CONNECT":
+                await self.forward_https(
+                    request,
+                    reader,
+                    writer,
+                )
+            else:
+                await self.forward_http(
+                    request,
+                    reader,
+                    writer,
+                )
+        except CircuitOpen as e:
+            if not self.replied:
+                writer.write(GATEWAY_TIMEOUT if e.timed_out else BAD_GATEWAY)
+            self.reject()
         except asyncio.TimeoutError:
-            ...
+            if not (self.replied or is_relayed(writer)):
+                writer.write(GATEWAY_TIMEOUT)
+            raise
+        except OSError as e:
+            if e is not self.dial_error:
+                raise
+            if not self.replied:
+                writer.write(BAD_GATEWAY)
+            self.dial_failed(e)
 
     async def forward_https(
         self,
@@ -78,13 +180,10 @@ class HttpProxyServerProtocol(asyncio.StreamReaderProtocol):
         reader: StreamReader,
         writer: StreamWriter,
     ):
-        remote_reader, remote_writer = await asyncio.open_connection(
-            request.host, request.port
+        remote_reader, remote_writer = await self.open_tunnel(
+            request.host, request.port, writer, CONNECTION_ESTABLISHED
         )
-
-        writer.write(b"HTTP/1.1 200 Connection Established\r\n\r\n")
-        await writer.drain()
-        await relay_stream((reader, writer), (remote_reader, remote_writer))
+        await self.relay((reader, writer), (remote_reader, remote_writer))
 
     async def forward_http(
         self,
@@ -92,9 +191,7 @@ class HttpProxyServerProtocol(asyncio.StreamReaderProtocol):
         reader: StreamReader,
         writer: StreamWriter,
     ):
-        remote_reader, remote_writer = await asyncio.open_connection(
-            request.host, request.port
-        )
+        remote_reader, remote_writer = await self.connect(request.host, request.port)
 
         headers = b"\r\n".join(
             [f"{k}: {v}".encode() for k, v in request.headers_to_send.items()]
@@ -109,15 +206,20 @@ class HttpProxyServerProtocol(asyncio.StreamReaderProtocol):
 
         remote_writer.write(data)
         await remote_writer.drain()
-        await relay_stream((reader, writer), (remote_reader, remote_writer))
+        await self.relay((reader, writer), (remote_reader, remote_writer))
 
 
 async def main():
     host, port = "127.0.0.1", 8080
     loop = asyncio.get_event_loop()
+    # kill -USR1 dumps the recent connection events to the working directory
+    recorder = FlightRecorder()
+    recorder.install_signal_handler()
     server = await loop.create_server(
         lambda: HttpProxyServerProtocol(
-            on_accept=lambda a, p: True, on_connect=lambda a, p: True
+            on_accept=lambda a, p: True,
+            on_connect=lambda a, p: True,
+            flight_recorder=recorder,
         ),
         host,
         port,
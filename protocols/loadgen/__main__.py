@@ -0,0 +1,112 @@
+"""
+Open-loop load generator for the proxies.
+
+    python -m protocols.loadgen MODE [--proxy HOST:PORT | --spawn] --rate 1000
+
+MODE is socks5, http-connect, http-get or reverse. Every connection goes
+through the proxy to a built-in origin on this host (echo for tunnels, a
+fixed-size HTTP response for http-get), so no network is needed. --spawn
+starts the proxy under test in a child process, with --socket-options
+picking one of the socket tuning profiles for it; otherwise a reverse proxy
+has to be pointed at --origin-port. --hold keeps every finished tunnel open
+for a while, which is how to ramp up tens of thousands of concurrent
+connections; raise ``ulimit -n`` for that.
+"""
+import argparse
+import asyncio
+import multiprocessing
+
+from protocols.loadgen.generator import MODES, LoadGenerator
+from protocols.loadgen.origin import Origin
+from protocols.loadgen.proxy import SOCKET_PROFILES, raise_fd_limit, serve_proxy
+
+DEFAULT_PORTS = {"socks5": 1080, "http-connect": 8080, "http-get": 8080}
+
+
+async def run(args) -> LoadGenerator:
+    loop = asyncio.get_running_loop()
+    origin = await loop.create_server(
+        lambda: Origin(args.body_size), args.origin_host, args.origin_port, backlog=4096
+    )
+    origin_port = origin.sockets[0].getsockname()[1]
+
+    proxy = None
+    if args.spawn:
+        parent, child = multiprocessing.Pipe()
+        proxy = multiprocessing.get_context("spawn").Process(
+            target=serve_proxy,
+            args=(args.mode, args.origin_host, origin_port, child, args.socket_options),
+            daemon=True,
+        )
+        proxy.start()
+        proxy_host, proxy_port = "127.0.0.1", await loop.run_in_executor(
+            None, parent.recv
+        )
+    else:
+        host, _, port = args.proxy.rpartition(":")
+        proxy_host, proxy_port = host or "127.0.0.1", int(port)
+
+    generator = LoadGenerator(
+        args.mode,
+        proxy_host,
+        proxy_port,
+        args.origin_host,
+        origin_port,
+        rate=args.rate,
+        duration=args.duration,
+        concurrency=args.concurrency,
+        ramp=args.ramp,
+        arrival=args.arrival,
+        payload=args.payload,
+        hold=args.hold,
+        timeout=args.timeout,
+        username=args.username,
+        password=args.password,
+    )
+    try:
+        await generator.run()
+    finally:
+        if proxy:
+            proxy.terminate()
+        origin.close()
+    return generator
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("mode", choices=MODES)
+    parser.add_argument("--proxy", help="HOST:PORT of the proxy under test")
+    parser.add_argument("--spawn", action="store_true")
+    parser.add_argument("--rate", type=float, default=100, help="connections/s")
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--ramp", type=float, default=0, help="seconds to full rate")
+    parser.add_argument("--arrival", choices=("poisson", "uniform"), default="poisson")
+    parser.add_argument("--concurrency", type=int, default=10000)
+    parser.add_argument("--hold", type=float, default=0)
+    parser.add_argument("--payload", type=int, default=64)
+    parser.add_argument("--body-size", type=int, default=1024)
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--username")
+    parser.add_argument("--password")
+    parser.add_argument("--origin-host", default="127.0.0.1")
+    parser.add_argument("--origin-port", type=int, default=0)
+    parser.add_argument(
+        "--socket-options",
+        choices=SOCKET_PROFILES,
+        default="none",
+        help="socket profile of a --spawn proxy",
+    )
+    args = parser.parse_args()
+
+    if not args.spawn and not args.proxy:
+        if args.mode == "reverse":
+            parser.error("reverse needs --proxy or --spawn")
+        args.proxy = f"127.0.0.1:{DEFAULT_PORTS[args.mode]}"
+
+    raise_fd_limit()
+    generator = asyncio.run(run(args))
+    print(generator.report())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import asyncio
+import random
+from collections import Counter
+from typing import Optional
+
+import async_timeout  # type:ignore
+
+from protocols.forward import StreamPair
+from protocols.http_proxy.client import http_get, open_http_connection
+from protocols.loadgen.histogram import Histogram
+from protocols.socks5_server.client import open_socks5_connection
+
+MODES = ("socks5", "http-connect", "http-get", "reverse")
+PERCENTILES = (50, 90, 99, 99.9, 99.99)
+
+
+def microseconds(seconds: float) -> int:
+    return int(seconds * 1e6)
+
+
+class LoadGenerator:
+    """
+    Open-loop load: connections arrive at ``rate`` per second whether or not
+    earlier ones finished, and at most ``concurrency`` run at once. Latency
+    is measured from the moment a connection was due to start, so time spent
+    waiting behind a slow proxy (or a saturated generator) is counted instead
+    of silently omitted; ``service_time`` is the uncorrected view.
+    """
+
+    def __init__(
+        self,
+        mode: str,
+        proxy_host: str,
+        proxy_port: int,
+        origin_host: str,
+        origin_port: int,
+        rate: float,
+        duration: float,
+        concurrency: int = 10000,
+        ramp: float = 0,
+        arrival: str = "poisson",
+        payload: int = 64,
+        hold: float = 0,
+        timeout: float = 30,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+    ):
+        assert mode in MODES
+        self.mode = mode
+        self.proxy_host = proxy_host
+        self.proxy_port = proxy_port
+        self.origin_host = origin_host
+        self.origin_port = origin_port
+        self.rate = rate
+        self.duration = duration
+        self.concurrency = concurrency
+        self.ramp = ramp
+        self.arrival = arrival
+        self.payload = b"x" * payload
+        self.hold = hold
+        self.timeout = timeout
+        self.username = username
+        self.password = password
+
+        self.connect_latency = Histogram()
+        self.latency = Histogram()
+        self.service_time = Histogram()
+        self.stats: Counter = Counter()
+        self.in_flight = 0
+        self.elapsed = 0.0
+
+    def interval(self, elapsed: float) -> float:
+        rate = self.rate
+        if self.ramp and elapsed < self.ramp:
+            rate *= max(elapsed / self.ramp, 0.01)
+        if self.arrival == "poisson":
+            return random.expovariate(rate)
+        return 1 / rate
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(self.concurrency)
+        tasks = set()
+        start = due = loop.time()
+        while due < start + self.duration:
+            delay = due - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            task = loop.create_task(self.transaction(due, slots))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            due += self.interval(due - start)
+        if tasks:
+            await asyncio.wait(tasks)
+        self.elapsed = loop.time() - start
+
+    async def transaction(self, due: float, slots: asyncio.Semaphore):
+        loop = asyncio.get_running_loop()
+        async with slots:
+            started = loop.time()
+            self.in_flight += 1
+            self.stats["max_in_flight"] = max(
+                self.stats["max_in_flight"], self.in_flight
+            )
+            writer = None
+            try:
+                async with async_timeout.timeout(self.timeout):
+                    reader, writer = await self.open()
+                    self.connect_latency.record(microseconds(loop.time() - due))
+                    await self.exchange(reader, writer)
+            except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+                self.stats[f"error {type(e).__name__}"] += 1
+            else:
+                done = loop.time()
+                self.latency.record(microseconds(done - due))
+                self.service_time.record(microseconds(done - started))
+                self.stats["ok"] += 1
+                if self.hold:
+                    await asyncio.sleep(self.hold)
+            finally:
+                self.in_flight -= 1
+                if writer:
+                    writer.close()
+
+    async def open(self) -> StreamPair:
+        if self.mode == "socks5":
+            return await open_socks5_connection(
+                self.proxy_host,
+                self.proxy_port,
+                self.origin_host,
+                self.origin_port,
+                self.username,
+                self.password,
+            )
+        if self.mode == "http-connect":
+            return await open_http_connection(
+                self.proxy_host,
+                self.proxy_port,
+                self.origin_host,
+                self.origin_port,
+                self.username,
+                self.password,
+            )
+        return await asyncio.open_connection(self.proxy_host, self.proxy_port)
+
+    async def exchange(self, reader, writer):
+        if self.mode == "http-get":
+            url = f"http://{self.origin_host}:{self.origin_port}/"
+            status, _ = await http_get(
+                reader, writer, url, self.username, self.password
+            )
+            if status != 200:
+                raise ConnectionError(f"status {status}")
+            return
+
+        writer.write(self.payload)
+        await writer.drain()
+        await reader.readexactly(len(self.payload))
+
+    def report(self) -> str:
+        lines = [
+            f"{self.mode}: {self.stats['ok']} ok in {self.elapsed:.1f}s "
+            f"({self.stats['ok'] / max(self.elapsed, 1e-9):.1f}/s, "
+            f"target {self.rate:g}/s), "
+            f"max in flight {self.stats['max_in_flight']}"
+        ]
+        for name, count in sorted(self.stats.items()):
+            if name.startswith("error "):
+                lines.append(f"  {name}: {count}")
+
+        header = "".join(f"{'p' + format(p, 'g'):>9}" for p in PERCENTILES)
+        lines.append(f"{'ms':10}{header}{'max':>9}{'mean':>9}")
+        for name, histogram in (
+            ("connect", self.connect_latency),
+            ("latency", self.latency),
+            ("service", self.service_time),
+        ):
+            values = [histogram.percentile(p) for p in PERCENTILES]
+            values += [histogram.max, int(histogram.mean)]
+            lines.append(f"{name:10}" + "".join(f"{v / 1000:>9.2f}" for v in values))
+        return "\n".join(lines)
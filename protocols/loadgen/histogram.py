@@ -0,0 +1,80 @@
+import math
+from typing import List
+
+# values below 2**SUB_BITS are counted exactly, larger ones in buckets no
+# wider than 1/2**(SUB_BITS - 1) of their value
+SUB_BITS = 8
+SUB_BUCKETS = 1 << (SUB_BITS - 1)
+MAX_SHIFT = 48
+
+
+def bucket_index(value: int) -> int:
+    shift = max(0, value.bit_length() - SUB_BITS)
+    return shift * SUB_BUCKETS + (value >> shift)
+
+
+def bucket_range(index: int) -> range:
+    shift = max(0, index // SUB_BUCKETS - 1)
+    low = (index - shift * SUB_BUCKETS) << shift
+    return range(low, low + (1 << shift))
+
+
+class Histogram:
+    """
+    Log-linear histogram of integer values (microseconds in the load
+    generator), in the spirit of HdrHistogram.
+    """
+
+    def __init__(self):
+        self.counts: List[int] = [0] * ((MAX_SHIFT + 2) * SUB_BUCKETS)
+        self.count = 0
+        self.total = 0
+        self.min = 0
+        self.max = 0
+
+    def record(self, value: int):
+        value = max(0, value)
+        self.counts[bucket_index(value)] += 1
+        self.min = value if not self.count else min(self.min, value)
+        self.max = max(self.max, value)
+        self.count += 1
+        self.total += value
+
+    def record_corrected(self, value: int, expected_interval: int):
+        """
+        Record a value measured by a closed-loop client that sends every
+        ``expected_interval``, adding the samples a stall kept it from
+        taking (coordinated omission).
+        """
+        self.record(value)
+        if expected_interval <= 0:
+            return
+        missing = value - expected_interval
+        while missing >= expected_interval:
+            self.record(missing)
+            missing -= expected_interval
+
+    def merge(self, other: "Histogram"):
+        if not other.count:
+            return
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.min = other.min if not self.count else min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.count += other.count
+        self.total += other.total
+
+    @property
+    def mean(self) -> float:
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, percentile: float) -> int:
+        if not self.count:
+            return 0
+        rank = max(1, math.ceil(percentile / 100 * self.count))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bucket_range(index)[-1], self.max)
+        return self.max
@@ -0,0 +1,36 @@
+import asyncio
+
+HTTP_METHODS = (b"GET ", b"HEAD ", b"POST ", b"PUT ")
+
+
+class Origin(asyncio.Protocol):
+    """
+    Built-in origin for the load generator: a connection that starts with an
+    HTTP request line gets ``body_size`` bytes back for every request, any
+    other connection is echoed.
+    """
+
+    def __init__(self, body_size: int = 1024):
+        self.body_size = body_size
+        self.transport: asyncio.Transport
+        self.http = None
+        self.buffer = b""
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        if self.http is None:
+            self.http = data.startswith(HTTP_METHODS)
+        if not self.http:
+            self.transport.write(data)
+            return
+
+        self.buffer += data
+        while b"\r\n\r\n" in self.buffer:
+            head, self.buffer = self.buffer.split(b"\r\n\r\n", 1)
+            body = b"" if head.startswith(b"HEAD ") else b"x" * self.body_size
+            self.transport.write(
+                b"HTTP/1.1 200 OK\r\nContent-Length: %d\r\n\r\n%s"
+                % (self.body_size, body)
+            )
@@ -0,0 +1,55 @@
+import asyncio
+import functools
+import resource
+from typing import Callable, Dict, Optional
+
+from protocols.http_proxy.server import HttpProxyServerProtocol
+from protocols.reverse_proxy.server import ReverseProxyProtocol
+from protocols.socket_options import SocketOptions
+from protocols.socks5_server.server import Socks5ProxyServerProtocol
+
+# --socket-options, for the proxy's listener and upstream dials
+SOCKET_PROFILES: Dict[str, Optional[SocketOptions]] = {
+    "none": None,
+    "nagle": SocketOptions(nodelay=False, backlog=4096),
+    "latency": SocketOptions(
+        nodelay=True, quickack=True, notsent_lowat=16384, fastopen=256, backlog=4096
+    ),
+    "throughput": SocketOptions(
+        rcvbuf=4 * 1024 * 1024, sndbuf=4 * 1024 * 1024, backlog=4096
+    ),
+    "keepalive": SocketOptions(keepalive=(60, 10, 6), backlog=4096),
+}
+
+
+def raise_fd_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def serve_proxy(
+    mode: str, origin_host: str, origin_port: int, conn, socket_profile: str = "none"
+):
+    options = SOCKET_PROFILES[socket_profile]
+    factory: Callable[[], asyncio.BaseProtocol]
+    if mode == "socks5":
+        factory = functools.partial(Socks5ProxyServerProtocol, socket_options=options)
+    elif mode == "reverse":
+        factory = functools.partial(
+            ReverseProxyProtocol, origin_host, origin_port, socket_options=options
+        )
+    else:
+        factory = functools.partial(HttpProxyServerProtocol, socket_options=options)
+
+    async def run():
+        if options:
+            server = await options.create_server(factory, "127.0.0.1", 0)
+        else:
+            server = await asyncio.get_running_loop().create_server(
+                factory, "127.0.0.1", 0, backlog=4096
+            )
+        conn.send(server.sockets[0].getsockname()[1])
+        await server.serve_forever()
+
+    raise_fd_limit()
+    asyncio.run(run())
@@ -0,0 +1,116 @@
+import asyncio
+import unittest
+from unittest import mock
+
+from protocols.dialer import DestinationError
+from protocols.http_proxy.server import HttpProxyServerProtocol
+from protocols.loadgen.generator import LoadGenerator
+from protocols.loadgen.histogram import Histogram, bucket_index, bucket_range
+from protocols.loadgen.origin import Origin
+from protocols.socks5_server.client import socks5_handshake
+from protocols.socks5_server.server import Socks5ProxyServerProtocol
+
+
+class TestHistogram(unittest.TestCase):
+    def test_buckets(self):
+        for value in [0, 1, 255, 256, 257, 1000, 123456, 2**40 + 12345]:
+            bucket = bucket_range(bucket_index(value))
+            self.assertIn(value, bucket)
+            self.assertLessEqual(len(bucket), max(1, value / 128))
+
+    def test_percentiles(self):
+        histogram = Histogram()
+        for value in range(1, 10001):
+            histogram.record(value)
+        self.assertEqual(10000, histogram.count)
+        self.assertAlmostEqual(5000, histogram.percentile(50), delta=50)
+        self.assertAlmostEqual(9900, histogram.percentile(99), delta=99)
+        self.assertEqual(10000, histogram.percentile(100))
+        self.assertEqual(1, histogram.min)
+
+    def test_coordinated_omission(self):
+        histogram = Histogram()
+        for _ in range(99):
+            histogram.record_corrected(1000, 1000)
+        # one 100ms stall hides 99 samples a closed-loop client never took
+        histogram.record_corrected(100000, 1000)
+        self.assertEqual(199, histogram.count)
+        self.assertGreater(histogram.percentile(90), 50000)
+
+
+class TestLoadGenerator(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_generator(self, mode, factory, **kwargs) -> LoadGenerator:
+        async def test():
+            origin = await self.loop.create_server(Origin, "127.0.0.1", 0)
+            proxy = await self.loop.create_server(factory, "127.0.0.1", 0)
+            generator = LoadGenerator(
+                mode,
+                "127.0.0.1",
+                proxy.sockets[0].getsockname()[1],
+                "127.0.0.1",
+                origin.sockets[0].getsockname()[1],
+                rate=200,
+                duration=0.25,
+                **kwargs,
+            )
+            await generator.run()
+            # let both proxy legs see the last close
+            await asyncio.sleep(0.1)
+            origin.close()
+            proxy.close()
+            return generator
+
+        return self.loop.run_until_complete(test())
+
+    def test_socks5(self):
+        generator = self.run_generator("socks5", Socks5ProxyServerProtocol)
+        self.assertGreater(generator.stats["ok"], 10)
+        self.assertEqual(generator.stats["ok"], generator.latency.count)
+        self.assertEqual(["max_in_flight", "ok"], sorted(generator.stats))
+
+    def test_http(self):
+        for mode in ["http-connect", "http-get"]:
+            generator = self.run_generator(
+                mode, HttpProxyServerProtocol, arrival="uniform"
+            )
+            self.assertEqual(["max_in_flight", "ok"], sorted(generator.stats))
+            self.assertGreaterEqual(generator.stats["ok"], 49)
+
+    def test_socks5_password_handshake(self):
+        async def test():
+            reader = asyncio.StreamReader()
+            reader.feed_data(b"\x05\x02" + b"\x01\x00" + b"\x05\x00\x00")
+            reader.feed_data(b"\x03\x09localhost\x1f\x90")
+            writer = mock.Mock(asyncio.StreamWriter)
+
+            bound = await socks5_handshake(
+                reader, writer, "example.com", 80, "user", "secret"
+            )
+            self.assertEqual(("localhost", 8080), bound)
+            # pipelined, a single write
+            self.assertEqual(
+                [
+                    b"\x05\x01\x02"
+                    + b"\x01\x04user\x06secret"
+                    + b"\x05\x01\x00\x03\x0bexample.com\x00\x50",
+                ],
+                [call.args[0] for call in writer.write.call_args_list],
+            )
+
+            reader = asyncio.StreamReader()
+            reader.feed_data(b"\x05\x00" + b"\x05\x05\x00\x01\x00\x00\x00\x00\x00\x00")
+            with self.assertRaises(DestinationError):
+                await socks5_handshake(reader, writer, "127.0.0.1", 80)
+
+        self.loop.run_until_complete(test())
+
+
+if __name__ == "__main__":
+    unittest.main()
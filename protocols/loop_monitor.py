@@ -0,0 +1,134 @@
+import asyncio
+import sys
+import threading
+import time
+import traceback
+from collections import Counter, deque
+from types import FrameType
+from typing import Deque, List, NamedTuple, Optional
+
+from protocols.loadgen.histogram import Histogram
+from protocols.tracing import Phase
+
+
+class Stall(NamedTuple):
+    time: float
+    # seconds since the heartbeat was due, when sampled
+    lag: float
+    # the protocol class and method on the stack, and the connection's last
+    # traced phase if it is traced
+    protocol: str
+    method: str
+    phase: str
+    # the innermost frame, e.g. an on_* hook
+    function: str
+    stack: List[str]
+
+
+class LoopMonitor:
+    """
+    Event loop health. A heartbeat every ``interval`` seconds records how
+    late it ran, in microseconds, in ``histogram``: one timer per interval,
+    whatever the number of connections.
+
+    A watchdog thread catches the loop while it is stuck: once a heartbeat
+    is ``threshold`` seconds overdue, it samples the loop thread's stack and
+    keeps the last ``max_samples`` stalls in ``samples``, attributed to the
+    protocol class and method on the stack and the connection's phase.
+    """
+
+    def __init__(
+        self,
+        interval: float = 0.05,
+        threshold: float = 0.1,
+        max_samples: int = 64,
+        stack_depth: int = 16,
+    ):
+        self.interval = interval
+        self.threshold = threshold
+        self.stack_depth = stack_depth
+        self.histogram = Histogram()
+        self.samples: Deque[Stall] = deque(maxlen=max_samples)
+        self.stats: Counter = Counter()
+
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.loop_thread = 0
+        self.expected = 0.0
+        # monotonic time of the last heartbeat, and whether the stall it
+        # has been waiting for was sampled already
+        self.last_beat = 0.0
+        self.sampled = False
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.stopped = threading.Event()
+
+    def start(self):
+        """
+        Monitors the running loop.
+        """
+        self.loop = loop = asyncio.get_running_loop()
+        self.loop_thread = threading.get_ident()
+        self.last_beat = time.monotonic()
+        self.expected = loop.time() + self.interval
+        self.timer = loop.call_at(self.expected, self.beat)
+        threading.Thread(target=self.watch, name="loop-monitor", daemon=True).start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.timer:
+            self.timer.cancel()
+
+    def beat(self):
+        loop = self.loop
+        assert loop is not None
+        now = loop.time()
+        lag = now - self.expected
+        self.histogram.record(int(lag * 1e6))
+        if lag >= self.threshold:
+            self.stats["lagged"] += 1
+        self.last_beat = time.monotonic()
+        self.sampled = False
+        self.expected = now + self.interval
+        self.timer = loop.call_at(self.expected, self.beat)
+
+    def watch(self):
+        while not self.stopped.wait(self.threshold / 2):
+            lag = time.monotonic() - self.last_beat - self.interval
+            if self.sampled or lag < self.threshold:
+                continue
+            # one sample per stall
+            self.sampled = True
+            frame = sys._current_frames().get(self.loop_thread)
+            if frame is not None:
+                self.samples.append(self.attribute(frame, lag))
+                self.stats["stalls"] += 1
+
+    def attribute(self, frame: FrameType, lag: float) -> Stall:
+        stack = traceback.format_stack(frame, limit=self.stack_depth)
+        function = (
+            f"{frame.f_code.co_name} ({frame.f_code.co_filename}:{frame.f_lineno})"
+        )
+        protocol = method = phase = ""
+        outer: Optional[FrameType] = frame
+        while outer is not None:
+            owner = outer.f_locals.get("self")
+            if isinstance(owner, asyncio.BaseProtocol):
+                protocol = type(owner).__name__
+                method = outer.f_code.co_name
+                trace = getattr(owner, "trace", None)
+                if trace:
+                    phase = max(Phase, key=lambda p: trace.marks[p]).name.lower()
+                break
+            outer = outer.f_back
+        return Stall(time.time(), lag, protocol, method, phase, function, stack)
+
+    def metrics(self) -> dict:
+        histogram = self.histogram
+        return {
+            "beats": histogram.count,
+            "lag_mean_us": round(histogram.mean),
+            "lag_p50_us": histogram.percentile(50),
+            "lag_p99_us": histogram.percentile(99),
+            "lag_max_us": histogram.max,
+            "lagged": self.stats["lagged"],
+            "stalls": self.stats["stalls"],
+        }
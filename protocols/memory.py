@@ -0,0 +1,89 @@
+import asyncio
+from collections import Counter
+from typing import Optional, Protocol, Set
+
+
+class Heavy(Protocol):
+    def memory_usage(self) -> int:
+        ...
+
+    def abort(self):
+        ...
+
+
+class MemoryGovernor:
+    """
+    Watches the buffered bytes of the registered connections every
+    ``interval`` seconds. Over ``high_watermark`` in total, the heaviest are
+    aborted until the total is under ``low_watermark`` again.
+    """
+
+    def __init__(
+        self,
+        high_watermark: int = 512 * 1024 * 1024,
+        low_watermark: Optional[int] = None,
+        interval: float = 0.5,
+    ):
+        self.high_watermark = high_watermark
+        self.low_watermark = (
+            low_watermark if low_watermark is not None else high_watermark * 4 // 5
+        )
+        self.interval = interval
+        self.connections: Set[Heavy] = set()
+        self.stats: Counter = Counter()
+        self.timer: Optional[asyncio.TimerHandle] = None
+
+    def register(self, connection: Heavy):
+        self.connections.add(connection)
+        if self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(
+                self.interval, self.sweep
+            )
+
+    def unregister(self, connection: Heavy):
+        self.connections.discard(connection)
+
+    def usage(self) -> int:
+        return sum(connection.memory_usage() for connection in self.connections)
+
+    def sweep(self):
+        self.timer = None
+        usages = [(c.memory_usage(), c) for c in self.connections]
+        total = sum(usage for usage, _ in usages)
+        if total > self.high_watermark:
+            usages.sort(key=lambda item: item[0], reverse=True)
+            for usage, connection in usages:
+                if total <= self.low_watermark:
+                    break
+                connection.abort()
+                self.unregister(connection)
+                total -= usage
+                self.stats["shed"] += 1
+                self.stats["shed_bytes"] += usage
+        if self.connections:
+            self.timer = asyncio.get_running_loop().call_later(
+                self.interval, self.sweep
+            )
+
+
+class MemoryBudget:
+    """
+    Per connection limits. ``header_size`` is the StreamReader limit: a
+    longer request header fails as soon as that much is buffered, and the
+    read buffer pauses the socket at twice that. ``write_buffer`` is the
+    high watermark of each relay direction, past which the other side stops
+    being read. Relays are registered with the governor, if any.
+    """
+
+    def __init__(
+        self,
+        header_size: int = 16 * 1024,
+        write_buffer: int = 256 * 1024,
+        governor: Optional[MemoryGovernor] = None,
+    ):
+        self.header_size = header_size
+        self.write_buffer = write_buffer
+        self.governor = governor
+
+    def limit(self, transport: asyncio.WriteTransport):
+        transport.set_write_buffer_limits(self.write_buffer, self.write_buffer // 4)
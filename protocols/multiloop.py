@@ -0,0 +1,151 @@
+import asyncio
+import itertools
+import socket
+import threading
+from typing import Callable, List, Optional
+
+from protocols.socket_options import SocketOptions
+
+ProtocolFactory = Callable[[], asyncio.BaseProtocol]
+
+
+class MultiLoopServer:
+    """
+    One process serving on ``loops`` event loops in as many threads, so the
+    caches of one server (``HttpCache``, ``BackendTLS`` sessions,
+    ``ParentProxies`` scores, the ``AccessLog`` queue) are shared instead of
+    duplicated per process. Worth it on free-threaded CPython 3.13+; with
+    the GIL only the system calls overlap.
+
+    ``make_factory`` runs once in every loop thread and returns that loop's
+    protocol factory. Objects that keep timers, ``MemoryGovernor`` and
+    ``Deadlines`` with an idle limit, belong to one loop and should be
+    created there; the rest can be shared.
+
+    Each loop listens on its own ``SO_REUSEPORT`` socket and the kernel
+    spreads the connections, or with ``acceptor=True`` one thread accepts
+    on a single socket and hands the connections out in turn.
+    """
+
+    def __init__(
+        self,
+        make_factory: Callable[[], ProtocolFactory],
+        host: str = "127.0.0.1",
+        port: int = 0,
+        loops: int = 4,
+        acceptor: bool = False,
+        socket_options: Optional[SocketOptions] = None,
+    ):
+        self.make_factory = make_factory
+        self.host = host
+        self.port = port
+        self.acceptor = acceptor
+        self.socket_options = socket_options
+        self.backlog = socket_options.backlog if socket_options else 100
+        self.loops: List[asyncio.AbstractEventLoop] = [
+            asyncio.new_event_loop() for _ in range(loops)
+        ]
+        self.factories: List[Optional[ProtocolFactory]] = [None] * loops
+        self.threads: List[threading.Thread] = []
+        self.listener: Optional[socket.socket] = None
+
+    def listen(self, reuse_port: bool) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if self.socket_options:
+            self.socket_options.apply_listener(sock)
+        sock.bind((self.host, self.port))
+        # with port 0 the first listener picks the port the others share
+        self.port = sock.getsockname()[1]
+        sock.listen(self.backlog)
+        return sock
+
+    def start(self):
+        """
+        Starts the loop threads, and the acceptor thread if any, once every
+        loop is listening or ready to take connections.
+        """
+        ready = threading.Barrier(len(self.loops) + 1)
+        for index in range(len(self.loops)):
+            sock = None if self.acceptor else self.listen(reuse_port=True)
+            thread = threading.Thread(
+                target=self.run,
+                args=(index, sock, ready),
+                name=f"loop-{index}",
+                daemon=True,
+            )
+            thread.start()
+            self.threads.append(thread)
+        ready.wait()
+
+        if self.acceptor:
+            self.listener = self.listen(reuse_port=False)
+            thread = threading.Thread(target=self.accept, name="acceptor", daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def run(self, index: int, sock: Optional[socket.socket], ready: threading.Barrier):
+        loop = self.loops[index]
+        asyncio.set_event_loop(loop)
+        try:
+            factory = self.factories[index] = self.make_factory()
+            server = None
+            if sock:
+                server = loop.run_until_complete(
+                    loop.create_server(factory, sock=sock, backlog=self.backlog)
+                )
+        except BaseException:
+            # start() raises BrokenBarrierError rather than wait forever
+            ready.abort()
+            raise
+        ready.wait()
+        try:
+            loop.run_forever()
+        finally:
+            # open connections are dropped with the loop, like on exit
+            if server:
+                server.close()
+            loop.close()
+
+    def accept(self):
+        listener = self.listener
+        assert listener is not None
+        for loop, factory in itertools.cycle(zip(self.loops, self.factories)):
+            assert factory is not None
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                # closed by stop()
+                return
+            conn.setblocking(False)
+            loop.call_soon_threadsafe(adopt, loop, factory, conn)
+
+    def stop(self):
+        if self.listener:
+            # wakes the blocking accept() up, close() alone does not
+            self.listener.shutdown(socket.SHUT_RDWR)
+            self.listener.close()
+        for loop in self.loops:
+            loop.call_soon_threadsafe(loop.stop)
+        for thread in self.threads:
+            thread.join()
+
+    def serve_forever(self):
+        if not self.threads:
+            self.start()
+        for thread in self.threads:
+            thread.join()
+
+
+def adopt(
+    loop: asyncio.AbstractEventLoop, factory: ProtocolFactory, conn: socket.socket
+):
+    async def connect():
+        try:
+            await loop.connect_accepted_socket(factory, conn)
+        except OSError:
+            conn.close()
+
+    loop.create_task(connect())
@@ -0,0 +1,77 @@
+import asyncio
+from typing import List, Optional
+
+from protocols.forward import StreamPair
+from protocols.mux.server import attach_stream
+from protocols.mux.session import MuxSession
+
+
+class MuxClient:
+    """
+    The edge end of a mux link. ``open_connection`` is a ``Dialer``: pass it
+    to a proxy protocol and every upstream connection becomes a stream over a
+    few persistent connections to a ``MuxServerProtocol``::
+
+        mux = MuxClient("core.example", 7000)
+        loop.create_server(
+            lambda: Socks5ProxyServerProtocol(dialer=mux.open_connection), ...
+        )
+
+    With ``compression`` ("zlib" or "zstd") the data we send over the link is
+    compressed per stream; the core picks its own setting for the other way.
+    """
+
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        connections: int = 2,
+        ping_interval: Optional[float] = 30,
+        compression: Optional[str] = None,
+        compression_level: Optional[int] = None,
+    ):
+        self.host = host
+        self.port = port
+        self.connections = connections
+        self.ping_interval = ping_interval
+        self.compression = compression
+        self.compression_level = compression_level
+        self.sessions: List[MuxSession] = []
+        # created in the running loop, a lock binds to one on Python 3.9
+        self.lock: Optional[asyncio.Lock] = None
+
+    async def open_connection(self, host: str, port: int) -> StreamPair:
+        session = await self.get_session()
+        stream = await session.open_stream(host, port)
+        return attach_stream(stream)
+
+    async def get_session(self) -> MuxSession:
+        if len(self.alive_sessions()) < self.connections:
+            if self.lock is None:
+                self.lock = asyncio.Lock()
+            async with self.lock:
+                if len(self.alive_sessions()) < self.connections:
+                    session = await self.connect()
+                    self.sessions = [*self.alive_sessions(), session]
+        return min(self.alive_sessions(), key=lambda s: len(s.streams))
+
+    def alive_sessions(self) -> List[MuxSession]:
+        return [s for s in self.sessions if not s.closed]
+
+    async def connect(self) -> MuxSession:
+        loop = asyncio.get_running_loop()
+        _, session = await loop.create_connection(
+            lambda: MuxSession(
+                ping_interval=self.ping_interval,
+                compression=self.compression,
+                compression_level=self.compression_level,
+            ),
+            self.host,
+            self.port,
+        )
+        return session
+
+    def close(self):
+        for session in self.sessions:
+            session.transport.close()
+        self.sessions = []
@@ -0,0 +1,137 @@
+import math
+import zlib
+from collections import Counter
+from enum import Enum
+from typing import Optional, Union
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None  # type:ignore
+
+from protocols.mux.frames import FLAG_ZLIB, FLAG_ZSTD, MAX_PAYLOAD
+
+
+class Codec(Enum):
+    ZLIB = FLAG_ZLIB
+    ZSTD = FLAG_ZSTD
+
+
+CODEC_FLAGS = FLAG_ZLIB | FLAG_ZSTD
+
+# log2 of the history kept per stream and direction; 15 is zlib's maximum
+DEFAULT_WINDOW_BITS = 15
+
+
+class ZlibCompressor:
+    def __init__(self, level: int, window_bits: int):
+        # raw deflate, the frame already says which codec produced it
+        self.compressor = zlib.compressobj(
+            level, zlib.DEFLATED, -window_bits, memLevel=min(9, window_bits - 6)
+        )
+
+    def compress(self, data) -> bytes:
+        # a sync flush per frame lets the peer decode it right away
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class ZstdCompressor:
+    def __init__(self, level: int, window_bits: int):
+        params = zstandard.ZstdCompressionParameters.from_level(
+            level, window_log=max(window_bits, zstandard.WINDOWLOG_MIN)
+        )
+        self.compressor = zstandard.ZstdCompressor(
+            compression_params=params
+        ).compressobj()
+
+    def compress(self, data) -> bytes:
+        return self.compressor.compress(data) + self.compressor.flush(
+            zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        )
+
+
+Compressor = Union[ZlibCompressor, ZstdCompressor]
+
+
+class ZlibDecompressor:
+    def __init__(self):
+        self.decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+
+    def decompress(self, data) -> bytes:
+        # a frame never carries more than MAX_PAYLOAD bytes before compression
+        try:
+            data = self.decompressor.decompress(data, MAX_PAYLOAD)
+        except zlib.error as e:
+            raise ValueError(f"bad zlib frame: {e}")
+        if self.decompressor.unconsumed_tail:
+            raise ValueError("compressed frame larger than MAX_PAYLOAD")
+        return data
+
+
+class ZstdDecompressor:
+    # zstd cannot stop at an output size, but a block takes at least 4 bytes
+    # and inflates to at most 128 KiB, so feeding the frame in slices bounds
+    # what is produced before the size is checked
+    slice_size = 256
+
+    def __init__(self):
+        self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+
+    def decompress(self, data) -> bytes:
+        view = memoryview(data)
+        chunks = []
+        size = 0
+        for offset in range(0, len(view), self.slice_size):
+            try:
+                chunk = self.decompressor.decompress(
+                    view[offset : offset + self.slice_size]
+                )
+            except zstandard.ZstdError as e:
+                raise ValueError(f"bad zstd frame: {e}")
+            size += len(chunk)
+            if size > MAX_PAYLOAD:
+                raise ValueError("compressed frame larger than MAX_PAYLOAD")
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+
+Decompressor = Union[ZlibDecompressor, ZstdDecompressor]
+
+
+def parse_codec(name: Optional[str]) -> Optional[Codec]:
+    if name is None:
+        return None
+    codec = Codec[name.upper()]
+    if codec == Codec.ZSTD and zstandard is None:
+        raise RuntimeError("zstd compression requires the zstandard package")
+    return codec
+
+
+def create_compressor(codec: Codec, level: int, window_bits: int) -> Compressor:
+    if codec == Codec.ZSTD:
+        return ZstdCompressor(level, window_bits)
+    return ZlibCompressor(level, window_bits)
+
+
+def create_decompressor(flags: int) -> Decompressor:
+    if flags & FLAG_ZSTD:
+        if zstandard is None:
+            raise ValueError("received zstd data without the zstandard package")
+        return ZstdDecompressor()
+    return ZlibDecompressor()
+
+
+def looks_incompressible(sample) -> bool:
+    """
+    Guess from the first bytes of a stream whether compressing it is a waste
+    of CPU: TLS records, or anything whose byte entropy is close to random.
+    """
+    if len(sample) >= 3 and 0x14 <= sample[0] <= 0x17 and sample[1] == 0x03:
+        return True
+
+    sample = sample[:4096]
+    n = len(sample)
+    if n < 64:
+        return False
+    entropy = -sum(c / n * math.log2(c / n) for c in Counter(sample).values())
+    return entropy > min(7.0, math.log2(n) - 1)
@@ -0,0 +1,61 @@
+import struct
+from enum import Enum
+from typing import Tuple
+
+# +------+-------+-----------+--------+---------+
+# | TYPE | FLAGS | STREAM ID | LENGTH | PAYLOAD |
+# +------+-------+-----------+--------+---------+
+# |  1   |   1   |     4     |   4    | LENGTH  |
+# +------+-------+-----------+--------+---------+
+HEADER = struct.Struct("!BBII")
+
+MAX_PAYLOAD = 16 * 1024
+# kept free in compressed DATA frames for the worst case expansion of either
+# codec, so that the frame still fits in MAX_PAYLOAD
+COMPRESSION_OVERHEAD = 256
+INITIAL_WINDOW = 256 * 1024
+
+FLAG_ACK = 0x01
+# DATA payload codec, see protocols.mux.compression
+FLAG_ZLIB = 0x02
+FLAG_ZSTD = 0x04
+
+
+class FrameType(Enum):
+    # open a stream to the address in the payload; answered with SYN+ACK or RST
+    SYN = 0x00
+    DATA = 0x01
+    WINDOW_UPDATE = 0x02
+    # the sender will not write to the stream anymore
+    FIN = 0x03
+    RST = 0x04
+    # stream id 0, 8 opaque bytes echoed back with the ACK flag
+    PING = 0x05
+
+
+class ResetCode(Enum):
+    CANCEL = 0x00
+    CONNECT_FAILED = 0x01
+    NOT_ALLOWED = 0x02
+    PROTOCOL_ERROR = 0x03
+
+
+def pack_frame(frame_type: FrameType, stream_id: int, payload=b"", flags=0) -> bytes:
+    return HEADER.pack(frame_type.value, flags, stream_id, len(payload)) + payload
+
+
+def pack_address(host: str, port: int) -> bytes:
+    return struct.pack("!H", port) + host.encode()
+
+
+def unpack_address(payload: bytes) -> Tuple[str, int]:
+    (port,) = struct.unpack_from("!H", payload)
+    return payload[2:].decode(), port
+
+
+def pack_window_update(increment: int) -> bytes:
+    return struct.pack("!I", increment)
+
+
+def unpack_window_update(payload: bytes) -> int:
+    return struct.unpack("!I", payload)[0]
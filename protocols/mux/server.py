@@ -0,0 +1,109 @@
+import asyncio
+import logging
+from asyncio import StreamReader, StreamWriter
+from typing import Optional, Callable
+
+from protocols.dialer import Dialer, open_connection
+from protocols.forward import relay_stream
+from protocols.mux.frames import ResetCode, FLAG_ACK, FrameType
+from protocols.mux.session import MuxSession, MuxStream
+
+logger = logging.getLogger(__name__)
+
+
+class MuxServerProtocol(MuxSession):
+    """
+    The core end of a mux link: every stream opened by the edge is dialed
+    here and relayed like any other proxied connection.
+    """
+
+    def __init__(
+        self,
+        on_accept: Optional[Callable[[str, int], bool]] = None,
+        on_connect: Optional[Callable[[str, int], bool]] = None,
+        dialer: Optional[Dialer] = None,
+        ping_interval: Optional[float] = 30,
+        compression: Optional[str] = None,
+        compression_level: Optional[int] = None,
+    ):
+        super().__init__(
+            ping_interval=ping_interval,
+            compression=compression,
+            compression_level=compression_level,
+        )
+        self.on_accept = on_accept
+        self.on_connect = on_connect
+        self.dialer = dialer
+
+    def connection_made(self, transport) -> None:
+        super().connection_made(transport)
+        addr = transport.get_extra_info("peername")
+        if self.on_accept:
+            if not self.on_accept(addr[0], addr[1]):
+                transport.close()
+
+    def stream_requested(self, stream_id: int, host: str, port: int):
+        if stream_id in self.streams:
+            self.send_reset(stream_id, ResetCode.PROTOCOL_ERROR)
+            return
+        if self.on_connect:
+            if not self.on_connect(host, port):
+                self.send_reset(stream_id, ResetCode.NOT_ALLOWED)
+                return
+
+        stream = self.create_stream(stream_id)
+        self.spawn(self.handler(stream, host, port))
+
+    async def handler(self, stream: MuxStream, host: str, port: int):
+        try:
+            remote_stream = await open_connection(host, port, self.dialer)
+        except (OSError, ValueError, asyncio.TimeoutError) as e:
+            # ValueError for a host the peer sent that cannot be resolved at
+            # all, e.g. with a NUL or an empty label
+            logger.debug(
+                "mux stream %d to %s:%d failed: %r", stream.stream_id, host, port, e
+            )
+            self.send_reset(stream.stream_id, ResetCode.CONNECT_FAILED)
+            stream.connection_lost(None)
+            return
+
+        if stream.closed:
+            # the edge gave up while we were dialing
+            remote_stream[1].close()
+            return
+
+        reader, writer = attach_stream(stream)
+        self.send_frame(FrameType.SYN, stream.stream_id, flags=FLAG_ACK)
+        await relay_stream((reader, writer), remote_stream)
+
+
+def attach_stream(stream: MuxStream) -> tuple[StreamReader, StreamWriter]:
+    loop = asyncio.get_running_loop()
+    reader = StreamReader(loop=loop)
+    protocol = asyncio.StreamReaderProtocol(reader, loop=loop)
+    stream.set_protocol(protocol)
+    protocol.connection_made(stream)
+    writer = StreamWriter(stream, protocol, reader, loop)
+    stream.attached()
+    return reader, writer
+
+
+async def main():
+    host, port = "127.0.0.1", 7000
+    loop = asyncio.get_event_loop()
+    server = await loop.create_server(
+        lambda: MuxServerProtocol(on_connect=lambda a, p: True),
+        host,
+        port,
+    )
+
+    logger.info(f"Serving on {host}:{port}")
+
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    logger.setLevel(logging.DEBUG)
+    asyncio.run(main())
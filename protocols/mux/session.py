@@ -0,0 +1,539 @@
+import asyncio
+import logging
+import os
+import struct
+from collections import Counter
+from typing import Coroutine, Dict, Optional, Set, Union
+
+from protocols.mux.compression import (
+    CODEC_FLAGS,
+    DEFAULT_WINDOW_BITS,
+    Codec,
+    Compressor,
+    Decompressor,
+    parse_codec,
+    create_compressor,
+    create_decompressor,
+    looks_incompressible,
+)
+from protocols.mux.frames import (
+    COMPRESSION_OVERHEAD,
+    HEADER,
+    MAX_PAYLOAD,
+    INITIAL_WINDOW,
+    FLAG_ACK,
+    FrameType,
+    ResetCode,
+    pack_frame,
+    pack_address,
+    unpack_address,
+    pack_window_update,
+    unpack_window_update,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class MuxStream(asyncio.Transport):
+    """
+    One multiplexed stream, exposed as a regular transport so that the usual
+    ``StreamReader``/``StreamWriter`` pair (and ``relay_stream``) work on it.
+
+    Sending is limited by the window granted by the peer; the peer only grants
+    more once our protocol has consumed the data, which is how a full
+    ``StreamReader`` on one end pauses the writer on the other end.
+
+    What arrives before a protocol is attached, like a greeting right
+    behind the SYN+ACK, is kept until ``attached`` delivers it.
+    """
+
+    write_buffer_high = 64 * 1024
+    write_buffer_low = 16 * 1024
+
+    def __init__(self, session: "MuxSession", stream_id: int):
+        super().__init__()
+        self.session = session
+        self.stream_id = stream_id
+        self.protocol: Optional[asyncio.Protocol] = None
+
+        self.send_window = INITIAL_WINDOW
+        self.send_buffer = bytearray()
+        self.unacked_received = 0
+        # received before a protocol was attached, bounded by our window
+        self.early_data = bytearray()
+
+        # None until the first flush decides, False once compression is off
+        self.compressor: Union[Compressor, None, bool] = None
+        self.compressed_in = 0
+        self.compressed_out = 0
+        self.decompressor: Optional[Decompressor] = None
+
+        self.reading_paused = False
+        self.writing_paused = False
+        self.eof_requested = False
+        self.close_requested = False
+        self.fin_sent = False
+        self.fin_received = False
+        self.closed = False
+
+    # Transport interface
+
+    def get_extra_info(self, name, default=None):
+        if name == "mux_stream_id":
+            return self.stream_id
+        return self.session.transport.get_extra_info(name, default)
+
+    def set_protocol(self, protocol):
+        self.protocol = protocol
+
+    def get_protocol(self):
+        return self.protocol
+
+    def is_closing(self) -> bool:
+        return self.close_requested or self.closed
+
+    def is_reading(self) -> bool:
+        return not self.reading_paused
+
+    def pause_reading(self):
+        self.reading_paused = True
+
+    def resume_reading(self):
+        if self.reading_paused:
+            self.reading_paused = False
+            self._grant_window()
+
+    def write(self, data) -> None:
+        if self.eof_requested or self.closed or not data:
+            return
+        self.send_buffer += data
+        self.session.stream_written(self)
+        self._update_write_flow()
+
+    def can_write_eof(self) -> bool:
+        return True
+
+    def write_eof(self):
+        if self.eof_requested or self.closed:
+            return
+        self.eof_requested = True
+        self.session.flush_stream(self)
+
+    def get_write_buffer_size(self) -> int:
+        return len(self.send_buffer)
+
+    def get_write_buffer_limits(self):
+        return self.write_buffer_low, self.write_buffer_high
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        if high is not None:
+            self.write_buffer_high = high
+        self.write_buffer_low = low if low is not None else self.write_buffer_high // 4
+        self._update_write_flow()
+
+    def close(self):
+        # FIN once the buffered data is out, then the stream is forgotten:
+        # anything the peer still sends is answered with a reset
+        if self.close_requested or self.closed:
+            return
+        self.close_requested = True
+        self.eof_requested = True
+        self.session.flush_stream(self)
+
+    def abort(self):
+        if self.closed:
+            return
+        self.send_buffer.clear()
+        self.session.send_reset(self.stream_id, ResetCode.CANCEL)
+        self.connection_lost(None)
+
+    # Session callbacks
+
+    def attached(self):
+        """
+        Delivers what came before the protocol, once it is connected.
+        """
+        if self.early_data:
+            data, self.early_data = bytes(self.early_data), bytearray()
+            self.deliver(data)
+        if self.fin_received:
+            self.fin_received = False
+            self.eof_received()
+
+    def data_received(self, data: bytes, flags: int = 0):
+        if self.fin_received or self.closed:
+            return
+        if flags & CODEC_FLAGS:
+            try:
+                data = self.decompress(flags, data)
+            except ValueError as e:
+                # the session is fine, only this stream's history is lost
+                logger.warning("mux stream %d: %s", self.stream_id, e)
+                self.send_buffer.clear()
+                self.session.send_reset(self.stream_id, ResetCode.PROTOCOL_ERROR)
+                self.connection_lost(ConnectionResetError(str(e)))
+                return
+        if self.protocol is None:
+            self.early_data += data
+            return
+        self.deliver(data)
+
+    def deliver(self, data: bytes):
+        assert self.protocol is not None
+        self.unacked_received += len(data)
+        self.protocol.data_received(data)
+        if not self.reading_paused:
+            self._grant_window()
+
+    def eof_received(self):
+        self.fin_received = True
+        if self.protocol is None:
+            # delivered after the early data once attached
+            return
+        keep_open = self.protocol.eof_received()
+        if not keep_open:
+            self.close()
+        elif self.fin_sent:
+            self.connection_lost(None)
+
+    def reset_received(self, exc: Exception):
+        # a reset after the peer finished writing is just the end of the stream
+        self.connection_lost(None if self.fin_received else exc)
+
+    def window_updated(self, increment: int):
+        self.send_window += increment
+        self.session.flush_stream(self)
+        self._update_write_flow()
+
+    def fin_flushed(self):
+        self.fin_sent = True
+        if self.close_requested or self.fin_received:
+            self.connection_lost(None)
+
+    def connection_lost(self, exc: Optional[Exception]):
+        if self.closed:
+            return
+        self.closed = True
+        self.send_buffer.clear()
+        self.session.forget_stream(self.stream_id)
+        if self.protocol is not None:
+            self.protocol.connection_lost(exc)
+
+    def decompress(self, flags: int, data: bytes) -> bytes:
+        if self.decompressor is None:
+            self.decompressor = create_decompressor(flags)
+        return self.decompressor.decompress(data)
+
+    def _grant_window(self):
+        # batch the credits, one update per half window is plenty
+        if self.unacked_received >= INITIAL_WINDOW // 2:
+            self.session.send_window_update(self.stream_id, self.unacked_received)
+            self.unacked_received = 0
+
+    def _update_write_flow(self):
+        if self.protocol is None:
+            return
+        size = len(self.send_buffer)
+        if not self.writing_paused and size > self.write_buffer_high:
+            self.writing_paused = True
+            self.protocol.pause_writing()
+        elif self.writing_paused and size <= self.write_buffer_low:
+            self.writing_paused = False
+            self.protocol.resume_writing()
+
+
+class MuxSession(asyncio.Protocol):
+    """
+    Either end of a multiplexed connection between two proxy instances.
+
+    The dialing (edge) side allocates odd stream ids, the accepting (core)
+    side only answers; this class only moves frames, opening and accepting
+    streams is left to ``MuxClient`` and ``MuxServerProtocol``.
+    """
+
+    def __init__(
+        self,
+        ping_interval: Optional[float] = 30,
+        ping_timeout: float = 10,
+        compression: Optional[str] = None,
+        compression_level: Optional[int] = None,
+        window_bits: int = DEFAULT_WINDOW_BITS,
+    ):
+        self.transport: asyncio.Transport
+        self.streams: Dict[int, MuxStream] = {}
+        self.next_stream_id = 1
+        self.buffer = bytearray()
+        self.closed = False
+        self.writing_paused = False
+
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.pings: Dict[bytes, asyncio.Future] = {}
+        self.ping_handle: Optional[asyncio.TimerHandle] = None
+
+        self.pending_opens: Dict[int, asyncio.Future] = {}
+        # the loop only keeps weak references to tasks
+        self.tasks: Set[asyncio.Task] = set()
+
+        # what we send is compressed with ``codec``, any codec is accepted
+        self.codec = parse_codec(compression)
+        if compression_level is None:
+            compression_level = 3 if self.codec == Codec.ZSTD else 6
+        self.compression_level = compression_level
+        self.window_bits = window_bits
+        self.unflushed: Dict[MuxStream, None] = {}
+        self.flush_handle: Optional[asyncio.Handle] = None
+        self.stats: Counter = Counter()
+
+    # asyncio.Protocol
+
+    def connection_made(self, transport) -> None:
+        self.transport = transport
+        self._schedule_ping()
+
+    def connection_lost(self, exc: Optional[Exception]) -> None:
+        self.closed = True
+        if self.ping_handle:
+            self.ping_handle.cancel()
+        for future in [*self.pings.values(), *self.pending_opens.values()]:
+            if not future.done():
+                future.set_exception(ConnectionResetError("mux session lost"))
+        for stream in list(self.streams.values()):
+            stream.connection_lost(exc or ConnectionResetError("mux session lost"))
+
+    def pause_writing(self) -> None:
+        self.writing_paused = True
+
+    def resume_writing(self) -> None:
+        self.writing_paused = False
+        for stream in list(self.streams.values()):
+            self.flush_stream(stream)
+            stream._update_write_flow()
+
+    def data_received(self, data: bytes) -> None:
+        self.buffer += data
+        offset = 0
+        while len(self.buffer) - offset >= HEADER.size:
+            frame_type, flags, stream_id, length = HEADER.unpack_from(
+                self.buffer, offset
+            )
+            if length > MAX_PAYLOAD:
+                logger.warning("%d byte frame from %r", length, self.peername)
+                self.transport.abort()
+                return
+            end = offset + HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            payload = bytes(self.buffer[offset + HEADER.size : end])
+            offset = end
+            try:
+                self.frame_received(FrameType(frame_type), flags, stream_id, payload)
+            except (ValueError, struct.error):
+                logger.warning("protocol error from %r", self.peername)
+                self.transport.abort()
+                return
+        del self.buffer[:offset]
+
+    # Frames
+
+    @property
+    def peername(self):
+        return self.transport.get_extra_info("peername")
+
+    def send_frame(self, frame_type: FrameType, stream_id: int, payload=b"", flags=0):
+        if not self.closed and not self.transport.is_closing():
+            self.transport.write(pack_frame(frame_type, stream_id, payload, flags))
+
+    def send_reset(self, stream_id: int, code: ResetCode):
+        self.send_frame(FrameType.RST, stream_id, bytes([code.value]))
+
+    def send_window_update(self, stream_id: int, increment: int):
+        self.send_frame(
+            FrameType.WINDOW_UPDATE, stream_id, pack_window_update(increment)
+        )
+
+    def frame_received(self, frame_type: FrameType, flags: int, stream_id, payload):
+        if frame_type == FrameType.PING:
+            if flags & FLAG_ACK:
+                future = self.pings.pop(payload, None)
+                if future and not future.done():
+                    future.set_result(None)
+            else:
+                self.send_frame(FrameType.PING, 0, payload, FLAG_ACK)
+            return
+
+        if frame_type == FrameType.SYN:
+            if flags & FLAG_ACK:
+                future = self.pending_opens.pop(stream_id, None)
+                if future and not future.done():
+                    future.set_result(None)
+            else:
+                host, port = unpack_address(payload)
+                self.stream_requested(stream_id, host, port)
+            return
+
+        stream = self.streams.get(stream_id)
+        if frame_type == FrameType.RST:
+            future = self.pending_opens.pop(stream_id, None)
+            code = ResetCode(payload[0]) if payload else ResetCode.CANCEL
+            if future and not future.done():
+                future.set_exception(reset_error(code))
+            if stream:
+                stream.reset_received(reset_error(code))
+            return
+
+        if stream is None:
+            if frame_type == FrameType.DATA:
+                self.send_reset(stream_id, ResetCode.CANCEL)
+            return
+
+        if frame_type == FrameType.DATA:
+            stream.data_received(payload, flags)
+        elif frame_type == FrameType.WINDOW_UPDATE:
+            stream.window_updated(unpack_window_update(payload))
+        elif frame_type == FrameType.FIN:
+            stream.eof_received()
+
+    def stream_written(self, stream: MuxStream):
+        if self.codec is None:
+            self.flush_stream(stream)
+            return
+        # compress whatever was written in this loop iteration as one frame
+        self.unflushed[stream] = None
+        if self.flush_handle is None:
+            loop = asyncio.get_running_loop()
+            self.flush_handle = loop.call_soon(self.flush_unflushed)
+
+    def flush_unflushed(self):
+        self.flush_handle = None
+        streams, self.unflushed = self.unflushed, {}
+        for stream in streams:
+            if not stream.closed:
+                self.flush_stream(stream)
+                stream._update_write_flow()
+
+    def flush_stream(self, stream: MuxStream):
+        if self.writing_paused or self.closed:
+            return
+        buffer = stream.send_buffer
+        while buffer and stream.send_window > 0:
+            compressor = self.compressor_for(stream, buffer)
+            limit = MAX_PAYLOAD - COMPRESSION_OVERHEAD if compressor else MAX_PAYLOAD
+            size = min(len(buffer), stream.send_window, limit)
+            payload = bytes(buffer[:size])
+            del buffer[:size]
+            stream.send_window -= size
+
+            flags = 0
+            if compressor:
+                payload = compressor.compress(payload)
+                flags = self.codec.value  # type: ignore[union-attr]
+                self.compressed(stream, size, len(payload))
+
+            self.stats["raw_bytes"] += size
+            self.stats["wire_bytes"] += len(payload)
+            self.send_frame(FrameType.DATA, stream.stream_id, payload, flags)
+        if stream.eof_requested and not buffer and not stream.fin_sent:
+            self.send_frame(FrameType.FIN, stream.stream_id)
+            stream.fin_flushed()
+
+    def compressor_for(
+        self, stream: MuxStream, data: bytearray
+    ) -> Optional[Compressor]:
+        if self.codec is None or stream.compressor is False:
+            return None
+        if stream.compressor is None:
+            if looks_incompressible(data):
+                self.stats["incompressible_streams"] += 1
+                stream.compressor = False
+                return None
+            stream.compressor = create_compressor(
+                self.codec, self.compression_level, self.window_bits
+            )
+        return stream.compressor  # type: ignore[return-value]
+
+    def compressed(self, stream: MuxStream, size: int, compressed_size: int):
+        stream.compressed_in += size
+        stream.compressed_out += compressed_size
+        # give up on streams that turn out not to compress after all
+        if stream.compressed_in >= 64 * 1024:
+            if stream.compressed_out > stream.compressed_in * 0.9:
+                self.stats["incompressible_streams"] += 1
+                stream.compressor = False
+            stream.compressed_in = stream.compressed_out = 0
+
+    # Streams
+
+    def stream_requested(self, stream_id: int, host: str, port: int):
+        self.send_reset(stream_id, ResetCode.NOT_ALLOWED)
+
+    def create_stream(self, stream_id: int) -> MuxStream:
+        stream = MuxStream(self, stream_id)
+        self.streams[stream_id] = stream
+        return stream
+
+    def forget_stream(self, stream_id: int):
+        self.streams.pop(stream_id, None)
+
+    async def open_stream(self, host: str, port: int) -> MuxStream:
+        stream_id = self.next_stream_id
+        self.next_stream_id += 2
+        stream = self.create_stream(stream_id)
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending_opens[stream_id] = future
+        self.send_frame(FrameType.SYN, stream_id, pack_address(host, port))
+        try:
+            await future
+        except BaseException:
+            self.pending_opens.pop(stream_id, None)
+            if not stream.closed:
+                stream.abort()
+            raise
+        return stream
+
+    # Keepalive
+
+    async def ping(self) -> float:
+        loop = asyncio.get_running_loop()
+        opaque = os.urandom(8)
+        future = loop.create_future()
+        self.pings[opaque] = future
+        start = loop.time()
+        self.send_frame(FrameType.PING, 0, opaque)
+        try:
+            await asyncio.wait_for(future, self.ping_timeout)
+        finally:
+            self.pings.pop(opaque, None)
+        return loop.time() - start
+
+    def _schedule_ping(self):
+        if self.ping_interval is None or self.closed:
+            return
+        loop = asyncio.get_running_loop()
+        self.ping_handle = loop.call_later(self.ping_interval, self._keepalive)
+
+    def _keepalive(self):
+        async def keepalive():
+            try:
+                await self.ping()
+            except (asyncio.TimeoutError, ConnectionError):
+                logger.info("mux peer %r did not answer ping", self.peername)
+                self.transport.abort()
+            else:
+                self._schedule_ping()
+
+        self.spawn(keepalive())
+
+    def spawn(self, coroutine: Coroutine):
+        task = asyncio.get_running_loop().create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+
+def reset_error(code: ResetCode) -> Exception:
+    if code == ResetCode.CONNECT_FAILED:
+        return ConnectionRefusedError("mux peer could not connect")
+    if code == ResetCode.NOT_ALLOWED:
+        return PermissionError("mux peer refused the destination")
+    return ConnectionResetError("mux stream reset")
@@ -0,0 +1,249 @@
+import asyncio
+import os
+import unittest
+
+import requests
+
+from protocols.http_proxy.server import HttpProxyServerProtocol
+from protocols.mux.client import MuxClient
+from protocols.mux.compression import create_decompressor, zstandard
+from protocols.mux.frames import FLAG_ZSTD, HEADER, MAX_PAYLOAD, FrameType
+from protocols.mux.server import MuxServerProtocol
+from protocols.socks5_server.server import Socks5ProxyServerProtocol
+from protocols.tests.setup_http_server import SetupHttpServer
+
+
+async def echo(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    while data := await reader.read(65536):
+        writer.write(data)
+        await writer.drain()
+    writer.close()
+
+
+class Greeter(asyncio.Protocol):
+    GREETING = b"220 ready\r\n"
+
+    def connection_made(self, transport):
+        transport.write(self.GREETING)
+
+
+class TestMux(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        async def test():
+            self.mux = MuxClient("127.0.0.1", 7000)
+            self.servers = [
+                await self.loop.create_server(
+                    lambda: MuxServerProtocol(), "127.0.0.1", 7000
+                ),
+                await self.loop.create_server(
+                    lambda: HttpProxyServerProtocol(dialer=self.mux.open_connection),
+                    "127.0.0.1",
+                    8081,
+                ),
+                await self.loop.create_server(
+                    lambda: Socks5ProxyServerProtocol(dialer=self.mux.open_connection),
+                    "127.0.0.1",
+                    1081,
+                ),
+                await asyncio.start_server(echo, "127.0.0.1", 7001),
+            ]
+            self.server_tasks = [
+                self.loop.create_task(server.serve_forever()) for server in self.servers
+            ]
+
+        self.loop.run_until_complete(test())
+
+    def tearDown(self):
+        async def stop_server():
+            self.mux.close()
+            for task in self.server_tasks:
+                task.cancel()
+            for server in self.servers:
+                await server.wait_closed()
+
+        self.loop.run_until_complete(stop_server())
+        self.loop.close()
+
+    def test_proxies_over_mux(self):
+        def get(url, proxy):
+            return requests.get(
+                url,
+                proxies={"http": proxy, "https": proxy},
+                headers={"User-Agent": "test"},
+                verify=False,
+            )
+
+        async def test():
+            for url, proxy in [
+                ("http://127.0.0.1:8000", "http://127.0.0.1:8081"),
+                ("http://127.0.0.1:8000", "socks5://127.0.0.1:1081"),
+            ]:
+                response = await self.loop.run_in_executor(None, get, url, proxy)
+                self.assertEqual(200, response.status_code)
+                self.assertEqual("Hello, World!", response.text)
+
+        with SetupHttpServer():
+            self.loop.run_until_complete(test())
+
+        with SetupHttpServer(https=True):
+            url, proxy = "https://127.0.0.1:8000", "http://127.0.0.1:8081"
+            response = self.loop.run_until_complete(
+                self.loop.run_in_executor(None, get, url, proxy)
+            )
+            self.assertEqual("Hello, World!", response.text)
+
+        # every upstream connection went over the persistent mux connections
+        self.assertLessEqual(len(self.mux.sessions), self.mux.connections)
+
+    def test_concurrent_streams_with_flow_control(self):
+        payload = bytes(range(256)) * 4096  # 1 MiB, several windows
+
+        async def roundtrip():
+            reader, writer = await self.mux.open_connection("127.0.0.1", 7001)
+
+            async def send():
+                writer.write(payload)
+                await writer.drain()
+
+            sender = asyncio.ensure_future(send())
+            received = await reader.readexactly(len(payload))
+            await sender
+            writer.close()
+            return received
+
+        async def test():
+            results = await asyncio.gather(*(roundtrip() for _ in range(8)))
+            for received in results:
+                self.assertEqual(payload, received)
+            self.assertEqual(2, len(self.mux.sessions))
+
+        self.loop.run_until_complete(asyncio.wait_for(test(), 30))
+
+    def test_connect_failure_and_ping(self):
+        async def test():
+            with self.assertRaises(ConnectionRefusedError):
+                await self.mux.open_connection("127.0.0.1", 1)
+            # a host that does not even resolve only fails its stream
+            with self.assertRaises(ConnectionRefusedError):
+                await self.mux.open_connection("bad\x00host", 80)
+
+            session = await self.mux.get_session()
+            self.assertGreaterEqual(await session.ping(), 0)
+
+        self.loop.run_until_complete(test())
+
+    def test_server_speaks_first(self):
+        async def greeting(port: int):
+            reader, writer = await self.mux.open_connection("127.0.0.1", port)
+            try:
+                return await asyncio.wait_for(
+                    reader.readexactly(len(Greeter.GREETING)), 5
+                )
+            finally:
+                writer.close()
+
+        async def test():
+            greeter = await self.loop.create_server(Greeter, "127.0.0.1", 0)
+            port = greeter.sockets[0].getsockname()[1]
+            # the greeting often comes in the same read as the SYN+ACK
+            greetings = await asyncio.gather(*(greeting(port) for _ in range(20)))
+            self.assertEqual([Greeter.GREETING] * 20, greetings)
+            await asyncio.sleep(0.1)
+            greeter.close()
+
+        self.loop.run_until_complete(test())
+
+    def test_oversized_frame(self):
+        async def test():
+            reader, writer = await asyncio.open_connection("127.0.0.1", 7000)
+            # only the header, the length alone is a protocol error
+            writer.write(HEADER.pack(FrameType.DATA.value, 0, 1, MAX_PAYLOAD + 1))
+            self.assertEqual(b"", await asyncio.wait_for(reader.read(), 5))
+            writer.close()
+
+        self.loop.run_until_complete(test())
+
+
+class TestMuxCompression(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+        async def test():
+            self.mux = MuxClient(
+                "127.0.0.1", 7002, compression="zstd" if zstandard else "zlib"
+            )
+            self.servers = [
+                await self.loop.create_server(
+                    lambda: MuxServerProtocol(compression="zlib"), "127.0.0.1", 7002
+                ),
+                await asyncio.start_server(echo, "127.0.0.1", 7003),
+            ]
+
+        self.loop.run_until_complete(test())
+
+    def tearDown(self):
+        async def stop_server():
+            self.mux.close()
+            for server in self.servers:
+                server.close()
+                await server.wait_closed()
+
+        self.loop.run_until_complete(stop_server())
+        self.loop.close()
+
+    def roundtrip(self, payload: bytes) -> bytes:
+        async def test():
+            reader, writer = await self.mux.open_connection("127.0.0.1", 7003)
+            for i in range(0, len(payload), 1000):
+                writer.write(payload[i : i + 1000])
+            await writer.drain()
+            received = await reader.readexactly(len(payload))
+            writer.close()
+            return received
+
+        return self.loop.run_until_complete(asyncio.wait_for(test(), 10))
+
+    def test_text_is_compressed(self):
+        with open(
+            os.path.join(os.path.dirname(__file__), "../tests/fixtures", "http.bin"),
+            "rb",
+        ) as f:
+            payload = f.read() * 1000
+
+        self.assertEqual(payload, self.roundtrip(payload))
+
+        session = self.mux.sessions[0]
+        self.assertEqual(len(payload), session.stats["raw_bytes"])
+        self.assertLess(session.stats["wire_bytes"], len(payload) / 10)
+
+    @unittest.skipUnless(zstandard, "zstandard is not installed")
+    def test_zstd_output_is_bounded(self):
+        compressor = zstandard.ZstdCompressor().compressobj()
+        frame = compressor.compress(b"x" * 1000) + compressor.flush(
+            zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        )
+        bomb = compressor.compress(bytes(64 * MAX_PAYLOAD)) + compressor.flush(
+            zstandard.COMPRESSOBJ_FLUSH_BLOCK
+        )
+
+        decompressor = create_decompressor(FLAG_ZSTD)
+        self.assertEqual(b"x" * 1000, decompressor.decompress(frame))
+        with self.assertRaises(ValueError):
+            decompressor.decompress(bomb)
+
+    def test_random_data_is_not_compressed(self):
+        payload = os.urandom(256 * 1024)
+
+        self.assertEqual(payload, self.roundtrip(payload))
+
+        session = self.mux.sessions[0]
+        self.assertEqual(1, session.stats["incompressible_streams"])
+        self.assertEqual(len(payload), session.stats["wire_bytes"])
+
+
+if __name__ == "__main__":
+    unittest.main()
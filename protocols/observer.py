@@ -0,0 +1,189 @@
+import functools
+import time
+from asyncio import StreamWriter
+from typing import Any, Awaitable, Optional, Tuple
+
+from protocols.access_log import AccessLog
+from protocols.circuit_breaker import CircuitBreakers
+from protocols.deadlines import CONNECT, Deadlines, PhaseTimeout
+from protocols.dialer import Dialer, open_connection
+from protocols.flight_recorder import CloseReason, Event, FlightRecorder, error_code
+from protocols.forward import StreamPair, is_relayed, relay_stream
+from protocols.memory import MemoryBudget
+from protocols.socket_options import SocketOptions
+from protocols.tracing import ConnectionTrace, Tracer
+
+
+class ObservedProtocol:
+    """
+    Tracing, flight recorder and access log hooks shared by the proxy server
+    protocols. All are optional; with none configured a hook is an attribute
+    check.
+    The socket options, if any, are set on the accepted connection and on
+    upstream dials. A phase that runs past its deadline closes the
+    connection quietly, with a ``timeout`` close reason.
+
+    With ``early_reply`` a tunnel is acknowledged before its upstream dial
+    has finished. What the client sends meanwhile waits in its
+    ``StreamReader``, which stops reading past twice the reader limit, and
+    is relayed first; a failed dial just closes the client.
+
+    Upstreams whose circuit breaker is open are not dialed, ``connect``
+    raises ``CircuitOpen`` right away. A failed dial is kept in
+    ``dial_error`` so that the handlers can answer it, and ``dial_failed``
+    ends the connection with an error without a traceback.
+    """
+
+    name = ""
+    dialer: Optional[Dialer] = None
+    socket_options: Optional[SocketOptions] = None
+    tracer: Optional[Tracer] = None
+    flight_recorder: Optional[FlightRecorder] = None
+    access_log: Optional[AccessLog] = None
+    memory_budget: Optional[MemoryBudget] = None
+    deadlines: Deadlines
+    early_reply = False
+    circuit_breakers: Optional[CircuitBreakers] = None
+
+    # per connection, only set when observed
+    trace: Optional[ConnectionTrace] = None
+    conn_id = 0
+    started = 0.0
+    peer: Tuple[Any, ...] = ()
+    target: Tuple[Any, ...] = ()
+    user = ""
+    close_reason = CloseReason.DONE
+    done = False
+    replied = False
+    dial_error: Optional[BaseException] = None
+
+    async def observe(self, handler: Awaitable[None], writer: StreamWriter):
+        if self.socket_options:
+            self.socket_options.apply(writer)
+        peer = writer.get_extra_info("peername") or ("", 0)
+        if self.access_log:
+            self.started = time.monotonic()
+            self.peer = peer
+        if self.tracer:
+            self.trace = self.tracer.start(self.name, peer)
+        if self.flight_recorder:
+            self.conn_id = self.flight_recorder.next_conn_id()
+            self.flight_recorder.record(
+                self.conn_id, Event.ACCEPT, port=peer[1], text=peer[0]
+            )
+
+        try:
+            await handler
+        except PhaseTimeout as e:
+            if self.trace:
+                self.trace.error = f"{e.phase} timeout"
+            self.close_reason = CloseReason.TIMEOUT
+        except BaseException as e:
+            if self.trace:
+                self.trace.error = type(e).__name__
+            self.close_reason = CloseReason.ERROR
+            raise
+        finally:
+            # a relay reports the end itself
+            if not is_relayed(writer):
+                self.connection_done(0, 0)
+
+    def reject(self):
+        self.close_reason = CloseReason.REJECTED
+
+    def record_auth(self, username: str, accepted: bool):
+        self.user = username
+        if self.flight_recorder:
+            self.flight_recorder.record(
+                self.conn_id, Event.AUTH, int(accepted), text=username
+            )
+
+    async def connect(self, host: str, port: int) -> StreamPair:
+        self.target = (host, port)
+        try:
+            if self.circuit_breakers:
+                return await self.circuit_breakers.connect(
+                    host, port, functools.partial(self.dial, host, port)
+                )
+            return await self.dial(host, port)
+        except OSError as e:
+            self.dial_error = e
+            raise
+
+    def dial_failed(self, e: BaseException):
+        # answered already, the client knows
+        if self.trace:
+            self.trace.error = type(e).__name__
+        self.close_reason = CloseReason.ERROR
+
+    async def dial(self, host: str, port: int) -> StreamPair:
+        if not self.flight_recorder:
+            async with self.deadlines.phase(CONNECT):
+                return await open_connection(
+                    host, port, self.dialer, self.trace, self.socket_options
+                )
+
+        self.flight_recorder.record(self.conn_id, Event.TARGET, port=port, text=host)
+        try:
+            async with self.deadlines.phase(CONNECT):
+                stream = await open_connection(
+                    host, port, self.dialer, self.trace, self.socket_options
+                )
+        except BaseException as e:
+            self.flight_recorder.record(self.conn_id, Event.CONNECT, error_code(e))
+            raise
+        self.flight_recorder.record(self.conn_id, Event.CONNECT)
+        return stream
+
+    async def open_tunnel(
+        self, host: str, port: int, writer: StreamWriter, reply: bytes
+    ) -> StreamPair:
+        if self.early_reply:
+            self.replied = True
+            writer.write(reply)
+            return await self.connect(host, port)
+
+        stream = await self.connect(host, port)
+        self.replied = True
+        writer.write(reply)
+        await writer.drain()
+        return stream
+
+    async def relay(self, local_stream: StreamPair, remote_stream: StreamPair):
+        if not (self.trace or self.flight_recorder or self.access_log):
+            await relay_stream(
+                local_stream,
+                remote_stream,
+                budget=self.memory_budget,
+                deadlines=self.deadlines,
+            )
+            return
+        await relay_stream(
+            local_stream,
+            remote_stream,
+            on_close=self.connection_done,
+            on_first_byte=self.trace.mark_first_byte if self.trace else None,
+            budget=self.memory_budget,
+            deadlines=self.deadlines,
+        )
+
+    def connection_done(self, sent: int, received: int):
+        if self.done:
+            return
+        self.done = True
+        if self.trace:
+            self.trace.close(sent, received)
+        if self.flight_recorder:
+            self.flight_recorder.record(
+                self.conn_id, Event.CLOSE, self.close_reason, a=sent, b=received
+            )
+        if self.access_log:
+            self.access_log.record(
+                self.peer,
+                self.target,
+                self.user,
+                sent,
+                received,
+                time.monotonic() - self.started,
+                self.close_reason.name.lower(),
+            )
@@ -0,0 +1,162 @@
+import asyncio
+import time
+from collections import Counter
+from typing import Iterable, List, Optional
+from urllib.parse import unquote, urlsplit
+
+import async_timeout  # type:ignore
+
+from protocols.dialer import DestinationError, ProxyError
+from protocols.forward import StreamPair
+from protocols.http_proxy.client import http_connect
+from protocols.socks5_server.client import socks5_handshake
+
+# seconds charged for a failed attempt when ranking the parents
+FAILURE_COST = 1.0
+
+
+class Parent:
+    """
+    One parent proxy, ``socks5://[user:password@]host:port`` or
+    ``http://[user:password@]host:port`` (CONNECT), with the EWMA of its
+    handshake latency and of its failure rate.
+    """
+
+    __slots__ = (
+        "name",
+        "scheme",
+        "host",
+        "port",
+        "username",
+        "password",
+        "latency",
+        "failure_rate",
+        "updated",
+    )
+
+    def __init__(self, url: str):
+        parsed = urlsplit(url)
+        if parsed.scheme not in ("socks5", "http") or not parsed.hostname:
+            raise ValueError(f"not a socks5:// or http:// parent proxy: {url}")
+        self.scheme = parsed.scheme
+        self.host = parsed.hostname
+        self.port = parsed.port or (1080 if parsed.scheme == "socks5" else 8080)
+        # without the credentials, for metrics
+        self.name = f"{self.scheme}://{self.host}:{self.port}"
+        self.username = unquote(parsed.username) if parsed.username else None
+        self.password = unquote(parsed.password) if parsed.password else None
+        # unmeasured parents go first
+        self.latency = 0.0
+        self.failure_rate = 0.0
+        # monotonic time the failure rate was last decayed
+        self.updated = time.monotonic()
+
+    def score(self) -> float:
+        # the expected time to a working tunnel: the handshake, plus what the
+        # failed attempts before it cost on average
+        failure_rate = min(self.failure_rate, 0.99)
+        return self.latency + failure_rate / (1 - failure_rate) * FAILURE_COST
+
+    async def open_connection(self, host: str, port: int) -> StreamPair:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            if self.scheme == "socks5":
+                await socks5_handshake(
+                    reader, writer, host, port, self.username, self.password
+                )
+            else:
+                await http_connect(
+                    reader, writer, host, port, self.username, self.password
+                )
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+
+class ParentProxies:
+    """
+    A ``Dialer`` that reaches every destination through one of several
+    parent proxies, for ``dialer=ParentProxies(urls).open_connection``.
+
+    The parent with the lowest expected time to a working tunnel is tried
+    first; when it fails, or takes longer than ``timeout`` seconds, the next
+    one is tried, up to ``attempts`` parents. ``alpha`` weighs new
+    measurements in both averages, and failure rates halve every
+    ``half_life`` seconds on top, so that a parent that failed is tried again
+    once its old failures weigh less than the others' latency. A
+    ``DestinationError``, the parent's answer that the destination refused or
+    is unreachable, is not the parent's failure and is raised as it is; a
+    ``ProxyError``, e.g. rejected credentials, is. When every attempt fails,
+    timeouts included, ``ProxyError`` is raised. Parents speaking SOCKS5 get
+    the whole handshake in one write; HTTP CONNECT is a single request anyway.
+    """
+
+    def __init__(
+        self,
+        parents: Iterable[str],
+        attempts: int = 2,
+        timeout: Optional[float] = 10.0,
+        alpha: float = 0.3,
+        half_life: float = 60.0,
+    ):
+        self.parents: List[Parent] = [Parent(url) for url in parents]
+        if not self.parents:
+            raise ValueError("no parent proxies")
+        self.attempts = attempts
+        self.timeout = timeout
+        self.alpha = alpha
+        self.half_life = half_life
+        self.stats: Counter = Counter()
+
+    def ranked(self) -> List[Parent]:
+        now = time.monotonic()
+        for parent in self.parents:
+            if parent.failure_rate:
+                elapsed = now - parent.updated
+                parent.failure_rate *= 0.5 ** (elapsed / self.half_life)
+            parent.updated = now
+        return sorted(self.parents, key=Parent.score)
+
+    async def open_connection(self, host: str, port: int) -> StreamPair:
+        error: Optional[BaseException] = None
+        for parent in self.ranked()[: self.attempts]:
+            if error:
+                self.stats["failovers"] += 1
+            started = time.monotonic()
+            try:
+                async with async_timeout.timeout(self.timeout):
+                    stream = await parent.open_connection(host, port)
+            except DestinationError:
+                self.succeeded(parent, time.monotonic() - started)
+                raise
+            except (OSError, EOFError, ValueError, asyncio.TimeoutError) as e:
+                self.failed(parent)
+                error = e
+                continue
+            self.succeeded(parent, time.monotonic() - started)
+            self.stats["tunnels"] += 1
+            return stream
+        raise ProxyError(f"no parent proxy reached {host}:{port}: {error!r}") from error
+
+    def succeeded(self, parent: Parent, latency: float):
+        alpha = self.alpha
+        parent.latency = (
+            (1 - alpha) * parent.latency + alpha * latency
+            if parent.latency
+            else latency
+        )
+        parent.failure_rate *= 1 - alpha
+
+    def failed(self, parent: Parent):
+        self.stats["failures"] += 1
+        parent.failure_rate = (1 - self.alpha) * parent.failure_rate + self.alpha
+
+    def metrics(self):
+        return {
+            parent.name: {
+                "latency": parent.latency,
+                "failure_rate": parent.failure_rate,
+            }
+            for parent in self.parents
+        }
@@ -0,0 +1,147 @@
+import base64
+import hashlib
+import hmac
+import os
+import struct
+from asyncio import StreamReader, StreamWriter
+from typing import Dict, NamedTuple, Optional
+
+from protocols.postgres.messages import (
+    AUTH_CLEARTEXT_PASSWORD,
+    AUTH_MD5_PASSWORD,
+    AUTH_OK,
+    AUTH_SASL,
+    AUTH_SASL_CONTINUE,
+    AUTH_SASL_FINAL,
+    PostgresError,
+    cstring,
+    message,
+    parse_error_response,
+    read_message,
+    startup_message,
+)
+
+
+def md5_password(user: str, password: str, salt: bytes) -> str:
+    inner = hashlib.md5((password + user).encode()).hexdigest()
+    return "md5" + hashlib.md5(inner.encode() + salt).hexdigest()
+
+
+class ScramClient:
+    """
+    SCRAM-SHA-256 without channel binding (RFC 5802, RFC 7677).
+    """
+
+    def __init__(self, password: str, user: str = "", nonce: Optional[str] = None):
+        self.password = password
+        self.user = user
+        self.nonce = nonce or base64.b64encode(os.urandom(18)).decode()
+        self.server_signature = b""
+
+    def client_first(self) -> bytes:
+        self.client_first_bare = f"n={self.user},r={self.nonce}"
+        return ("n,," + self.client_first_bare).encode()
+
+    def client_final(self, server_first: bytes) -> bytes:
+        attributes = dict(
+            item.split("=", 1) for item in server_first.decode().split(",")
+        )
+        nonce = attributes["r"]
+        if not nonce.startswith(self.nonce):
+            raise ValueError("SCRAM server nonce does not extend ours")
+        salted = hashlib.pbkdf2_hmac(
+            "sha256",
+            self.password.encode(),
+            base64.b64decode(attributes["s"]),
+            int(attributes["i"]),
+        )
+        client_key = hmac.digest(salted, b"Client Key", "sha256")
+        stored_key = hashlib.sha256(client_key).digest()
+        without_proof = f"c=biws,r={nonce}"
+        auth_message = ",".join(
+            [self.client_first_bare, server_first.decode(), without_proof]
+        ).encode()
+        signature = hmac.digest(stored_key, auth_message, "sha256")
+        proof = bytes(a ^ b for a, b in zip(client_key, signature))
+        server_key = hmac.digest(salted, b"Server Key", "sha256")
+        self.server_signature = hmac.digest(server_key, auth_message, "sha256")
+        return f"{without_proof},p={base64.b64encode(proof).decode()}".encode()
+
+    def verify(self, server_final: bytes):
+        attributes = dict(
+            item.split("=", 1) for item in server_final.decode().split(",")
+        )
+        if base64.b64decode(attributes.get("v", "")) != self.server_signature:
+            raise ValueError("SCRAM server signature mismatch")
+
+
+class Login(NamedTuple):
+    parameters: Dict[str, str]
+    process_id: int
+    secret_key: int
+    status: bytes
+
+
+async def login(
+    reader: StreamReader,
+    writer: StreamWriter,
+    user: str,
+    database: str,
+    password: Optional[str] = None,
+    options: Optional[Dict[str, str]] = None,
+) -> Login:
+    """
+    Start up a backend session and read up to its first ReadyForQuery.
+    """
+    writer.write(
+        startup_message({"user": user, "database": database, **(options or {})})
+    )
+    parameters: Dict[str, str] = {}
+    process_id = secret_key = 0
+    scram: Optional[ScramClient] = None
+
+    while True:
+        message_type, payload = await read_message(reader)
+        if message_type == b"E":
+            raise PostgresError(parse_error_response(payload))
+        if message_type == b"S":
+            name, value = payload.rstrip(b"\0").split(b"\0")
+            parameters[name.decode()] = value.decode()
+        elif message_type == b"K":
+            process_id, secret_key = struct.unpack("!II", payload)
+        elif message_type == b"Z":
+            return Login(parameters, process_id, secret_key, payload)
+        elif message_type == b"R":
+            (code,) = struct.unpack_from("!I", payload)
+            if code == AUTH_OK:
+                continue
+            if password is None:
+                raise PostgresError(
+                    {"C": "28P01", "M": "the server asks for a password"}
+                )
+            if code == AUTH_CLEARTEXT_PASSWORD:
+                writer.write(message(b"p", cstring(password)))
+            elif code == AUTH_MD5_PASSWORD:
+                writer.write(
+                    message(b"p", cstring(md5_password(user, password, payload[4:8])))
+                )
+            elif code == AUTH_SASL and b"SCRAM-SHA-256" in payload[4:].split(b"\0"):
+                scram = ScramClient(password)
+                first = scram.client_first()
+                writer.write(
+                    message(
+                        b"p",
+                        cstring("SCRAM-SHA-256")
+                        + struct.pack("!i", len(first))
+                        + first,
+                    )
+                )
+            elif code == AUTH_SASL_CONTINUE and scram:
+                writer.write(message(b"p", scram.client_final(payload[4:])))
+            elif code == AUTH_SASL_FINAL and scram:
+                scram.verify(payload[4:])
+            else:
+                raise PostgresError(
+                    {"C": "28000", "M": f"unsupported authentication {code}"}
+                )
+        # NoticeResponse and anything else during startup is not interesting
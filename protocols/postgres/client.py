@@ -0,0 +1,634 @@
+"""
+An asyncio PostgreSQL client on the extended query protocol.
+
+Every call writes its messages at once and then waits for its own results,
+so calls made concurrently on one connection are pipelined; ``pipeline()``
+goes further and puts many statements behind a single Sync. Statements are
+prepared once per connection and cached by their SQL. Rows keep the
+``memoryview`` of the DataRow they came in and decode a column only when it
+is read. COPY data streams through ``copy_in`` and ``copy_out`` with at most
+``max_chunks`` chunks buffered; a COPY has the connection to itself, calls
+made meanwhile wait for it to end and pipelines may not be used.
+
+Parameters and results use the text format.
+"""
+import asyncio
+import itertools
+import struct
+from collections import OrderedDict, deque
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Deque,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+    cast,
+)
+
+from protocols.forward import READ_SIZE
+from protocols.postgres.auth import Login, login
+from protocols.postgres.messages import (
+    HEADER,
+    TERMINATE,
+    PostgresError,
+    cancel_request,
+    cstring,
+    message,
+    parse_error_response,
+    query,
+)
+
+DECODERS: Dict[int, Callable[[bytes], Any]] = {
+    16: lambda value: value == b"t",  # bool
+    17: lambda value: bytes.fromhex(value[2:].decode()),  # bytea
+    20: int,  # int8
+    21: int,  # int2
+    23: int,  # int4
+    26: int,  # oid
+    700: float,  # float4
+    701: float,  # float8
+}
+
+unpack_count = struct.Struct("!H").unpack_from
+unpack_length = struct.Struct("!i").unpack_from
+
+SYNC = message(b"S")
+EXECUTE = message(b"E", cstring("") + struct.pack("!I", 0))
+
+
+def encode(value: Any) -> Optional[bytes]:
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return b"t" if value else b"f"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return b"\\x" + bytes(value).hex().encode()
+    return str(value).encode()
+
+
+def bind(statement: str, args: Tuple[Any, ...]) -> bytes:
+    payload = [cstring(""), cstring(statement), struct.pack("!HH", 0, len(args))]
+    for arg in args:
+        value = encode(arg)
+        if value is None:
+            payload.append(struct.pack("!i", -1))
+        else:
+            payload.append(struct.pack("!i", len(value)) + value)
+    payload.append(struct.pack("!H", 0))
+    return message(b"B", b"".join(payload))
+
+
+class Column(NamedTuple):
+    name: str
+    oid: int
+
+
+class RowDescription:
+    __slots__ = ("columns", "index", "decoders")
+
+    def __init__(self, payload: memoryview):
+        data = bytes(payload)
+        (count,) = struct.unpack_from("!H", data)
+        self.columns: List[Column] = []
+        offset = 2
+        for _ in range(count):
+            end = data.index(b"\0", offset)
+            name = data[offset:end].decode()
+            (oid,) = struct.unpack_from("!I", data, end + 7)
+            self.columns.append(Column(name, oid))
+            offset = end + 19
+        self.index = {column.name: i for i, column in enumerate(self.columns)}
+        self.decoders = [
+            DECODERS.get(column.oid, bytes.decode) for column in self.columns
+        ]
+
+
+class Row:
+    """
+    A DataRow, decoded column by column on access.
+    """
+
+    __slots__ = ("description", "data", "offsets")
+
+    def __init__(self, description: RowDescription, data: memoryview):
+        self.description = description
+        self.data = data
+        self.offsets: Optional[List[int]] = None
+
+    def locate(self) -> List[int]:
+        # start and end of each value, both -1 for NULL
+        data = self.data
+        offsets: List[int] = []
+        append = offsets.append
+        offset = 2
+        for _ in range(unpack_count(data)[0]):
+            (length,) = unpack_length(data, offset)
+            offset += 4
+            if length < 0:
+                append(-1)
+                append(-1)
+            else:
+                append(offset)
+                offset += length
+                append(offset)
+        self.offsets = offsets
+        return offsets
+
+    def raw(self, index: int) -> Optional[memoryview]:
+        offsets = self.offsets or self.locate()
+        start = offsets[2 * index]
+        return None if start < 0 else self.data[start : offsets[2 * index + 1]]
+
+    def __getitem__(self, key: Union[int, str]) -> Any:
+        description = self.description
+        index = description.index[key] if isinstance(key, str) else key
+        offsets = self.offsets or self.locate()
+        start = offsets[2 * index]
+        if start < 0:
+            return None
+        value = self.data[start : offsets[2 * index + 1]].tobytes()
+        return description.decoders[index](value)
+
+    def __len__(self) -> int:
+        return len(self.description.columns)
+
+    def __iter__(self) -> Iterator[Any]:
+        return (self[i] for i in range(len(self)))
+
+    def __repr__(self) -> str:
+        return f"Row({tuple(self)!r})"
+
+
+class Statement:
+    __slots__ = ("name", "description")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.description: Optional[RowDescription] = None
+
+
+class Operation:
+    """
+    Something waiting for the responses to messages already written.
+    """
+
+    # whether it lasts up to and including a ReadyForQuery
+    until_ready = False
+    done = False
+    error: Optional[Exception] = None
+
+    def __init__(self):
+        self.future = asyncio.get_running_loop().create_future()
+
+    def handle(self, message_type: bytes, payload: memoryview) -> Optional[Awaitable]:
+        self.finish(None)
+        return None
+
+    def finish(self, result: Any):
+        self.done = True
+        if not self.future.done():
+            self.future.set_result(result)
+
+    def fail(self, error: Exception):
+        self.done = True
+        if not self.future.done():
+            self.future.set_exception(error)
+            # the caller may be gone; the error is theirs anyway
+            self.future.exception()
+
+
+class Prepare(Operation):
+    def __init__(self, statement: Statement, forget: Callable[[], None]):
+        super().__init__()
+        self.statement = statement
+        self.forget = forget
+
+    def handle(self, message_type, payload):
+        if message_type == b"T":
+            self.statement.description = RowDescription(payload)
+            self.finish(None)
+        elif message_type == b"n":
+            self.finish(None)
+        # ParseComplete and ParameterDescription come first
+
+    def fail(self, error):
+        self.forget()
+        super().fail(error)
+
+
+class Execute(Operation):
+    def __init__(self, statement: Statement):
+        super().__init__()
+        self.statement = statement
+        self.rows: List[Row] = []
+
+    def handle(self, message_type, payload):
+        if message_type == b"D":
+            # the statement is described before any of its rows arrive
+            description = cast(RowDescription, self.statement.description)
+            self.rows.append(Row(description, payload))
+        elif message_type == b"C":
+            self.finish((bytes(payload[:-1]).decode(), self.rows))
+        elif message_type == b"I":
+            self.finish(("", self.rows))
+        # BindComplete
+
+
+class Sync(Operation):
+    until_ready = True
+
+    def handle(self, message_type, payload):
+        if message_type == b"Z":
+            self.finish(None)
+
+
+class CopyIn(Operation):
+    until_ready = True
+
+    def __init__(self):
+        super().__init__()
+        self.ready = asyncio.get_running_loop().create_future()
+        self.tag = ""
+
+    def handle(self, message_type, payload):
+        if message_type == b"G" and not self.ready.done():
+            self.ready.set_result(None)
+        elif message_type == b"C":
+            self.tag = bytes(payload[:-1]).decode()
+        elif message_type == b"Z":
+            if self.error:
+                self.fail(self.error)
+            else:
+                self.finish(self.tag)
+
+    def fail(self, error):
+        if not self.ready.done():
+            self.ready.set_exception(error)
+            self.ready.exception()
+        super().fail(error)
+
+
+class CopyOut(Operation):
+    until_ready = True
+
+    def __init__(self, max_chunks: int):
+        super().__init__()
+        # chunks, then None at the end or the error
+        self.queue: asyncio.Queue = asyncio.Queue(max_chunks)
+        self.discard = False
+        self.tag = ""
+
+    def handle(self, message_type, payload):
+        if message_type == b"d":
+            if self.discard:
+                return None
+            if self.queue.full():
+                # stop reading the connection until the consumer catches up
+                return self.queue.put(payload)
+            self.queue.put_nowait(payload)
+        elif message_type == b"C":
+            self.tag = bytes(payload[:-1]).decode()
+        elif message_type == b"Z":
+            if self.error:
+                self.fail(self.error)
+                return None
+            self.finish(self.tag)
+            if not self.discard:
+                return self.queue.put(None)
+        return None
+
+    def fail(self, error):
+        super().fail(error)
+        while self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(error)
+
+
+class Connection:
+    def __init__(
+        self,
+        reader: asyncio.StreamReader,
+        writer: asyncio.StreamWriter,
+        session: Login,
+        address: Tuple[str, int],
+        statement_cache_size: int = 256,
+    ):
+        self.reader = reader
+        self.writer = writer
+        self.address = address
+        self.parameters = session.parameters
+        self.process_id = session.process_id
+        self.secret_key = session.secret_key
+        self.status = session.status
+        self.statement_cache_size = statement_cache_size
+        self.statements: "OrderedDict[str, Statement]" = OrderedDict()
+        self.statement_ids = itertools.count(1)
+        self.pending: Deque[Operation] = deque()
+        self.error: Optional[Exception] = None
+        # set while a COPY is in progress, no other message may go in between
+        self.copying: Optional[asyncio.Future] = None
+        self.read_task = asyncio.ensure_future(self.read_loop())
+
+    async def execute(self, sql: str, *args: Any) -> str:
+        """
+        Run ``sql`` and return its command tag.
+        """
+        tag, _ = await self.run(sql, args)
+        return tag
+
+    async def fetch(self, sql: str, *args: Any) -> List[Row]:
+        _, rows = await self.run(sql, args)
+        return rows
+
+    async def fetchrow(self, sql: str, *args: Any) -> Optional[Row]:
+        rows = await self.fetch(sql, *args)
+        return rows[0] if rows else None
+
+    async def run(self, sql: str, args: Tuple[Any, ...]) -> Tuple[str, List[Row]]:
+        await self.copy_ended()
+        future = self.queue(sql, args)
+        self.send(SYNC, Sync())
+        await self.writer.drain()
+        return await future
+
+    def pipeline(self) -> "Pipeline":
+        return Pipeline(self)
+
+    def queue(self, sql: str, args: Tuple[Any, ...]) -> asyncio.Future:
+        """
+        Write Bind/Execute for ``sql`` (and Parse/Describe the first time),
+        without a Sync.
+        """
+        if self.copying:
+            raise RuntimeError("a COPY is in progress on this connection")
+        messages: List[bytes] = []
+        statement = self.statements.get(sql)
+        if statement:
+            self.statements.move_to_end(sql)
+        else:
+            statement = self.prepare(sql, messages)
+        execute = Execute(statement)
+        messages += [bind(statement.name, args), EXECUTE]
+        self.send(b"".join(messages))
+        self.pending.append(execute)
+        return execute.future
+
+    def prepare(self, sql: str, messages: List[bytes]) -> Statement:
+        if len(self.statements) >= self.statement_cache_size:
+            _, evicted = self.statements.popitem(last=False)
+            messages.append(message(b"C", b"S" + cstring(evicted.name)))
+            self.pending.append(Operation())
+        statement = Statement(f"s{next(self.statement_ids)}")
+        self.statements[sql] = statement
+
+        def forget():
+            if self.statements.get(sql) is statement:
+                del self.statements[sql]
+
+        messages.append(message(b"P", cstring(statement.name) + cstring(sql) + b"\0\0"))
+        messages.append(message(b"D", b"S" + cstring(statement.name)))
+        self.pending.append(Prepare(statement, forget))
+        return statement
+
+    def send(self, data: bytes, operation: Optional[Operation] = None):
+        if self.error:
+            raise self.error
+        self.writer.write(data)
+        if operation:
+            self.pending.append(operation)
+
+    async def copy_in(
+        self,
+        sql: str,
+        source: Union[AsyncIterable[bytes], Iterable[bytes]],
+    ) -> str:
+        """
+        Run ``COPY ... FROM STDIN`` with the chunks of ``source``, waiting
+        for the server to take each one before reading the next.
+        """
+        await self.copy_ended()
+        operation = CopyIn()
+        self.send(query(sql), operation)
+        self.start_copy()
+        try:
+            await operation.ready
+            try:
+                if isinstance(source, AsyncIterable):
+                    async for chunk in source:
+                        self.writer.write(message(b"d", chunk))
+                        await self.writer.drain()
+                else:
+                    for chunk in source:
+                        self.writer.write(message(b"d", chunk))
+                        await self.writer.drain()
+            except BaseException as e:
+                self.writer.write(message(b"f", cstring(repr(e))))
+                await asyncio.gather(operation.future, return_exceptions=True)
+                raise
+            self.writer.write(message(b"c"))
+            return await operation.future
+        finally:
+            self.end_copy()
+
+    async def copy_out(
+        self, sql: str, max_chunks: int = 64
+    ) -> AsyncIterator[memoryview]:
+        """
+        Run ``COPY ... TO STDOUT`` and yield its data. Reading from the
+        server stops while ``max_chunks`` chunks are waiting to be consumed.
+        Other calls wait until the iteration ends, so none can be awaited
+        inside it.
+        """
+        await self.copy_ended()
+        operation = CopyOut(max_chunks)
+        self.send(query(sql), operation)
+        self.start_copy()
+        ended = False
+        try:
+            while True:
+                chunk = await operation.queue.get()
+                if chunk is None:
+                    ended = True
+                    return
+                if isinstance(chunk, Exception):
+                    ended = True
+                    raise chunk
+                yield chunk
+        finally:
+            if not ended:
+                # stopped early: the rest is dropped, and the reader may be
+                # waiting for room for a chunk or the end
+                operation.discard = True
+                while not operation.queue.empty():
+                    operation.queue.get_nowait()
+            self.end_copy()
+
+    async def copy_ended(self):
+        while self.copying:
+            await asyncio.shield(self.copying)
+
+    def start_copy(self):
+        self.copying = asyncio.get_running_loop().create_future()
+
+    def end_copy(self):
+        copying, self.copying = self.copying, None
+        if copying:
+            copying.set_result(None)
+
+    async def read_loop(self):
+        data = b""
+        try:
+            while chunk := await self.reader.read(READ_SIZE):
+                data = data + chunk if data else chunk
+                view = memoryview(data)
+                offset, end = 0, len(data)
+                while end - offset >= HEADER.size:
+                    message_type, length = HEADER.unpack_from(data, offset)
+                    if end - offset < length + 1:
+                        # read the rest of a large message in one go
+                        rest = await self.reader.readexactly(
+                            length + 1 - (end - offset)
+                        )
+                        data = data[offset:] + rest
+                        view = memoryview(data)
+                        offset, end = 0, len(data)
+                    payload = view[offset + HEADER.size : offset + length + 1]
+                    offset += length + 1
+                    wait = self.dispatch(message_type, payload)
+                    if wait:
+                        await wait
+                data = data[offset:]
+            self.error = ConnectionResetError("the server closed the connection")
+        except (OSError, asyncio.IncompleteReadError) as e:
+            self.error = ConnectionResetError(f"connection lost: {e}")
+        except BaseException as e:
+            self.error = ConnectionError(f"connection closed: {e!r}")
+            raise
+        finally:
+            while self.pending:
+                self.pending.popleft().fail(self.error or ConnectionError())
+
+    def dispatch(self, message_type: bytes, payload: memoryview) -> Optional[Awaitable]:
+        if message_type == b"D":
+            # the bulk of the traffic, never the end of an operation
+            return self.pending[0].handle(message_type, payload)
+        if message_type == b"S":
+            name, value = bytes(payload).rstrip(b"\0").split(b"\0")
+            self.parameters[name.decode()] = value.decode()
+            return None
+        if message_type in (b"N", b"A"):
+            # notices and notifications are not surfaced
+            return None
+        if message_type == b"Z":
+            self.status = bytes(payload)
+        if message_type == b"E":
+            self.fail_batch(PostgresError(parse_error_response(bytes(payload))))
+            return None
+        operation = self.pending[0]
+        wait = operation.handle(message_type, payload)
+        if operation.done:
+            self.pending.popleft()
+        return wait
+
+    def fail_batch(self, error: PostgresError):
+        # the server skips everything up to the next Sync
+        while self.pending and not self.pending[0].until_ready:
+            self.pending.popleft().fail(error)
+        if self.pending:
+            self.pending[0].error = error
+
+    async def cancel(self):
+        """
+        Ask the server to cancel whatever this connection is running.
+        """
+        _, writer = await asyncio.open_connection(*self.address)
+        writer.write(cancel_request(self.process_id, self.secret_key))
+        await writer.drain()
+        writer.close()
+
+    async def close(self):
+        if not self.writer.is_closing():
+            self.writer.write(TERMINATE)
+            self.writer.close()
+        await asyncio.gather(self.read_task, return_exceptions=True)
+
+
+class Pipeline:
+    """
+    Statements queued on a pipeline are written right away but share one
+    Sync, sent when the ``async with`` block ends. As in a single Sync
+    batch on the server, the first error fails the statements after it.
+    """
+
+    def __init__(self, connection: Connection):
+        self.connection = connection
+        self.futures: List[asyncio.Future] = []
+
+    def execute(self, sql: str, *args: Any) -> asyncio.Future:
+        return self.add(sql, args, lambda result: result[0])
+
+    def fetch(self, sql: str, *args: Any) -> asyncio.Future:
+        return self.add(sql, args, lambda result: result[1])
+
+    def add(self, sql: str, args: Tuple[Any, ...], pick: Callable) -> asyncio.Future:
+        future = self.connection.queue(sql, args)
+        picked = asyncio.get_running_loop().create_future()
+
+        def done(future: asyncio.Future):
+            if picked.cancelled():
+                return
+            if future.cancelled():
+                picked.cancel()
+            elif future.exception():
+                picked.set_exception(future.exception())  # type: ignore[arg-type]
+            else:
+                picked.set_result(pick(future.result()))
+
+        future.add_done_callback(done)
+        self.futures.append(picked)
+        return picked
+
+    async def sync(self) -> List[Any]:
+        sync = Sync()
+        self.connection.send(SYNC, sync)
+        await self.connection.writer.drain()
+        await sync.future
+        futures, self.futures = self.futures, []
+        return await asyncio.gather(*futures)
+
+    async def __aenter__(self) -> "Pipeline":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.sync()
+        elif not self.connection.error:
+            # still resynchronize the connection, ignoring the results
+            await asyncio.gather(self.sync(), return_exceptions=True)
+
+
+async def connect(
+    host: str = "127.0.0.1",
+    port: int = 5432,
+    user: str = "postgres",
+    database: Optional[str] = None,
+    password: Optional[str] = None,
+    statement_cache_size: int = 256,
+    **options: str,
+) -> Connection:
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        session = await login(reader, writer, user, database or user, password, options)
+    except BaseException:
+        writer.close()
+        raise
+    return Connection(reader, writer, session, (host, port), statement_cache_size)
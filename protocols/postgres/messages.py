@@ -0,0 +1,189 @@
+import struct
+from asyncio import StreamReader
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# https://www.postgresql.org/docs/current/protocol-message-formats.html
+#
+# +------+--------+---------+
+# | TYPE | LENGTH | PAYLOAD |
+# +------+--------+---------+
+# |  1   |   4    | LENGTH-4|
+# +------+--------+---------+
+# LENGTH counts itself but not TYPE; startup packets have no TYPE at all.
+HEADER = struct.Struct("!cI")
+
+PROTOCOL_VERSION = 196608  # 3.0
+SSL_REQUEST = 80877103
+GSSENC_REQUEST = 80877104
+CANCEL_REQUEST = 80877102
+
+AUTH_OK = 0
+AUTH_CLEARTEXT_PASSWORD = 3
+AUTH_MD5_PASSWORD = 5
+AUTH_SASL = 10
+AUTH_SASL_CONTINUE = 11
+AUTH_SASL_FINAL = 12
+
+# ReadyForQuery transaction status
+IDLE = b"I"
+IN_TRANSACTION = b"T"
+FAILED_TRANSACTION = b"E"
+
+OID_INT4 = 23
+OID_TEXT = 25
+
+
+class PostgresError(Exception):
+    """
+    An ErrorResponse; ``fields`` maps the one letter field codes to values.
+    """
+
+    def __init__(self, fields: Dict[str, str]):
+        super().__init__(fields.get("M", ""))
+        self.fields = fields
+
+    @property
+    def code(self) -> str:
+        return self.fields.get("C", "")
+
+    @property
+    def severity(self) -> str:
+        return self.fields.get("S", "")
+
+
+def cstring(value: str) -> bytes:
+    return value.encode() + b"\0"
+
+
+def message(message_type: bytes, payload: bytes = b"") -> bytes:
+    return HEADER.pack(message_type, len(payload) + 4) + payload
+
+
+async def read_message(reader: StreamReader) -> Tuple[bytes, bytes]:
+    message_type, length = HEADER.unpack(await reader.readexactly(HEADER.size))
+    return message_type, await reader.readexactly(length - 4)
+
+
+async def read_startup(reader: StreamReader) -> Tuple[int, bytes]:
+    """
+    The code (protocol version or request code) and the rest of a startup packet.
+    """
+    (length,) = struct.unpack("!I", await reader.readexactly(4))
+    payload = await reader.readexactly(length - 4)
+    return struct.unpack_from("!I", payload)[0], payload[4:]
+
+
+def startup_message(parameters: Dict[str, str]) -> bytes:
+    payload = struct.pack("!I", PROTOCOL_VERSION)
+    payload += b"".join(cstring(k) + cstring(v) for k, v in parameters.items())
+    payload += b"\0"
+    return struct.pack("!I", len(payload) + 4) + payload
+
+
+def parse_startup_parameters(payload: bytes) -> Dict[str, str]:
+    values = payload.rstrip(b"\0").split(b"\0")
+    return {k.decode(): v.decode() for k, v in zip(values[::2], values[1::2]) if k}
+
+
+def cancel_request(process_id: int, secret_key: int) -> bytes:
+    return struct.pack("!IIII", 16, CANCEL_REQUEST, process_id, secret_key)
+
+
+def authentication(code: int, data: bytes = b"") -> bytes:
+    return message(b"R", struct.pack("!I", code) + data)
+
+
+def parameter_status(name: str, value: str) -> bytes:
+    return message(b"S", cstring(name) + cstring(value))
+
+
+def backend_key_data(process_id: int, secret_key: int) -> bytes:
+    return message(b"K", struct.pack("!II", process_id, secret_key))
+
+
+def ready_for_query(status: bytes = IDLE) -> bytes:
+    return message(b"Z", status)
+
+
+def query(sql: str) -> bytes:
+    return message(b"Q", cstring(sql))
+
+
+def command_complete(tag: str) -> bytes:
+    return message(b"C", cstring(tag))
+
+
+def row_description(fields: Sequence[Tuple[str, int]]) -> bytes:
+    """
+    ``fields`` are (name, type oid) pairs, all in text format.
+    """
+    payload = struct.pack("!H", len(fields))
+    for name, oid in fields:
+        payload += cstring(name) + struct.pack("!IHIhiH", 0, 0, oid, -1, -1, 0)
+    return message(b"T", payload)
+
+
+def data_row(values: Sequence[Optional[bytes]]) -> bytes:
+    payload = struct.pack("!H", len(values))
+    for value in values:
+        if value is None:
+            payload += struct.pack("!i", -1)
+        else:
+            payload += struct.pack("!i", len(value)) + value
+    return message(b"D", payload)
+
+
+def error_response(text: str, code: str = "08P01", severity: str = "FATAL") -> bytes:
+    fields = [("S", severity), ("V", severity), ("C", code), ("M", text)]
+    return message(b"E", b"".join(k.encode() + cstring(v) for k, v in fields) + b"\0")
+
+
+def parse_error_response(payload: bytes) -> Dict[str, str]:
+    fields = {}
+    for field in payload.rstrip(b"\0").split(b"\0"):
+        if field:
+            fields[field[:1].decode()] = field[1:].decode(errors="replace")
+    return fields
+
+
+TERMINATE = message(b"X")
+
+
+class MessageScanner:
+    """
+    Follows message boundaries in a stream of backend messages without
+    copying it, so it can be forwarded in whole chunks. ``feed`` returns the
+    transaction status of every ReadyForQuery completed by ``data``.
+    """
+
+    def __init__(self):
+        self.header = bytearray()
+        # payload bytes of the current message still to come
+        self.remaining = 0
+        self.ready_for_query = False
+
+    def feed(self, data: bytes) -> List[bytes]:
+        statuses = []
+        offset, end = 0, len(data)
+        while offset < end:
+            if self.remaining:
+                if self.ready_for_query:
+                    statuses.append(data[offset : offset + 1])
+                    self.ready_for_query = False
+                skipped = min(self.remaining, end - offset)
+                offset += skipped
+                self.remaining -= skipped
+                continue
+            needed = HEADER.size - len(self.header)
+            self.header += data[offset : offset + needed]
+            offset += needed
+            if len(self.header) == HEADER.size:
+                message_type, length = HEADER.unpack(self.header)
+                self.header.clear()
+                self.remaining = length - 4
+                self.ready_for_query = message_type == b"Z"
+        return statuses
+
+    @property
+    def at_boundary(self) -> bool:
+        return not self.remaining and not self.header
@@ -0,0 +1,477 @@
+"""
+A PostgreSQL connection pooler in the spirit of pgbouncer.
+
+Clients log in to the pooler, which hands them backend connections from a
+pool per (database, user):
+
+- ``PoolMode.SESSION`` keeps a backend for the whole client session and
+  runs ``reset_query`` before giving it to the next client.
+- ``PoolMode.TRANSACTION`` takes the backend back as soon as it reports an
+  idle ReadyForQuery, so a few backends serve many mostly idle clients.
+  Session state (SET, prepared statements, advisory locks) does not survive
+  a transaction in this mode, just like with pgbouncer.
+
+Backend responses are forwarded in whole chunks; only the message headers
+are looked at to find the ReadyForQuery boundaries.
+"""
+import asyncio
+import itertools
+import logging
+import random
+import struct
+from asyncio import StreamReader, StreamWriter
+from collections import Counter, deque
+from enum import Enum
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+from protocols.forward import READ_SIZE
+from protocols.postgres.auth import login
+from protocols.postgres.messages import (
+    AUTH_CLEARTEXT_PASSWORD,
+    AUTH_OK,
+    CANCEL_REQUEST,
+    GSSENC_REQUEST,
+    HEADER,
+    IDLE,
+    PROTOCOL_VERSION,
+    SSL_REQUEST,
+    TERMINATE,
+    MessageScanner,
+    PostgresError,
+    authentication,
+    backend_key_data,
+    cancel_request,
+    error_response,
+    parameter_status,
+    parse_startup_parameters,
+    query,
+    read_message,
+    read_startup,
+    ready_for_query,
+)
+from protocols.reverse_proxy.server import ReverseProxyProtocol
+
+logger = logging.getLogger(__name__)
+
+
+# extended query messages, which run as a batch up to the next Sync
+EXTENDED = (b"P", b"B", b"D", b"E", b"C", b"H")
+
+
+class PoolMode(Enum):
+    SESSION = "session"
+    TRANSACTION = "transaction"
+
+
+class ServerConnection:
+    def __init__(self, reader: StreamReader, writer: StreamWriter, login):
+        self.reader = reader
+        self.writer = writer
+        self.parameters: Dict[str, str] = login.parameters
+        self.process_id: int = login.process_id
+        self.secret_key: int = login.secret_key
+
+    @property
+    def closed(self) -> bool:
+        return self.writer.is_closing() or self.reader.at_eof()
+
+    async def reset(self, sql: str):
+        self.writer.write(query(sql))
+        while True:
+            message_type, payload = await read_message(self.reader)
+            if message_type == b"Z":
+                if payload != IDLE:
+                    raise PostgresError({"M": f"{sql} left the session busy"})
+                return
+
+    def close(self):
+        if not self.writer.is_closing():
+            self.writer.write(TERMINATE)
+            self.writer.close()
+
+
+class Pool:
+    """
+    The backends of one (database, user). When all ``max_size`` of them are
+    busy, clients queue up and get a released backend handed over in FIFO
+    order.
+    """
+
+    def __init__(
+        self,
+        pooler: "Pooler",
+        database: str,
+        user: str,
+        max_size: int,
+        password: Optional[str] = None,
+    ):
+        self.pooler = pooler
+        self.database = database
+        self.user = user
+        self.max_size = max_size
+        self.password = password
+        self.idle: Deque[ServerConnection] = deque()
+        # each waiter gets a backend, or None when it may open one itself
+        self.waiters: Deque[asyncio.Future] = deque()
+        # open or opening backends
+        self.size = 0
+        self.active = 0
+        self.max_wait = 0.0
+        self.stats: Counter = Counter()
+
+    async def acquire(self) -> ServerConnection:
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        while True:
+            while self.idle:
+                server = self.idle.pop()
+                if not server.closed:
+                    return self.checkout(server, start)
+                self.discard(server)
+
+            if self.size < self.max_size:
+                self.size += 1
+                try:
+                    server = await self.connect()
+                except BaseException:
+                    self.size -= 1
+                    self.wake()
+                    raise
+                return self.checkout(server, start)
+
+            waiter = loop.create_future()
+            self.waiters.append(waiter)
+            self.stats["waited"] += 1
+            try:
+                server = await asyncio.wait_for(waiter, self.pooler.wait_timeout)
+            except asyncio.TimeoutError:
+                self.stats["wait_timeouts"] += 1
+                raise
+            except BaseException:
+                # handed a backend just as we got cancelled
+                if waiter.done() and not waiter.cancelled() and waiter.result():
+                    self.active += 1
+                    self.release(waiter.result())
+                raise
+            finally:
+                if waiter in self.waiters:
+                    self.waiters.remove(waiter)
+            if server:
+                return self.checkout(server, start)
+
+    def checkout(self, server: ServerConnection, start: float) -> ServerConnection:
+        wait = asyncio.get_running_loop().time() - start
+        self.max_wait = max(self.max_wait, wait)
+        self.stats["acquired"] += 1
+        self.stats["wait_us"] += int(wait * 1e6)
+        self.active += 1
+        return server
+
+    async def connect(self) -> ServerConnection:
+        reader, writer = await asyncio.open_connection(
+            self.pooler.host, self.pooler.port
+        )
+        try:
+            session = await login(
+                reader, writer, self.user, self.database, self.password
+            )
+        except BaseException:
+            writer.close()
+            raise
+        self.stats["connections_opened"] += 1
+        return ServerConnection(reader, writer, session)
+
+    def release(self, server: ServerConnection, reusable: bool = True):
+        self.active -= 1
+        if not reusable or server.closed:
+            self.discard(server)
+            self.wake()
+            return
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(server)
+                return
+        self.idle.append(server)
+
+    def discard(self, server: ServerConnection):
+        server.close()
+        self.size -= 1
+        self.stats["connections_closed"] += 1
+
+    def wake(self):
+        # a slot is free: let the first waiter open a backend
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    def metrics(self) -> dict:
+        acquired = self.stats["acquired"]
+        return {
+            "size": self.size,
+            "max_size": self.max_size,
+            "active": self.active,
+            "idle": len(self.idle),
+            "waiting": len(self.waiters),
+            "max_wait": self.max_wait,
+            "avg_wait": self.stats["wait_us"] / acquired / 1e6 if acquired else 0.0,
+            **self.stats,
+        }
+
+
+class Pooler:
+    def __init__(
+        self,
+        host: str,
+        port: int,
+        mode: PoolMode = PoolMode.TRANSACTION,
+        pool_size: int = 20,
+        pool_sizes: Optional[Dict[Tuple[str, str], int]] = None,
+        on_auth: Optional[Callable[[str, str], bool]] = None,
+        password: Optional[str] = None,
+        wait_timeout: Optional[float] = 120,
+        reset_query: Optional[str] = "DISCARD ALL",
+    ):
+        """
+        ``pool_sizes`` overrides ``pool_size`` per (database, user). Backends
+        are logged in to with ``password``, or else with the password the
+        client gave ``on_auth``.
+        """
+        self.host = host
+        self.port = port
+        self.mode = mode
+        self.pool_size = pool_size
+        self.pool_sizes = pool_sizes or {}
+        self.on_auth = on_auth
+        self.password = password
+        self.wait_timeout = wait_timeout
+        self.reset_query = reset_query
+        self.pools: Dict[Tuple[str, str], Pool] = {}
+        # the keys handed to clients, for cancel requests
+        self.sessions: Dict[Tuple[int, int], "PostgresPoolerProtocol"] = {}
+        self.process_ids = itertools.count(1)
+
+    def pool(self, database: str, user: str, password: Optional[str] = None) -> Pool:
+        key = (database, user)
+        if key not in self.pools:
+            self.pools[key] = Pool(
+                self,
+                database,
+                user,
+                self.pool_sizes.get(key, self.pool_size),
+                self.password or password,
+            )
+        return self.pools[key]
+
+    def metrics(self) -> Dict[str, dict]:
+        return {
+            f"{db}/{user}": pool.metrics() for (db, user), pool in self.pools.items()
+        }
+
+    def close(self):
+        """
+        Close the idle backends; busy ones close as their clients leave.
+        """
+        for pool in self.pools.values():
+            while pool.idle:
+                pool.discard(pool.idle.pop())
+
+    async def cancel(self, process_id: int, secret_key: int):
+        session = self.sessions.get((process_id, secret_key))
+        server = session.server if session else None
+        if not server:
+            return
+        _, writer = await asyncio.open_connection(self.host, self.port)
+        writer.write(cancel_request(server.process_id, server.secret_key))
+        await writer.drain()
+        writer.close()
+
+
+class PostgresPoolerProtocol(ReverseProxyProtocol):
+    pool: Pool
+    server: Optional[ServerConnection] = None
+    pump_task: Optional[asyncio.Task] = None
+    # Sync and Query messages whose ReadyForQuery has not come back yet
+    pending = 0
+    # extended query messages were sent, but not their Sync yet
+    batch_open = False
+    status = IDLE
+
+    def __init__(
+        self,
+        pooler: Pooler,
+        on_accept: Optional[Callable[[str, int], bool]] = None,
+    ):
+        super().__init__(pooler.host, pooler.port, on_accept)
+        self.pooler = pooler
+        self.key = (next(pooler.process_ids), random.getrandbits(31))
+
+    async def forward(self, reader: StreamReader, writer: StreamWriter):
+        code, payload = await read_startup(reader)
+        while code in (SSL_REQUEST, GSSENC_REQUEST):
+            writer.write(b"N")
+            code, payload = await read_startup(reader)
+        if code == CANCEL_REQUEST:
+            await self.pooler.cancel(*struct.unpack("!II", payload))
+            return
+        if code != PROTOCOL_VERSION:
+            writer.write(error_response(f"unsupported protocol {code >> 16}"))
+            return
+
+        parameters = parse_startup_parameters(payload)
+        user = parameters.get("user", "")
+        database = parameters.get("database", user)
+        password = None
+        if self.pooler.on_auth:
+            writer.write(authentication(AUTH_CLEARTEXT_PASSWORD))
+            message_type, payload = await read_message(reader)
+            password = payload.rstrip(b"\0").decode()
+            if message_type != b"p" or not self.pooler.on_auth(user, password):
+                writer.write(
+                    error_response(
+                        f'password authentication failed for user "{user}"', "28P01"
+                    )
+                )
+                return
+
+        self.pool = self.pooler.pool(database, user, password)
+        if not await self.attach(writer):
+            return
+        assert self.server
+        writer.write(
+            authentication(AUTH_OK)
+            + b"".join(
+                parameter_status(k, v) for k, v in self.server.parameters.items()
+            )
+            + backend_key_data(*self.key)
+            + ready_for_query()
+        )
+        self.pooler.sessions[self.key] = self
+        try:
+            if self.pooler.mode == PoolMode.TRANSACTION:
+                self.release_if_idle()
+            else:
+                self.start_pump(writer)
+            await self.serve(reader, writer)
+        finally:
+            del self.pooler.sessions[self.key]
+            await self.detach()
+
+    async def serve(self, reader: StreamReader, writer: StreamWriter):
+        while True:
+            try:
+                message_type, payload = await read_message(reader)
+            except asyncio.IncompleteReadError:
+                return
+            if message_type == b"X":
+                return
+            attached = not self.server
+            if attached and not await self.attach(writer):
+                return
+            assert self.server
+            if message_type in EXTENDED:
+                self.batch_open = True
+            elif message_type in (b"Q", b"S"):
+                self.pending += 1
+                if message_type == b"S":
+                    self.batch_open = False
+            server_writer = self.server.writer
+            server_writer.write(HEADER.pack(message_type, len(payload) + 4) + payload)
+            if attached:
+                self.start_pump(writer)
+            await server_writer.drain()
+
+    async def attach(self, writer: StreamWriter) -> bool:
+        try:
+            self.server = await self.pool.acquire()
+        except asyncio.TimeoutError:
+            writer.write(error_response("query_wait_timeout"))
+            return False
+        except PostgresError as e:
+            writer.write(
+                error_response(e.args[0], e.code or "08P01", e.severity or "FATAL")
+            )
+            return False
+        except OSError as e:
+            writer.write(error_response(f"server connection failed: {e}", "08006"))
+            return False
+        return True
+
+    def start_pump(self, writer: StreamWriter):
+        assert self.server
+        self.pump_task = asyncio.ensure_future(self.pump(self.server, writer))
+
+    async def pump(self, server: ServerConnection, writer: StreamWriter):
+        scanner = MessageScanner()
+        try:
+            while data := await server.reader.read(READ_SIZE):
+                writer.write(data)
+                statuses = scanner.feed(data)
+                for status in statuses:
+                    self.pending -= 1
+                    self.status = status
+                # checked after every chunk, the ReadyForQuery may have come
+                # with the start of a message that only ends in this one
+                if (
+                    self.pooler.mode == PoolMode.TRANSACTION
+                    and scanner.at_boundary
+                    and self.release_if_idle()
+                ):
+                    return
+                await writer.drain()
+        except OSError as e:
+            logger.debug(f"server connection lost: {e}")
+        # the backend went away under the client
+        writer.close()
+
+    def release_if_idle(self) -> bool:
+        if self.pending or self.batch_open or self.status != IDLE or not self.server:
+            return False
+        server, self.server = self.server, None
+        self.pump_task = None
+        self.pool.release(server)
+        return True
+
+    async def detach(self):
+        server, self.server = self.server, None
+        if not server:
+            return
+        if self.pump_task:
+            # the pump must be off the backend's reader before it is reused
+            self.pump_task.cancel()
+            await asyncio.gather(self.pump_task, return_exceptions=True)
+            self.pump_task = None
+        reusable = not self.pending and not self.batch_open and self.status == IDLE
+        if (
+            reusable
+            and self.pooler.mode == PoolMode.SESSION
+            and self.pooler.reset_query
+        ):
+            try:
+                await server.reset(self.pooler.reset_query)
+            except (OSError, asyncio.IncompleteReadError, PostgresError) as e:
+                logger.debug(f"reset failed: {e}")
+                reusable = False
+        self.pool.release(server, reusable)
+
+
+async def main():
+    host, port = "127.0.0.1", 6432
+    pooler = Pooler("127.0.0.1", 5432)
+    loop = asyncio.get_event_loop()
+    server = await loop.create_server(
+        lambda: PostgresPoolerProtocol(pooler), host, port
+    )
+
+    logger.info(f"Serving on {host}:{port}")
+
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    logger.setLevel(logging.DEBUG)
+    asyncio.run(main())
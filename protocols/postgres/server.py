@@ -0,0 +1,443 @@
+"""
+A framework for PostgreSQL wire protocol servers.
+
+Applications provide a query handler returning a ``Result`` whose rows are
+an (async) iterable; the rows are only iterated when the result is sent.
+DataRows are encoded into one reusable buffer per connection and written
+once ``BATCH_SIZE`` bytes have piled up, waiting on the transport between
+batches, so a result of any size is sent in constant memory at the pace
+the client reads it. Both the simple and the extended query protocol are
+supported, including portals executed with a row limit.
+
+Describing a prepared statement must not run it, so its columns come from
+an optional describe handler; without one the statement is described as
+returning no data. A described portal runs its query once, for both the
+Describe and the Execute.
+
+Values are sent in the text format: None is NULL, booleans are t or f,
+bytes are sent as they are and anything else as its ``str``.
+"""
+import asyncio
+import itertools
+import logging
+import random
+import re
+import struct
+from asyncio import StreamReader, StreamWriter
+from typing import (
+    Any,
+    AsyncIterable,
+    AsyncIterator,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+    Union,
+)
+
+from protocols.forward import closing_stream
+from protocols.postgres.messages import (
+    AUTH_CLEARTEXT_PASSWORD,
+    AUTH_OK,
+    CANCEL_REQUEST,
+    FAILED_TRANSACTION,
+    GSSENC_REQUEST,
+    IDLE,
+    IN_TRANSACTION,
+    OID_TEXT,
+    PROTOCOL_VERSION,
+    SSL_REQUEST,
+    PostgresError,
+    authentication,
+    backend_key_data,
+    command_complete,
+    cstring,
+    error_response,
+    message,
+    parameter_status,
+    parse_startup_parameters,
+    read_message,
+    read_startup,
+    ready_for_query,
+    row_description,
+)
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 64 * 1024
+
+pack_row_header = struct.Struct("!cIH").pack_into
+pack_length = struct.Struct("!i").pack
+NULL = pack_length(-1)
+ROW_HEADER = bytes(7)
+
+Rows = Union[AsyncIterable[Sequence[Any]], Iterable[Sequence[Any]]]
+
+
+Columns = Sequence[Union[str, Tuple[str, int]]]
+
+
+def column_types(columns: Columns) -> List[Tuple[str, int]]:
+    return [
+        (column, OID_TEXT) if isinstance(column, str) else column for column in columns
+    ]
+
+
+class Result:
+    """
+    ``columns`` are names or (name, type oid) pairs; the tag defaults to
+    ``SELECT <rows>`` when there are columns and to the SQL command otherwise.
+    """
+
+    def __init__(
+        self,
+        columns: Columns = (),
+        rows: Rows = (),
+        tag: Optional[str] = None,
+    ):
+        self.columns = column_types(columns)
+        self.rows = rows
+        self.tag = tag
+
+
+# called with the SQL and the text of its parameters
+QueryHandler = Callable[[str, List[Optional[str]]], Awaitable[Result]]
+# called with the SQL of a prepared statement, returns its columns
+DescribeHandler = Callable[[str], Awaitable[Columns]]
+
+
+def command_tag(sql: str, result: Result, count: int) -> str:
+    if result.tag is not None:
+        return result.tag
+    if result.columns:
+        return f"SELECT {count}"
+    words = sql.split(None, 1)
+    return words[0].upper() if words else ""
+
+
+class Portal:
+    __slots__ = ("sql", "params", "result", "rows", "sent")
+
+    def __init__(self, sql: str, params: List[Optional[str]]):
+        self.sql = sql
+        self.params = params
+        self.result: Optional[Result] = None
+        # the row iterator of a portal suspended by a row limit
+        self.rows: Optional[AsyncIterator[Sequence[Any]]] = None
+        self.sent = 0
+
+
+def aiter_rows(rows: Rows) -> AsyncIterator[Sequence[Any]]:
+    if isinstance(rows, AsyncIterable):
+        return rows.__aiter__()
+    return iterate(rows)
+
+
+async def iterate(rows: Iterable[Sequence[Any]]) -> AsyncIterator[Sequence[Any]]:
+    for row in rows:
+        yield row
+
+
+def encode_text(value: Any) -> bytes:
+    if value.__class__ is bool:
+        return b"t" if value else b"f"
+    if isinstance(value, (bytes, bytearray)):
+        return value
+    return str(value).encode()
+
+
+class PostgresServerProtocol(asyncio.StreamReaderProtocol):
+    status = IDLE
+
+    def __init__(
+        self,
+        query_handler: QueryHandler,
+        on_accept: Optional[Callable[[str, int], bool]] = None,
+        on_auth: Optional[Callable[[str, str], bool]] = None,
+        parameters: Optional[Dict[str, str]] = None,
+        describe_handler: Optional[DescribeHandler] = None,
+    ):
+        self.reader = StreamReader()
+        super().__init__(self.reader, self.handler)
+
+        self.query_handler = query_handler
+        self.describe_handler = describe_handler
+        self.on_accept = on_accept
+        self.on_auth = on_auth
+        self.parameters = {
+            "server_version": "16.0",
+            "server_encoding": "UTF8",
+            "client_encoding": "UTF8",
+            "DateStyle": "ISO, MDY",
+            "integer_datetimes": "on",
+            "standard_conforming_strings": "on",
+            **(parameters or {}),
+        }
+        self.statements: Dict[bytes, str] = {}
+        self.portals: Dict[bytes, Portal] = {}
+        # rows and small messages waiting for the next write
+        self.buffer = bytearray()
+        # after an error, extended protocol messages are ignored up to Sync
+        self.skipping = False
+
+    async def handler(self, reader: StreamReader, writer: StreamWriter):
+        with closing_stream(writer):
+            try:
+                await self._handler(reader, writer)
+            except ConnectionError:
+                # the client went away, possibly in the middle of a result
+                pass
+
+    async def _handler(self, reader: StreamReader, writer: StreamWriter) -> None:
+        addr = writer.get_extra_info("peername")
+        if self.on_accept:
+            if not self.on_accept(addr[0], addr[1]):
+                return
+
+        if not await self.startup(reader, writer):
+            return
+
+        while True:
+            try:
+                message_type, payload = await read_message(reader)
+            except asyncio.IncompleteReadError:
+                return
+            if message_type == b"X":
+                return
+            if message_type == b"Q":
+                await self.simple_query(payload[:-1].decode(), writer)
+            elif message_type == b"S":
+                self.skipping = False
+                self.buffer += ready_for_query(self.status)
+                await self.flush(writer)
+            elif message_type == b"H":
+                await self.flush(writer)
+            elif not self.skipping:
+                try:
+                    await self.extended(message_type, payload, writer)
+                except ConnectionError:
+                    raise
+                except Exception as e:
+                    self.fail(e)
+                    self.skipping = True
+            if len(self.buffer) >= BATCH_SIZE:
+                await self.flush(writer)
+
+    async def startup(self, reader: StreamReader, writer: StreamWriter) -> bool:
+        code, payload = await read_startup(reader)
+        while code in (SSL_REQUEST, GSSENC_REQUEST):
+            writer.write(b"N")
+            code, payload = await read_startup(reader)
+        if code == CANCEL_REQUEST:
+            return False
+        if code != PROTOCOL_VERSION:
+            writer.write(error_response(f"unsupported protocol {code >> 16}"))
+            return False
+
+        user = parse_startup_parameters(payload).get("user", "")
+        if self.on_auth:
+            writer.write(authentication(AUTH_CLEARTEXT_PASSWORD))
+            message_type, password = await read_message(reader)
+            if message_type != b"p" or not self.on_auth(user, password[:-1].decode()):
+                writer.write(
+                    error_response(
+                        f'password authentication failed for user "{user}"', "28P01"
+                    )
+                )
+                return False
+
+        writer.write(
+            authentication(AUTH_OK)
+            + b"".join(parameter_status(k, v) for k, v in self.parameters.items())
+            + backend_key_data(next(process_ids), random.getrandbits(31))
+            + ready_for_query()
+        )
+        return True
+
+    async def simple_query(self, sql: str, writer: StreamWriter):
+        if not sql.strip():
+            self.buffer += message(b"I")
+        else:
+            try:
+                result = await self.query_handler(sql, [])
+                if result.columns:
+                    self.buffer += row_description(result.columns)
+                await self.send_rows(Portal(sql, []), result, 0, writer)
+            except ConnectionError:
+                raise
+            except Exception as e:
+                self.fail(e)
+        self.buffer += ready_for_query(self.status)
+        await self.flush(writer)
+
+    async def extended(self, message_type: bytes, payload: bytes, writer: StreamWriter):
+        if message_type == b"P":
+            name, text, _ = payload.split(b"\0", 2)
+            self.statements[name] = text.decode()
+            self.buffer += message(b"1")
+        elif message_type == b"B":
+            portal_name, name, rest = payload.split(b"\0", 2)
+            self.portals[portal_name] = Portal(self.statements[name], parse_bind(rest))
+            self.buffer += message(b"2")
+        elif message_type == b"D":
+            name = payload[1:-1]
+            if payload[:1] == b"S":
+                sql = self.statements[name]
+                count = max(map(int, re.findall(r"\$(\d+)", sql)), default=0)
+                self.buffer += message(
+                    b"t", struct.pack("!H", count) + struct.pack("!I", OID_TEXT) * count
+                )
+                columns = (
+                    column_types(await self.describe_handler(sql))
+                    if self.describe_handler
+                    else []
+                )
+            else:
+                columns = (await self.result(self.portals[name])).columns
+            self.buffer += row_description(columns) if columns else message(b"n")
+        elif message_type == b"E":
+            name, rest = payload.split(b"\0", 1)
+            (max_rows,) = struct.unpack_from("!I", rest)
+            portal = self.portals[name]
+            await self.send_rows(portal, await self.result(portal), max_rows, writer)
+        elif message_type == b"C":
+            name = payload[1:-1]
+            if payload[:1] == b"S":
+                self.statements.pop(name, None)
+            else:
+                self.portals.pop(name, None)
+            self.buffer += message(b"3")
+        else:
+            raise PostgresError(
+                {"C": "08P01", "M": f"unexpected message {message_type!r}"}
+            )
+
+    async def result(self, portal: Portal) -> Result:
+        if portal.result is None:
+            portal.result = await self.query_handler(portal.sql, portal.params)
+        return portal.result
+
+    async def send_rows(
+        self, portal: Portal, result: Result, max_rows: int, writer: StreamWriter
+    ):
+        if portal.rows is None:
+            portal.rows = aiter_rows(result.rows)
+        buffer = self.buffer
+        sent = 0
+        async for row in portal.rows:
+            start = len(buffer)
+            buffer += ROW_HEADER
+            for value in row:
+                if value is None:
+                    buffer += NULL
+                    continue
+                if value.__class__ is str:
+                    value = value.encode()
+                elif value.__class__ is int:
+                    value = b"%d" % value
+                elif value.__class__ is not bytes:
+                    value = encode_text(value)
+                buffer += pack_length(len(value)) + value
+            pack_row_header(buffer, start, b"D", len(buffer) - start - 1, len(row))
+            sent += 1
+            if len(buffer) >= BATCH_SIZE:
+                await self.flush(writer)
+            if sent == max_rows:
+                portal.sent += sent
+                self.buffer += message(b"s")
+                return
+        portal.sent += sent
+        tag = command_tag(portal.sql, result, portal.sent)
+        self.buffer += command_complete(tag)
+        self.track_transaction(tag)
+
+    def track_transaction(self, tag: str):
+        if tag in ("BEGIN", "START TRANSACTION"):
+            self.status = IN_TRANSACTION
+        elif tag in ("COMMIT", "ROLLBACK"):
+            self.status = IDLE
+
+    def fail(self, error: Exception):
+        if self.status == IN_TRANSACTION:
+            self.status = FAILED_TRANSACTION
+        if isinstance(error, PostgresError):
+            fields = {"S": "ERROR", "V": "ERROR", "C": "XX000", **error.fields}
+            self.buffer += message(
+                b"E",
+                b"".join(k.encode() + cstring(v) for k, v in fields.items()) + b"\0",
+            )
+            return
+        logger.exception("query failed", exc_info=error)
+        self.buffer += error_response(
+            str(error) or type(error).__name__, "XX000", "ERROR"
+        )
+
+    async def flush(self, writer: StreamWriter):
+        if self.buffer:
+            # the transport may keep what it is given, so it gets a copy and
+            # the buffer is reused
+            writer.write(bytes(self.buffer))
+            self.buffer.clear()
+        await writer.drain()
+
+
+process_ids = itertools.count(1)
+
+
+def parse_bind(payload: bytes) -> List[Optional[str]]:
+    (formats,) = struct.unpack_from("!H", payload)
+    if any(struct.unpack_from(f"!{formats}H", payload, 2)):
+        raise PostgresError({"C": "0A000", "M": "binary parameters are not supported"})
+    offset = 2 + 2 * formats
+    (count,) = struct.unpack_from("!H", payload, offset)
+    offset += 2
+    params: List[Optional[str]] = []
+    for _ in range(count):
+        (length,) = struct.unpack_from("!i", payload, offset)
+        offset += 4
+        if length < 0:
+            params.append(None)
+            continue
+        params.append(payload[offset : offset + length].decode())
+        offset += length
+    return params
+
+
+async def main():
+    async def query_handler(sql: str, params: List[Optional[str]]) -> Result:
+        # SELECT <n> streams n rows
+        count = int(sql.split()[-1]) if sql.split()[-1].isdigit() else 1
+
+        async def rows():
+            for i in range(count):
+                yield i, f"row {i}"
+
+        return Result(["id", "name"], rows())
+
+    async def describe_handler(sql: str) -> Columns:
+        return ["id", "name"]
+
+    host, port = "127.0.0.1", 5433
+    loop = asyncio.get_event_loop()
+    server = await loop.create_server(
+        lambda: PostgresServerProtocol(
+            query_handler, describe_handler=describe_handler
+        ),
+        host,
+        port,
+    )
+
+    logger.info(f"Serving on {host}:{port}")
+
+    async with server:
+        await server.serve_forever()
+
+
+if __name__ == "__main__":
+    logging.basicConfig()
+    logger.setLevel(logging.DEBUG)
+    asyncio.run(main())
@@ -0,0 +1,645 @@
+import asyncio
+import struct
+import unittest
+from typing import List, cast
+
+from protocols.postgres.auth import ScramClient, login
+from protocols.postgres.client import connect
+from protocols.postgres.messages import (
+    AUTH_MD5_PASSWORD,
+    IDLE,
+    IN_TRANSACTION,
+    MessageScanner,
+    PostgresError,
+    OID_INT4,
+    cancel_request,
+    command_complete,
+    data_row,
+    message,
+    parse_error_response,
+    query,
+    read_message,
+    ready_for_query,
+    startup_message,
+)
+from protocols.postgres.pooler import PoolMode, Pooler, PostgresPoolerProtocol
+from protocols.postgres.server import PostgresServerProtocol, Result
+from protocols.tests.fake_postgres import FakePostgres
+
+
+async def simple_query(reader, writer, sql):
+    writer.write(query(sql))
+    rows = []
+    while True:
+        message_type, payload = await read_message(reader)
+        if message_type == b"D":
+            (length,) = struct.unpack_from("!i", payload, 2)
+            rows.append(payload[6 : 6 + length].decode())
+        elif message_type == b"E":
+            rows.append(parse_error_response(payload)["C"])
+        elif message_type == b"Z":
+            return rows, payload
+
+
+class TestMessages(unittest.TestCase):
+    def test_scanner(self):
+        stream = (
+            command_complete("BEGIN")
+            + ready_for_query(IN_TRANSACTION)
+            + data_row([b"1", None])
+            + ready_for_query(IDLE)
+        )
+        for size in [1, 3, 5, 7, len(stream)]:
+            scanner = MessageScanner()
+            statuses = []
+            for i in range(0, len(stream), size):
+                statuses += scanner.feed(stream[i : i + size])
+            self.assertEqual([IN_TRANSACTION, IDLE], statuses)
+            self.assertTrue(scanner.at_boundary)
+
+    def test_scram(self):
+        # https://datatracker.ietf.org/doc/html/rfc7677#section-3
+        scram = ScramClient("pencil", "user", "rOprNGfwEbeRWgbNEkqO")
+        self.assertEqual(b"n,,n=user,r=rOprNGfwEbeRWgbNEkqO", scram.client_first())
+        final = scram.client_final(
+            b"r=rOprNGfwEbeRWgbNEkqO%hvYDpWUa2RaTCAfuxFIlj)hNlF$k0,"
+            b"s=W22ZaJ0SNY7soEsUEjb6gQ==,i=4096"
+        )
+        self.assertEqual(
+            b"c=biws,r=rOprNGfwEbeRWgbNEkqO%hvYDpWUa2RaTCAfuxFIlj)hNlF$k0,"
+            b"p=dHzbZapWIk4jUhN+Ute9ytag9zjfMHgsqmmiz7AndVQ=",
+            final,
+        )
+        scram.verify(b"v=6rriTRBi23WpRR/wtup+mMhUZUn/dB5nLTJRsjl95G4=")
+        with self.assertRaises(ValueError):
+            scram.verify(b"v=AAAA")
+
+
+class TestPooler(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.backend = FakePostgres()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_pooler(self, test, **kwargs):
+        async def run():
+            backend = await self.loop.create_server(self.backend, "127.0.0.1", 0)
+            pooler = Pooler("127.0.0.1", backend.sockets[0].getsockname()[1], **kwargs)
+            proxy = await self.loop.create_server(
+                lambda: PostgresPoolerProtocol(pooler), "127.0.0.1", 0
+            )
+            port = proxy.sockets[0].getsockname()[1]
+            try:
+                await test(pooler, port)
+            finally:
+                await asyncio.sleep(0.1)
+                pooler.close()
+                await asyncio.sleep(0.1)
+                proxy.close()
+                backend.close()
+
+        self.loop.run_until_complete(run())
+
+    async def connect(self, port, user="app", database="db", password=None):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        try:
+            session = await login(reader, writer, user, database, password)
+        except PostgresError:
+            writer.close()
+            raise
+        return reader, writer, session
+
+    def test_transaction_mode(self):
+        async def test(pooler, port):
+            clients = [await self.connect(port) for _ in range(10)]
+            self.assertEqual("16.0", clients[0][2].parameters["server_version"])
+            for _ in range(3):
+                results = await asyncio.gather(
+                    *[
+                        simple_query(reader, writer, "SELECT pg_backend_pid()")
+                        for reader, writer, _ in clients
+                    ]
+                )
+                for rows, status in results:
+                    self.assertEqual(IDLE, status)
+                    self.assertIn(rows[0], ["1000", "1001"])
+            self.assertEqual(2, self.backend.connections)
+
+            metrics = pooler.metrics()["db/app"]
+            self.assertEqual(2, metrics["size"])
+            self.assertEqual(0, metrics["active"])
+            # once on login, then for each query
+            self.assertEqual(40, metrics["acquired"])
+            for _, writer, _ in clients:
+                writer.close()
+
+        self.run_pooler(test, pool_size=2)
+
+    def test_wait_queue(self):
+        async def test(pooler, port):
+            reader, writer, _ = await self.connect(port)
+            other_reader, other_writer, _ = await self.connect(port)
+
+            self.assertEqual(
+                ([], IN_TRANSACTION), await simple_query(reader, writer, "BEGIN")
+            )
+            waiting = asyncio.ensure_future(
+                simple_query(other_reader, other_writer, "SELECT 2")
+            )
+            await asyncio.sleep(0.1)
+            metrics = pooler.metrics()["db/app"]
+            self.assertEqual((1, 1), (metrics["active"], metrics["waiting"]))
+            self.assertFalse(waiting.done())
+
+            # the backend is still ours inside the transaction
+            self.assertEqual(
+                (["1000"], IN_TRANSACTION),
+                await simple_query(reader, writer, "SELECT pg_backend_pid()"),
+            )
+            self.assertEqual(([], IDLE), await simple_query(reader, writer, "COMMIT"))
+            self.assertEqual((["2"], IDLE), await waiting)
+
+            metrics = pooler.metrics()["db/app"]
+            self.assertEqual((0, 0), (metrics["active"], metrics["waiting"]))
+            self.assertEqual(1, metrics["waited"])
+            self.assertGreaterEqual(metrics["max_wait"], 0.1)
+            writer.close()
+            other_writer.close()
+
+        self.run_pooler(test, pool_size=1)
+
+    def test_extended_batch_keeps_the_backend(self):
+        def statement(sql):
+            return (
+                message(b"P", b"\0" + sql.encode() + b"\0\0\0")
+                + message(b"B", b"\0\0" + bytes(6))
+                + message(b"E", b"\0" + bytes(4))
+            )
+
+        async def test(pooler, port):
+            reader, writer, _ = await self.connect(port)
+            # a synced batch, then the next one before its Sync
+            writer.write(statement("SELECT 1") + message(b"S") + statement("SELECT 2"))
+            while (await read_message(reader))[0] != b"Z":
+                pass
+            await asyncio.sleep(0.1)
+            self.assertEqual(1, pooler.metrics()["db/app"]["active"])
+
+            writer.write(message(b"S"))
+            rows = []
+            while (message_type := (await read_message(reader))[0]) != b"Z":
+                rows.append(message_type)
+            self.assertIn(b"D", rows)
+            await asyncio.sleep(0.1)
+            self.assertEqual(0, pooler.metrics()["db/app"]["active"])
+            writer.close()
+
+        self.run_pooler(test, pool_size=1)
+
+    def test_wait_timeout(self):
+        async def test(pooler, port):
+            reader, writer, _ = await self.connect(port)
+            other_reader, other_writer, _ = await self.connect(port)
+            await simple_query(reader, writer, "BEGIN")
+            other_writer.write(query("SELECT 1"))
+            message_type, payload = await read_message(other_reader)
+            self.assertEqual(b"E", message_type)
+            self.assertEqual("query_wait_timeout", parse_error_response(payload)["M"])
+            self.assertEqual(b"", await other_reader.read())
+            self.assertEqual(1, pooler.metrics()["db/app"]["wait_timeouts"])
+            writer.close()
+            other_writer.close()
+
+        self.run_pooler(test, pool_size=1, wait_timeout=0.1)
+
+    def test_session_mode(self):
+        async def test(pooler, port):
+            for _ in range(2):
+                reader, writer, _ = await self.connect(port)
+                for _ in range(2):
+                    rows, _ = await simple_query(
+                        reader, writer, "SELECT pg_backend_pid()"
+                    )
+                    self.assertEqual(["1000"], rows)
+                writer.write(message(b"X"))
+                await asyncio.sleep(0.1)
+                writer.close()
+            self.assertEqual(1, self.backend.connections)
+            self.assertEqual(2, self.backend.queries.count("DISCARD ALL"))
+
+        self.run_pooler(test, mode=PoolMode.SESSION)
+
+    def test_pool_limits_and_auth(self):
+        self.backend = FakePostgres(AUTH_MD5_PASSWORD, "secret")
+        users = {"app": "secret", "report": "secret"}
+
+        async def test(pooler, port):
+            with self.assertRaises(PostgresError) as context:
+                await self.connect(port, password="wrong")
+            self.assertEqual("28P01", context.exception.code)
+
+            clients = [
+                await self.connect(port, user, password="secret")
+                for user in ["app"] * 3 + ["report"] * 3
+            ]
+            queries = [
+                asyncio.ensure_future(simple_query(reader, writer, sql))
+                for (reader, writer, _), sql in zip(
+                    clients, ["BEGIN"] * 4 + ["SELECT 1"] * 2
+                )
+            ]
+            await asyncio.sleep(0.1)
+            metrics = pooler.metrics()
+            self.assertEqual(3, metrics["db/app"]["active"])
+            self.assertEqual(1, metrics["db/report"]["active"])
+            self.assertEqual(2, metrics["db/report"]["waiting"])
+
+            reader, writer, _ = clients[3]
+            await simple_query(reader, writer, "COMMIT")
+            await asyncio.gather(*queries)
+            self.assertEqual(1, pooler.metrics()["db/report"]["size"])
+            for _, writer, _ in clients:
+                writer.close()
+
+        self.run_pooler(
+            test,
+            on_auth=lambda user, password: users.get(user) == password,
+            pool_sizes={("db", "report"): 1},
+        )
+
+    def test_cancel(self):
+        async def test(pooler, port):
+            reader, writer, session = await self.connect(port)
+            await simple_query(reader, writer, "BEGIN")
+            _, cancel_writer = await asyncio.open_connection("127.0.0.1", port)
+            cancel_writer.write(cancel_request(session.process_id, session.secret_key))
+            await asyncio.sleep(0.1)
+            self.assertEqual([(1000, 7000)], self.backend.cancelled)
+            cancel_writer.close()
+            writer.close()
+
+        self.run_pooler(test)
+
+
+class TestClient(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.backend = FakePostgres()
+
+    def tearDown(self):
+        self.loop.close()
+
+    def run_client(self, test, pooler=False, **kwargs):
+        async def run():
+            backend = await self.loop.create_server(self.backend, "127.0.0.1", 0)
+            port = backend.sockets[0].getsockname()[1]
+            servers = [backend]
+            if pooler:
+                backend_pooler = Pooler("127.0.0.1", port)
+                proxy = await self.loop.create_server(
+                    lambda: PostgresPoolerProtocol(backend_pooler),
+                    "127.0.0.1",
+                    0,
+                )
+                servers.append(proxy)
+                port = proxy.sockets[0].getsockname()[1]
+            connection = await connect("127.0.0.1", port, "app", **kwargs)
+            try:
+                await test(connection)
+            finally:
+                await connection.close()
+                await asyncio.sleep(0.1)
+                if pooler:
+                    backend_pooler.close()
+                    await asyncio.sleep(0.1)
+                for server in servers:
+                    server.close()
+
+        self.loop.run_until_complete(run())
+
+    def test_fetch(self):
+        async def test(connection):
+            row = await connection.fetchrow("SELECT 1, 'a', NULL, $1", "x")
+            self.assertEqual((1, "a", None, "x"), tuple(row))
+            self.assertEqual(b"a", bytes(row.raw(1)))
+            row = await connection.fetchrow("SELECT 1, 'a', NULL, $1", None)
+            self.assertIsNone(row[3])
+            row = await connection.fetchrow("SELECT pg_backend_pid()")
+            self.assertEqual(1000, row["pg_backend_pid"])
+
+            rows = await connection.fetch("SELECT generate_series(1, 100000)")
+            self.assertEqual(100000, len(rows))
+            self.assertEqual(5000050000, sum(row["generate_series"] for row in rows))
+            self.assertEqual("BEGIN", await connection.execute("BEGIN"))
+            self.assertEqual(b"T", connection.status)
+
+            # prepared once each
+            self.assertEqual(4, len(connection.statements))
+            self.assertEqual(4, len(self.backend.sessions[0].statements))
+
+        self.run_client(test)
+
+    def test_errors(self):
+        async def test(connection):
+            with self.assertRaises(PostgresError) as context:
+                await connection.fetch("SELECT missing")
+            self.assertEqual("42703", context.exception.code)
+            # a statement that failed to prepare is not cached
+            self.assertEqual(0, len(connection.statements))
+            self.assertEqual(
+                [(1,)], [tuple(row) for row in await connection.fetch("SELECT 1")]
+            )
+
+        self.run_client(test)
+
+    def test_pipeline(self):
+        async def test(connection):
+            async with connection.pipeline() as pipeline:
+                results = [pipeline.fetch("SELECT $1", i) for i in range(1000)]
+            self.assertEqual(
+                [str(i) for i in range(1000)],
+                [(await result)[0][0] for result in results],
+            )
+            self.assertEqual(1, len(connection.statements))
+
+            # the first error fails the rest of the batch
+            pipeline = connection.pipeline()
+            first = pipeline.execute("BEGIN")
+            failed = pipeline.execute("FAIL")
+            skipped = pipeline.fetch("SELECT 2")
+            with self.assertRaises(PostgresError):
+                await pipeline.sync()
+            self.assertEqual("BEGIN", await first)
+            with self.assertRaises(PostgresError) as context:
+                await failed
+            self.assertEqual("P0001", context.exception.code)
+            with self.assertRaises(PostgresError):
+                await skipped
+            self.assertEqual(b"E", connection.status)
+            self.assertEqual("ROLLBACK", await connection.execute("ROLLBACK"))
+
+            # concurrent calls are pipelined as well
+            values = await asyncio.gather(
+                *[connection.fetchrow("SELECT $1", i) for i in range(100)]
+            )
+            self.assertEqual([str(i) for i in range(100)], [row[0] for row in values])
+
+        self.run_client(test)
+
+    def test_statement_cache(self):
+        async def test(connection):
+            for sql in ["SELECT 1", "SELECT 2", "SELECT 3", "SELECT 1"]:
+                await connection.fetch(sql)
+            self.assertEqual(["SELECT 3", "SELECT 1"], list(connection.statements))
+            self.assertEqual(2, len(self.backend.sessions[0].statements))
+
+        self.run_client(test, statement_cache_size=2)
+
+    def test_copy(self):
+        lines = [f"{i}\tline {i}\n".encode() for i in range(10000)]
+
+        async def source():
+            for i in range(0, len(lines), 100):
+                yield b"".join(lines[i : i + 100])
+
+        async def test(connection):
+            self.assertEqual(
+                "COPY 10000", await connection.copy_in("COPY t FROM STDIN", source())
+            )
+            chunks = [
+                bytes(chunk)
+                async for chunk in connection.copy_out("COPY t TO STDOUT", max_chunks=4)
+            ]
+            self.assertEqual(lines, chunks)
+
+            # stopping early leaves the connection usable
+            async for chunk in connection.copy_out("COPY t TO STDOUT", max_chunks=4):
+                break
+            self.assertEqual(1, (await connection.fetchrow("SELECT 1"))[0])
+
+            # also once the whole COPY is in, with the reader waiting for room
+            await connection.copy_in("COPY small FROM STDIN", lines[:3])
+            copy = connection.copy_out("COPY small TO STDOUT", max_chunks=2)
+            async for chunk in copy:
+                await asyncio.sleep(0.1)
+                break
+            await copy.aclose()
+            row = await asyncio.wait_for(connection.fetchrow("SELECT 1"), 5)
+            self.assertEqual(1, row[0])
+
+            # calls made during a COPY wait for it instead of interleaving
+            async def slow_source():
+                yield lines[0]
+                await asyncio.sleep(0.1)
+                yield lines[1]
+
+            copied = asyncio.ensure_future(
+                connection.copy_in("COPY small FROM STDIN", slow_source())
+            )
+            await asyncio.sleep(0.05)
+            row = await asyncio.wait_for(connection.fetchrow("SELECT 1"), 5)
+            self.assertTrue(copied.done())
+            self.assertEqual("COPY 2", copied.result())
+            self.assertEqual(1, row[0])
+            copy = connection.copy_out("COPY small TO STDOUT")
+            self.assertEqual(lines[0], bytes(await copy.__anext__()))
+            with self.assertRaises(RuntimeError):
+                connection.pipeline().execute("SELECT 1")
+            await copy.aclose()
+
+            # a failing source aborts the COPY
+            with self.assertRaises(TypeError):
+                await connection.copy_in("COPY t FROM STDIN", [b"1\n", 2])
+            self.assertEqual(b"I", connection.status)
+            self.assertEqual(1, (await connection.fetchrow("SELECT 1"))[0])
+
+        self.run_client(test)
+
+    def test_through_pooler(self):
+        async def test(connection):
+            async with connection.pipeline() as pipeline:
+                pipeline.execute("BEGIN")
+                pid = pipeline.fetch("SELECT pg_backend_pid()")
+                pipeline.execute("COMMIT")
+            self.assertEqual(1000, (await pid)[0][0])
+            self.assertEqual((2,), tuple(await connection.fetchrow("SELECT 2")))
+
+        self.run_client(test, pooler=True)
+
+
+class TestServer(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        # rows handed out by the query handler so far
+        self.produced = 0
+        self.queries = []
+
+    def tearDown(self):
+        self.loop.close()
+
+    async def query_handler(self, sql, params):
+        self.queries.append(sql)
+        words = sql.split()
+        if words[0] == "FAIL":
+            raise PostgresError({"C": "P0001", "M": "failed"})
+        if words[0] == "CRASH":
+            raise ValueError("crashed")
+        if words[0] != "SELECT":
+            return Result()
+        if words[1] == "$1":
+            return Result(["value", ("count", OID_INT4)], [(params[0], 1)])
+
+        async def rows():
+            for i in range(int(words[1])):
+                self.produced += 1
+                yield (i, None if i % 2 else "x" * 10)
+
+        return Result([("i", OID_INT4), "text"], rows())
+
+    async def describe_handler(self, sql):
+        words = sql.split()
+        if words[0] != "SELECT":
+            return []
+        if words[1] == "$1":
+            return ["value", ("count", OID_INT4)]
+        return [("i", OID_INT4), "text"]
+
+    def run_server(self, test, **kwargs):
+        kwargs.setdefault("describe_handler", self.describe_handler)
+
+        async def run():
+            server = await self.loop.create_server(
+                lambda: PostgresServerProtocol(self.query_handler, **kwargs),
+                "127.0.0.1",
+                0,
+            )
+            try:
+                await test(server.sockets[0].getsockname()[1])
+            finally:
+                await asyncio.sleep(0.1)
+                server.close()
+
+        self.loop.run_until_complete(run())
+
+    def test_client(self):
+        async def test(port):
+            connection = await connect("127.0.0.1", port, "app")
+            try:
+                rows = await connection.fetch("SELECT $1", "a")
+                self.assertEqual([("a", 1)], [tuple(row) for row in rows])
+                self.assertEqual(1, rows[0]["count"])
+
+                rows = await connection.fetch("SELECT 200000")
+                self.assertEqual(200000, len(rows))
+                self.assertEqual((199999, None), tuple(rows[-1]))
+                self.assertEqual("x" * 10, rows[-2]["text"])
+
+                with self.assertRaises(PostgresError) as context:
+                    await connection.fetch("FAIL")
+                self.assertEqual("P0001", context.exception.code)
+                with self.assertRaises(PostgresError) as context:
+                    await connection.fetch("CRASH")
+                self.assertEqual("XX000", context.exception.code)
+
+                self.assertEqual("BEGIN", await connection.execute("BEGIN"))
+                self.assertEqual(b"T", connection.status)
+                with self.assertRaises(PostgresError):
+                    await connection.execute("FAIL")
+                self.assertEqual(b"E", connection.status)
+                self.assertEqual("ROLLBACK", await connection.execute("ROLLBACK"))
+                self.assertEqual(b"I", connection.status)
+            finally:
+                await connection.close()
+
+        with self.assertLogs("protocols.postgres.server"):
+            self.run_server(test)
+
+    def test_describe_does_not_run_the_query(self):
+        async def test(port):
+            connection = await connect("127.0.0.1", port, "app")
+            rows = await connection.fetch("SELECT $1", "a")
+            self.assertEqual([("a", 1)], [tuple(row) for row in rows])
+            self.assertEqual(3, len(await connection.fetch("SELECT 3")))
+            await connection.close()
+
+        self.run_server(test)
+        self.assertEqual(["SELECT $1", "SELECT 3"], self.queries)
+
+        async def test_no_data(port):
+            # without a describe handler, a statement returns no data
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            await login(reader, writer, "app", "db")
+            writer.write(
+                message(b"P", b"s\0SELECT 3\0\0\0")
+                + message(b"D", b"Ss\0")
+                + message(b"S")
+            )
+            replies = []
+            while (message_type := (await read_message(reader))[0]) != b"Z":
+                replies.append(message_type)
+            self.assertEqual([b"1", b"t", b"n"], replies)
+            writer.close()
+
+        self.run_server(test_no_data, describe_handler=None)
+        self.assertEqual(["SELECT $1", "SELECT 3"], self.queries)
+
+    def test_simple_query_and_auth(self):
+        async def test(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(startup_message({"user": "app"}))
+            self.assertEqual(b"R", (await read_message(reader))[0])
+            writer.write(message(b"p", b"wrong\0"))
+            self.assertEqual(b"E", (await read_message(reader))[0])
+            writer.close()
+
+            connection = await connect("127.0.0.1", port, "app", password="secret")
+            reader, writer = connection.reader, connection.writer
+            rows, status = await simple_query(reader, writer, "SELECT 3")
+            self.assertEqual(["0", "1", "2"], rows)
+            self.assertEqual(IDLE, status)
+            rows, status = await simple_query(reader, writer, "FAIL")
+            self.assertEqual(["P0001"], rows)
+            await connection.close()
+
+        self.run_server(test, on_auth=lambda user, password: password == "secret")
+
+    def test_portal_suspended(self):
+        async def test(port):
+            connection = await connect("127.0.0.1", port, "app")
+            reader, writer = connection.reader, connection.writer
+            writer.write(
+                message(b"P", b"\0SELECT 5\0\0\0")
+                + message(b"B", b"\0\0" + struct.pack("!HHH", 0, 0, 0))
+                + message(b"E", b"\0" + struct.pack("!I", 2))
+                + message(b"E", b"\0" + struct.pack("!I", 2))
+                + message(b"E", b"\0" + struct.pack("!I", 2))
+                + message(b"S")
+            )
+            types: List[bytes] = []
+            while not types or types[-1] != b"Z":
+                types.append((await read_message(reader))[0])
+            self.assertEqual(b"12DDsDDsDCZ", b"".join(types))
+            await connection.close()
+
+        self.run_server(test)
+
+    def test_backpressure(self):
+        async def test(port):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            cast(asyncio.Transport, writer.transport).pause_reading()
+            writer.write(startup_message({"user": "app"}) + query("SELECT 10000000"))
+            await asyncio.sleep(0.5)
+            # the socket buffers and one batch, nowhere near ten million rows
+            self.assertLess(self.produced, 500000)
+            writer.close()
+
+        self.run_server(test)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,63 +1,142 @@
 import asyncio
 import logging
 from asyncio import StreamReader, StreamWriter
-from contextlib import closing
 from typing import Optional, Callable
 
-from protocols.forward import relay_stream
+from protocols.deadlines import CONNECT, Deadlines, PhaseTimeout, default_deadlines
+from protocols.dialer import open_connection
+from protocols.forward import closing_stream, relay_stream
+from protocols.memory import MemoryBudget
+from protocols.reverse_proxy.tls import BackendTLS
+from protocols.socket_options import SocketOptions
+from protocols.unix import create_unix_server, open_unix_connection
 
 logger = logging.getLogger(__name__)
 
 
 class ReverseProxyProtocol(asyncio.StreamReaderProtocol):
+    """
+    Relays every connection to one backend: ``target_host``:``target_port``,
+    or the unix socket ``target_path`` (``@name`` for an abstract one).
+    """
+
     def __init__(
         self,
-        target_host: str,
-        target_port: int,
+        target_host: str = "",
+        target_port: int = 0,
         on_accept: Optional[Callable[[str, int], bool]] = None,
+        tls: Optional[BackendTLS] = None,
+        socket_options: Optional[SocketOptions] = None,
+        memory_budget: Optional[MemoryBudget] = None,
+        deadlines: Optional[Deadlines] = None,
+        target_path: Optional[str] = None,
     ):
-        self.reader = StreamReader()
+        if tls and target_path:
+            raise ValueError("TLS is only originated towards TCP backends")
+        self.reader = (
+            StreamReader(limit=memory_budget.header_size)
+            if memory_budget
+            else StreamReader()
+        )
         super().__init__(self.reader, self.handler)
 
         self.on_accept = on_accept
         self.target_host = target_host
         self.target_port = target_port
+        self.target_path = target_path
+        self.tls = tls
+        self.socket_options = socket_options
+        self.memory_budget = memory_budget
+        self.deadlines = deadlines or default_deadlines()
 
     async def handler(self, reader: StreamReader, writer: StreamWriter):
-        with closing(writer):
-            await self._handler(reader, writer)
+        with closing_stream(writer):
+            try:
+                await self._handler(reader, writer)
+            except PhaseTimeout:
+                # counted by the deadlines, nothing else to report
+                pass
 
     async def _handler(self, reader: StreamReader, writer: StreamWriter) -> None:
+        if self.socket_options:
+            self.socket_options.apply(writer)
         addr = writer.get_extra_info("peername")
+        if not isinstance(addr, tuple):
+            # a unix socket client, which is usually unnamed
+            addr = ("", 0)
         if self.on_accept:
             if not self.on_accept(addr[0], addr[1]):
                 return
         await self.forward(reader, writer)
 
     async def forward(self, reader, writer):
-        remote_reader, remote_writer = await asyncio.open_connection(
-            self.target_host, self.target_port
+        if self.tls:
+            await self.forward_tls(reader, writer, self.tls)
+            return
+
+        async with self.deadlines.phase(CONNECT):
+            if self.target_path:
+                remote_reader, remote_writer = await open_unix_connection(
+                    self.target_path
+                )
+            else:
+                remote_reader, remote_writer = await open_connection(
+                    self.target_host,
+                    self.target_port,
+                    socket_options=self.socket_options,
+                )
+
+        await relay_stream(
+            (reader, writer),
+            (remote_reader, remote_writer),
+            budget=self.memory_budget,
+            deadlines=self.deadlines,
         )
 
-        await relay_stream((reader, writer), (remote_reader, remote_writer))
+    async def forward_tls(self, reader, writer, tls: BackendTLS):
+        async with self.deadlines.phase(CONNECT):
+            remote_reader, remote_writer = await tls.open_connection(
+                self.target_host, self.target_port, socket_options=self.socket_options
+            )
+        ssl_object = remote_writer.get_extra_info("ssl_object")
 
+        def on_close(sent: int, received: int):
+            tls.save_session(self.target_host, self.target_port, ssl_object)
+
+        await relay_stream(
+            (reader, writer),
+            (remote_reader, remote_writer),
+            on_close=on_close,
+            budget=self.memory_budget,
+            deadlines=self.deadlines,
+        )
 
-async def main():
-    host, port = "127.0.0.1", 8000
-    loop = asyncio.get_event_loop()
-    server = await loop.create_server(
-        lambda: ReverseProxyProtocol(target_host="1.1.1.1", target_port=80),
-        host,
-        port,
-    )
 
-    logger.info(f"Serving on {host}:{port}")
+async def main(listen_path: Optional[str] = None, target_path: Optional[str] = None):
+    def factory():
+        if target_path:
+            return ReverseProxyProtocol(target_path=target_path)
+        return ReverseProxyProtocol(target_host="1.1.1.1", target_port=80)
+
+    if listen_path:
+        server = await create_unix_server(factory, listen_path)
+        logger.info(f"Serving on {listen_path}")
+    else:
+        host, port = "127.0.0.1", 8000
+        server = await asyncio.get_running_loop().create_server(factory, host, port)
+        logger.info(f"Serving on {host}:{port}")
 
     async with server:
         await server.serve_forever()
 
 
 if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--listen-unix", help="listen on this unix socket")
+    parser.add_argument("--target-unix", help="relay to this unix socket")
+    args = parser.parse_args()
     logging.basicConfig()
     logger.setLevel(logging.DEBUG)
-    asyncio.run(main())
+    asyncio.run(main(args.listen_unix, args.target_unix))
@@ -1,12 +1,20 @@
 import asyncio
 import os.path
+import socket
+import tempfile
+import threading
 import unittest
 from unittest import mock
 
 import requests
 
+from protocols.multiloop import MultiLoopServer
 from protocols.reverse_proxy.server import ReverseProxyProtocol
+from protocols.reverse_proxy.tls import BackendTLS
+from protocols.socket_options import SocketOptions
 from protocols.stream_utils import create_stream_reader_from_file
+from protocols.tests.setup_http_server import SetupHttpServer
+from protocols.unix import create_unix_server, open_unix_connection
 
 
 def request_reverse_proxy():
@@ -88,13 +96,196 @@ class TestReverseServer(unittest.TestCase):
                 self.assertEqual(proxy_response_header, response.headers)
                 self.assertEqual(proxy_response_body, response.text)
 
-                self.assertEqual(2, len(w.method_calls))
-                self.assertEqual("write", w.method_calls[0][0])
-                self.assertEqual((proxy_request_header,), w.method_calls[0][1])
-                self.assertEqual("drain", w.method_calls[1][0])
+                # the relay closes the writer as soon as the origin hits EOF
+                calls = [call for call in w.method_calls if call[0] != "close"]
+                self.assertEqual(2, len(calls))
+                self.assertEqual("write", calls[0][0])
+                self.assertEqual((proxy_request_header,), calls[0][1])
+                self.assertEqual("drain", calls[1][0])
 
             self.loop.run_until_complete(test())
 
 
+class TestReverseServerTLS(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.tls = BackendTLS(verify=False)
+
+        async def test():
+            self.server = await self.loop.create_server(
+                lambda: ReverseProxyProtocol(
+                    target_host="127.0.0.1", target_port=8000, tls=self.tls
+                ),
+                "127.0.0.1",
+                8088,
+            )
+            self.server_task = self.loop.create_task(self.server.serve_forever())
+
+        self.loop.run_until_complete(test())
+
+    def tearDown(self):
+        async def stop_server():
+            self.server_task.cancel()
+            await self.server.wait_closed()
+
+        self.loop.run_until_complete(stop_server())
+        self.loop.close()
+
+    def test_session_resumption(self):
+        with SetupHttpServer(https=True):
+
+            async def wait_for_session():
+                while ("127.0.0.1", 8000) not in self.tls.sessions:
+                    await asyncio.sleep(0.05)
+
+            async def test():
+                for _ in range(2):
+                    response = await self.loop.run_in_executor(
+                        None, request_reverse_proxy
+                    )
+                    self.assertEqual(200, response.status_code)
+                    self.assertEqual("Hello, World!", response.text)
+                    # the session is kept once the relay has finished
+                    await asyncio.wait_for(wait_for_session(), 5)
+
+            self.loop.run_until_complete(test())
+
+        self.assertEqual(1, self.tls.stats["full_handshakes"])
+        self.assertEqual(1, self.tls.stats["resumed_handshakes"])
+
+    def test_socket_options(self):
+        with SetupHttpServer(https=True):
+
+            async def test():
+                reader, writer = await self.tls.open_connection(
+                    "127.0.0.1",
+                    8000,
+                    socket_options=SocketOptions(keepalive=(60, 10, 3)),
+                )
+                sock = writer.get_extra_info("socket")
+                self.assertEqual(
+                    1, sock.getsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE)
+                )
+                self.assertIsNotNone(writer.get_extra_info("ssl_object"))
+                writer.close()
+                await writer.wait_closed()
+
+            self.loop.run_until_complete(test())
+
+
+class Echo(asyncio.Protocol):
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.transport.write(data)
+
+
+class TestReverseServerUnix(unittest.TestCase):
+    def test_unix_listener_and_backend(self):
+        loop = asyncio.new_event_loop()
+
+        async def test():
+            with tempfile.TemporaryDirectory() as directory:
+                backend_path = os.path.join(directory, "backend.sock")
+                backend = await create_unix_server(Echo, backend_path)
+                # abstract, nothing to clean up on the file system
+                listen_path = f"@protocols-test-{os.getpid()}"
+                proxy = await create_unix_server(
+                    lambda: ReverseProxyProtocol(target_path=backend_path),
+                    listen_path,
+                )
+                reader, writer = await open_unix_connection(listen_path)
+                writer.write(b"ping")
+                self.assertEqual(b"ping", await reader.readexactly(4))
+                self.assertFalse(os.path.exists(listen_path))
+
+                writer.close()
+                await asyncio.sleep(0.1)
+                for server in [proxy, backend]:
+                    server.close()
+                    await server.wait_closed()
+
+        loop.run_until_complete(test())
+        loop.close()
+
+
+class TestMultiLoopServer(unittest.TestCase):
+    def serve(self, acceptor: bool):
+        loop = asyncio.new_event_loop()
+        threads = set()
+
+        async def test():
+            echo = await loop.create_server(Echo, "127.0.0.1", 0)
+            echo_port = echo.sockets[0].getsockname()[1]
+
+            def make_factory():
+                def factory():
+                    threads.add(threading.get_ident())
+                    return ReverseProxyProtocol("127.0.0.1", echo_port)
+
+                return factory
+
+            server = MultiLoopServer(make_factory, loops=2, acceptor=acceptor)
+            server.start()
+            try:
+                for _ in range(4):
+                    reader, writer = await asyncio.open_connection(
+                        "127.0.0.1", server.port
+                    )
+                    writer.write(b"ping")
+                    self.assertEqual(b"ping", await reader.readexactly(4))
+                    writer.close()
+                await asyncio.sleep(0.1)
+            finally:
+                await loop.run_in_executor(None, server.stop)
+                echo.close()
+
+        loop.run_until_complete(test())
+        loop.close()
+        return threads
+
+    def test_reuse_port(self):
+        self.assertTrue(self.serve(acceptor=False))
+
+    def test_payloads_stay_per_connection(self):
+        loop = asyncio.new_event_loop()
+
+        async def round_trips(port: int, index: int):
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            payload = bytes([index]) * 256 * 1024
+            for _ in range(64):
+                writer.write(payload)
+                self.assertEqual(payload, await reader.readexactly(len(payload)))
+            writer.close()
+
+        async def test():
+            # each connection its own bytes, which a read buffer shared by
+            # the loop threads would mix up
+            backend = MultiLoopServer(lambda: Echo, loops=2)
+            backend.start()
+            server = MultiLoopServer(
+                lambda: lambda: ReverseProxyProtocol("127.0.0.1", backend.port),
+                loops=4,
+            )
+            server.start()
+            try:
+                await asyncio.gather(
+                    *(round_trips(server.port, index) for index in range(16))
+                )
+                await asyncio.sleep(0.1)
+            finally:
+                await loop.run_in_executor(None, server.stop)
+                await loop.run_in_executor(None, backend.stop)
+
+        loop.run_until_complete(test())
+        loop.close()
+
+    def test_acceptor(self):
+        # handed out in turn
+        self.assertEqual(2, len(self.serve(acceptor=True)))
+
+
 if __name__ == "__main__":
     unittest.main()
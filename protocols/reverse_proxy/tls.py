@@ -0,0 +1,116 @@
+import asyncio
+import ssl
+import threading
+from collections import Counter, OrderedDict
+from contextvars import ContextVar
+from typing import Optional, Tuple
+
+from protocols.dialer import open_tuned_connection
+from protocols.forward import StreamPair
+from protocols.socket_options import SocketOptions
+
+# The session to offer for the dial currently in progress. asyncio calls
+# ``wrap_bio`` from a callback scheduled inside the dialing task, so the value
+# set around ``open_connection`` is visible there without a per-dial context.
+_resume_session: ContextVar[Optional[ssl.SSLSession]] = ContextVar(
+    "_resume_session", default=None
+)
+
+
+class _ResumingSSLContext(ssl.SSLContext):
+    def wrap_bio(self, *args, **kwargs):
+        if kwargs.get("session") is None:
+            kwargs["session"] = _resume_session.get()
+        return super().wrap_bio(*args, **kwargs)
+
+
+class BackendTLS:
+    """
+    TLS origination towards backends.
+
+    One instance owns a single client ``SSLContext`` and should be shared by
+    every protocol instance of a server, so that sessions negotiated by one
+    connection are resumed by the next dial to the same backend.
+    """
+
+    def __init__(
+        self,
+        server_hostname: Optional[str] = None,
+        verify: bool = True,
+        check_hostname: bool = True,
+        cafile: Optional[str] = None,
+        certfile: Optional[str] = None,
+        keyfile: Optional[str] = None,
+        max_sessions: int = 1024,
+    ):
+        self.server_hostname = server_hostname
+        self.max_sessions = max_sessions
+
+        context = _ResumingSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        if verify:
+            context.check_hostname = check_hostname
+            if cafile:
+                context.load_verify_locations(cafile=cafile)
+            else:
+                context.load_default_certs(ssl.Purpose.SERVER_AUTH)
+        else:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+        if certfile:
+            context.load_cert_chain(certfile, keyfile)
+        self.context: ssl.SSLContext = context
+
+        self.sessions: "OrderedDict[Tuple[str, int], ssl.SSLSession]" = OrderedDict()
+        # for one instance shared by the loops of a MultiLoopServer
+        self.sessions_lock = threading.Lock()
+        self.stats: Counter = Counter()
+
+    async def open_connection(
+        self, host: str, port: int, socket_options: Optional[SocketOptions] = None
+    ) -> StreamPair:
+        key = (host, port)
+        with self.sessions_lock:
+            session = self.sessions.get(key)
+        token = _resume_session.set(session)
+        try:
+            if socket_options:
+                reader, writer = await open_tuned_connection(
+                    host,
+                    port,
+                    socket_options=socket_options,
+                    ssl_context=self.context,
+                    server_hostname=self.server_hostname,
+                )
+            else:
+                reader, writer = await asyncio.open_connection(
+                    host,
+                    port,
+                    ssl=self.context,
+                    server_hostname=self.server_hostname or host,
+                )
+        except ssl.SSLError:
+            self.stats["handshake_failures"] += 1
+            raise
+        finally:
+            _resume_session.reset(token)
+
+        ssl_object = writer.get_extra_info("ssl_object")
+        if ssl_object.session_reused:
+            self.stats["resumed_handshakes"] += 1
+        else:
+            self.stats["full_handshakes"] += 1
+        return reader, writer
+
+    def save_session(self, host: str, port: int, ssl_object: ssl.SSLObject):
+        # TLS 1.3 tickets arrive after the handshake, so the session is only
+        # worth keeping once the connection has carried some traffic.
+        session = ssl_object.session
+        if session is None or not (session.has_ticket or session.id):
+            return
+
+        key = (host, port)
+        with self.sessions_lock:
+            self.sessions[key] = session
+            self.sessions.move_to_end(key)
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
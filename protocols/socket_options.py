@@ -0,0 +1,139 @@
+import asyncio
+import socket
+from typing import Any, Callable, List, Optional, Tuple
+
+# not exported by the socket module; Linux 4.11+
+TCP_FASTOPEN_CONNECT = getattr(socket, "TCP_FASTOPEN_CONNECT", 30)
+
+
+def has_option(name: str) -> bool:
+    return hasattr(socket, name)
+
+
+class SocketOptions:
+    """
+    A socket tuning profile shared by listeners and upstream dials; an option
+    left at None keeps the system default.
+
+    asyncio already turns Nagle off (TCP_NODELAY) for every TCP transport, so
+    ``nodelay=False`` is the setting that changes something. ``keepalive`` is
+    (idle, interval, count) in seconds and probes. ``fastopen`` is the queue
+    length of pending TFO connections on listeners and enables TFO on dials.
+    TCP_QUICKACK is not sticky, the kernel drops back to delayed ACKs on its
+    own, so ``quickack`` only covers the start of a connection.
+
+    Options the platform lacks are skipped, so a profile can be shared
+    between Linux and elsewhere.
+    """
+
+    def __init__(
+        self,
+        nodelay: Optional[bool] = None,
+        keepalive: Optional[Tuple[int, int, int]] = None,
+        rcvbuf: Optional[int] = None,
+        sndbuf: Optional[int] = None,
+        fastopen: Optional[int] = None,
+        quickack: Optional[bool] = None,
+        notsent_lowat: Optional[int] = None,
+        backlog: int = 100,
+    ):
+        self.nodelay = nodelay
+        self.keepalive = keepalive
+        self.rcvbuf = rcvbuf
+        self.sndbuf = sndbuf
+        self.fastopen = fastopen
+        self.quickack = quickack
+        self.notsent_lowat = notsent_lowat
+        self.backlog = backlog
+
+    def connection_options(self) -> List[Tuple[int, int, int]]:
+        options = []
+        if self.nodelay is not None:
+            options.append((socket.IPPROTO_TCP, socket.TCP_NODELAY, int(self.nodelay)))
+        if self.keepalive is not None:
+            options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+            for name, value in zip(
+                ("TCP_KEEPIDLE", "TCP_KEEPINTVL", "TCP_KEEPCNT"), self.keepalive
+            ):
+                if has_option(name):
+                    options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+        if self.rcvbuf is not None:
+            options.append((socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf))
+        if self.sndbuf is not None:
+            options.append((socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf))
+        if self.quickack is not None and has_option("TCP_QUICKACK"):
+            options.append(
+                (socket.IPPROTO_TCP, socket.TCP_QUICKACK, int(self.quickack))
+            )
+        if self.notsent_lowat is not None and has_option("TCP_NOTSENT_LOWAT"):
+            options.append(
+                (socket.IPPROTO_TCP, socket.TCP_NOTSENT_LOWAT, self.notsent_lowat)
+            )
+        return options
+
+    def apply(self, sock: Any):
+        """
+        Sets the per connection options on a socket, or on the transport
+        socket of an accepted ``StreamWriter``.
+        """
+        if isinstance(sock, asyncio.StreamWriter):
+            sock = sock.get_extra_info("socket")
+        if sock is None or sock.family not in (socket.AF_INET, socket.AF_INET6):
+            return
+        for level, option, value in self.connection_options():
+            sock.setsockopt(level, option, value)
+
+    def apply_listener(self, sock: Any):
+        # buffer sizes are inherited by accepted sockets, and the receive
+        # buffer has to be known before the SYN-ACK to pick the window scale
+        if self.rcvbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.rcvbuf)
+        if self.sndbuf is not None:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, self.sndbuf)
+        if self.fastopen is not None and has_option("TCP_FASTOPEN"):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_FASTOPEN, self.fastopen)
+
+    async def create_server(
+        self,
+        protocol_factory: Callable[[], asyncio.BaseProtocol],
+        host: Optional[str] = None,
+        port: int = 0,
+        **kwargs,
+    ) -> asyncio.Server:
+        """
+        ``loop.create_server`` with the listener options set before listen().
+        """
+        server = await asyncio.get_running_loop().create_server(
+            protocol_factory,
+            host,
+            port,
+            backlog=self.backlog,
+            start_serving=False,
+            **kwargs,
+        )
+        for sock in server.sockets:
+            self.apply_listener(sock)
+        await server.start_serving()
+        return server
+
+    async def connect(self, address: Tuple[Any, ...], family: int) -> socket.socket:
+        """
+        A connected non-blocking socket with the options set before the
+        handshake, ready for ``asyncio.open_connection(sock=...)``.
+        """
+        loop = asyncio.get_running_loop()
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        try:
+            sock.setblocking(False)
+            for level, option, value in self.connection_options():
+                sock.setsockopt(level, option, value)
+            if self.fastopen is not None:
+                try:
+                    sock.setsockopt(socket.IPPROTO_TCP, TCP_FASTOPEN_CONNECT, 1)
+                except OSError:
+                    pass
+            await loop.sock_connect(sock, address)
+        except BaseException:
+            sock.close()
+            raise
+        return sock
@@ -0,0 +1,109 @@
+import asyncio
+import struct
+from asyncio import StreamReader, StreamWriter
+from typing import Optional, Tuple
+
+from protocols.dialer import DestinationError, ProxyError
+from protocols.forward import StreamPair
+from protocols.socks5_server.consts import (
+    AUTH_SUB_VERSION,
+    AUTH_SUCCESS,
+    SOCKS5_VERSION,
+    AuthenticationMethod,
+    Command,
+    ResponseCode,
+)
+from protocols.socks5_server.utils import (
+    pack_address_port,
+    unpack_address_port,
+    unpack_data,
+)
+
+
+# the replies about the destination rather than the proxy
+DESTINATION_REPLIES = {
+    ResponseCode.CONNECTION_NOT_ALLOWED,
+    ResponseCode.NETWORK_UNREACHABLE,
+    ResponseCode.HOST_UNREACHABLE,
+    ResponseCode.CONNECTION_REFUSED,
+    ResponseCode.TTL_EXPIRED,
+}
+
+
+def reply_error(code: ResponseCode) -> ConnectionError:
+    if code in DESTINATION_REPLIES:
+        return DestinationError(f"SOCKS5 {code.name}")
+    return ProxyError(f"SOCKS5 {code.name}")
+
+
+async def socks5_handshake(
+    reader: StreamReader,
+    writer: StreamWriter,
+    host: str,
+    port: int,
+    username: Optional[str] = None,
+    password: Optional[str] = None,
+) -> Tuple[str, int]:
+    """
+    CONNECT to host:port through an already connected SOCKS5 proxy and
+    return the address the proxy bound for it.
+
+    Only one method is offered, so the proxy can only pick it or refuse:
+    greeting, credentials and request go out in a single write and the
+    replies are read in order, one round trip instead of two or three.
+    Raises ``DestinationError`` for the proxy's answer about host:port and
+    ``ProxyError`` when the proxy itself fails.
+    """
+    # https://datatracker.ietf.org/doc/html/rfc1928
+    method = (
+        AuthenticationMethod.NO_AUTHENTICATION_REQUIRED
+        if username is None
+        else AuthenticationMethod.USERNAME_PASSWORD
+    )
+    data = struct.pack("!BBB", SOCKS5_VERSION, 1, method.value)
+    if method == AuthenticationMethod.USERNAME_PASSWORD:
+        # https://datatracker.ietf.org/doc/html/rfc1929
+        b_username = (username or "").encode()
+        b_password = (password or "").encode()
+        data += (
+            struct.pack("!BB", AUTH_SUB_VERSION, len(b_username))
+            + b_username
+            + struct.pack("!B", len(b_password))
+            + b_password
+        )
+    writer.write(
+        data
+        + struct.pack("!BBB", SOCKS5_VERSION, Command.CONNECT.value, 0x00)
+        + pack_address_port(host, port)
+    )
+
+    version, selected = unpack_data(await reader.readexactly(2), "!BB")
+    if selected != method.value:
+        raise ProxyError("SOCKS5 no acceptable authentication method")
+    if method == AuthenticationMethod.USERNAME_PASSWORD:
+        _, status = unpack_data(await reader.readexactly(2), "!BB")
+        if status != AUTH_SUCCESS:
+            raise ProxyError("SOCKS5 authentication failed")
+
+    version, code, _ = unpack_data(await reader.readexactly(3), "!BBB")
+    _, bind_addr, bind_port = await unpack_address_port(reader)
+    if code != ResponseCode.SUCCEEDED.value:
+        raise reply_error(ResponseCode(code))
+    return bind_addr, bind_port
+
+
+async def open_socks5_connection(
+    proxy_host: str,
+    proxy_port: int,
+    host: str,
+    port: int,
+    username: Optional[str] = None,
+    password: Optional[str] = None,
+) -> StreamPair:
+    reader, writer = await asyncio.open_connection(proxy_host, proxy_port)
+    try:
+        await socks5_handshake(reader, writer, host, port, username, password)
+    except BaseException:
+        writer.close()
+        raise
+    return reader, writer
@@ -1,10 +1,17 @@
 import asyncio
 import struct
 from asyncio import StreamReader, StreamWriter, BaseTransport
-from contextlib import closing
 from typing import Optional, Coroutine, Any, Callable
 
-from protocols.forward import relay_stream
+from protocols.access_log import AccessLog
+from protocols.circuit_breaker import CircuitBreakers, CircuitOpen
+from protocols.deadlines import AUTH, HANDSHAKE, Deadlines, default_deadlines
+from protocols.dialer import Dialer, ProxyError
+from protocols.flight_recorder import FlightRecorder
+from protocols.forward import closing_stream
+from protocols.memory import MemoryBudget
+from protocols.observer import ObservedProtocol
+from protocols.socket_options import SocketOptions
 from protocols.socks5_server.consts import (
     SOCKS5_VERSION,
     AuthenticationMethod,
@@ -21,35 +28,61 @@ from protocols.socks5_server.utils import (
     unpack_address_port,
     generate_response,
 )
+from protocols.tracing import Phase, Tracer
 
 
-class Socks5ProxyServerProtocol(asyncio.StreamReaderProtocol):
+class Socks5ProxyServerProtocol(ObservedProtocol, asyncio.StreamReaderProtocol):
+    name = "socks5"
+    # only set for UDP ASSOCIATE, so plain tunnels don't carry them
+    udp_server_task: Optional[
+        Coroutine[Any, Any, tuple[BaseTransport, UDPForwardingServer]]
+    ] = None
+    udp_server: Optional[UDPForwardingServer] = None
+
     def __init__(
         self,
         on_accept: Optional[Callable[[str, int], bool]] = None,
         on_auth=Optional[Callable[[str, str], bool]],
         on_connect=Optional[Callable[[str, int], bool]],
+        dialer: Optional[Dialer] = None,
+        tracer: Optional[Tracer] = None,
+        flight_recorder: Optional[FlightRecorder] = None,
+        socket_options: Optional[SocketOptions] = None,
+        access_log: Optional[AccessLog] = None,
+        memory_budget: Optional[MemoryBudget] = None,
+        deadlines: Optional[Deadlines] = None,
+        early_reply: bool = False,
+        circuit_breakers: Optional[CircuitBreakers] = None,
     ):
-        self.reader = StreamReader()
+        self.reader = (
+            StreamReader(limit=memory_budget.header_size)
+            if memory_budget
+            else StreamReader()
+        )
         super().__init__(self.reader, self.handler)
 
         self.on_accept = on_accept
         self.on_auth = on_auth
         self.on_connect = on_connect
+        self.dialer = dialer
+        self.tracer = tracer
+        self.flight_recorder = flight_recorder
+        self.socket_options = socket_options
+        self.access_log = access_log
+        self.memory_budget = memory_budget
+        self.deadlines = deadlines or default_deadlines()
+        self.early_reply = early_reply
+        self.circuit_breakers = circuit_breakers
 
         self.allow_method = AuthenticationMethod.NO_AUTHENTICATION_REQUIRED
         assert self.allow_method in [
             AuthenticationMethod.NO_AUTHENTICATION_REQUIRED,
             AuthenticationMethod.USERNAME_PASSWORD,
         ]
-        self.udp_server_task: Optional[
-            Coroutine[Any, Any, tuple[BaseTransport, UDPForwardingServer]]
-        ] = None
-        self.udp_server: Optional[UDPForwardingServer] = None
 
     async def handler(self, reader: StreamReader, writer: StreamWriter):
-        with closing(writer):
-            await self._handler(reader, writer)
+        with closing_stream(writer):
+            await self.observe(self._handler(reader, writer), writer)
 
     def connection_lost(self, exc: Optional[Exception]) -> None:
         super().connection_lost(exc)
@@ -66,9 +99,14 @@ class Socks5ProxyServerProtocol(asyncio.StreamReaderProtocol):
         addr = writer.get_extra_info("peername")
         if self.on_accept:
             if not self.on_accept(addr[0], addr[1]):
+                self.reject()
                 return
+            if self.trace:
+                self.trace.mark(Phase.ON_ACCEPT)
 
         await self.handler_negotiation(reader, writer)
+        if self.trace:
+            self.trace.mark(Phase.AUTH)
         # Read the client's request for a connection
 
         # +----+-----+-------+------+----------+----------+
@@ -77,11 +115,14 @@ class Socks5ProxyServerProtocol(asyncio.StreamReaderProtocol):
         # | 1  |  1  | X'00' |  1   | Variable |    2     |
         # +----+-----+-------+------+----------+----------+
 
-        data = await reader.readexactly(3)
-        version, cmd, _ = unpack_data(data, "!BBB")
-        assert version == SOCKS5_VERSION
+        async with self.deadlines.phase(HANDSHAKE):
+            data = await reader.readexactly(3)
+            version, cmd, _ = unpack_data(data, "!BBB")
+            assert version == SOCKS5_VERSION
 
-        address_type, dst_addr, dst_port = await unpack_address_port(reader)
+            address_type, dst_addr, dst_port = await unpack_address_port(reader)
+        if self.trace:
+            self.trace.mark(Phase.HEADER)
 
         assert cmd in [Command.CONNECT.value, Command.UDP_ASSOCIATE.value]
 
@@ -103,11 +144,12 @@ class Socks5ProxyServerProtocol(asyncio.StreamReaderProtocol):
         # | 1  |    1     | 1 to 255 |
         # +----+----------+----------+
 
-        data = await reader.readexactly(2)
-        version, nmethods = unpack_data(data, "!BB")
-        assert version == SOCKS5_VERSION
+        async with self.deadlines.phase(HANDSHAKE):
+            data = await reader.readexactly(2)
+            version, nmethods = unpack_data(data, "!BB")
+            assert version == SOCKS5_VERSION
 
-        methods = await reader.readexactly(nmethods)
+            methods = await reader.readexactly(nmethods)
 
         auth_method = (
             self.allow_method.value
@@ -128,7 +170,8 @@ class Socks5ProxyServerProtocol(asyncio.StreamReaderProtocol):
         if self.allow_method == AuthenticationMethod.NO_AUTHENTICATION_REQUIRED:
             return True
         elif self.allow_method == AuthenticationMethod.USERNAME_PASSWORD:
-            return self.handler_password_auth(reader, writer)
+            async with self.deadlines.phase(AUTH):
+                return await self.handler_password_auth(reader, writer)
 
         return False
 
@@ -151,6 +194,9 @@ class Socks5ProxyServerProtocol(asyncio.StreamReaderProtocol):
 
         # delegate the verification
         authenticated = self.on_auth(username.decode(), password.decode())
+        self.record_auth(username.decode(), authenticated)
+        if not authenticated:
+            self.reject()
 
         # +----+--------+
         # |VER | STATUS |
@@ -170,24 +216,57 @@ class Socks5ProxyServerProtocol(asyncio.StreamReaderProtocol):
         dst_addr,
         dst_port,
     ):
-        remote_reader, remote_writer = await asyncio.open_connection(dst_addr, dst_port)
         # +----+-----+-------+------+----------+----------+
         # |VER | REP |  RSV  | ATYP | BND.ADDR | BND.PORT |
         # +----+-----+-------+------+----------+----------+
         # | 1  |  1  | X'00' |  1   | Variable |    2     |
         # +----+-----+-------+------+----------+----------+
 
-        # TODO: send status after create connection
+        # the bound address is not reported, so the reply does not depend on
+        # the upstream connection and may go out before it exists
         response = generate_response(
             ResponseCode.SUCCEEDED,
             address_type=AddressType.IPV4_ADDRESS,
             bind_addr="0.0.0.0",
             bind_port=0,
         )
-        writer.write(response)
-        await writer.drain()
-
-        await relay_stream((reader, writer), (remote_reader, remote_writer))
+        try:
+            remote_reader, remote_writer = await self.open_tunnel(
+                dst_addr, dst_port, writer, response
+            )
+        except CircuitOpen as e:
+            if not self.replied:
+                code = (
+                    ResponseCode.HOST_UNREACHABLE
+                    if e.timed_out
+                    else ResponseCode.CONNECTION_REFUSED
+                )
+                writer.write(
+                    generate_response(code, AddressType.IPV4_ADDRESS, "0.0.0.0", 0)
+                )
+            self.reject()
+            return
+        except asyncio.TimeoutError:
+            if not self.replied:
+                writer.write(
+                    generate_response(
+                        ResponseCode.TTL_EXPIRED, AddressType.IPV4_ADDRESS, "0.0.0.0", 0
+                    )
+                )
+            raise
+        except OSError as e:
+            if e is not self.dial_error:
+                raise
+            if not self.replied:
+                writer.write(
+                    generate_response(
+                        dial_error_code(e), AddressType.IPV4_ADDRESS, "0.0.0.0", 0
+                    )
+                )
+            self.dial_failed(e)
+            return
+
+        await self.relay((reader, writer), (remote_reader, remote_writer))
 
     async def handler_udp_associate(
         self,
@@ -225,23 +304,41 @@ class Socks5ProxyServerProtocol(asyncio.StreamReaderProtocol):
             writer.write(response)
             await writer.drain()
 
-            while not stop_event.is_set():
-                try:
-                    data = await asyncio.wait_for(reader.read(1), 1)
-                except asyncio.TimeoutError:
-                    continue
+            # the association ends with the TCP connection it arrived on, or
+            # when the UDP side stops on its own
+            closed = asyncio.ensure_future(read_until_eof(reader))
+            stopped = asyncio.ensure_future(stop_event.wait())
+            await asyncio.wait([closed, stopped], return_when=asyncio.FIRST_COMPLETED)
+            closed.cancel()
+            stopped.cancel()
+            stop_event.set()
+
+
+async def read_until_eof(reader: StreamReader):
+    while await reader.read(4096):
+        pass
+
 
-                if data == b"":
-                    stop_event.set()
-                    break
+def dial_error_code(e: OSError) -> ResponseCode:
+    if isinstance(e, ConnectionRefusedError):
+        return ResponseCode.CONNECTION_REFUSED
+    if isinstance(e, ProxyError):
+        # the parent proxy, not the destination
+        return ResponseCode.GENERAL_FAILURE
+    return ResponseCode.HOST_UNREACHABLE
 
 
 async def main():
     host, port = "127.0.0.1", 1080
     loop = asyncio.get_event_loop()
+    # kill -USR1 dumps the recent connection events to the working directory
+    recorder = FlightRecorder()
+    recorder.install_signal_handler()
     server = await loop.create_server(
         lambda: Socks5ProxyServerProtocol(
-            on_accept=lambda addr, port: True, on_connect=lambda addr, port: True
+            on_accept=lambda addr, port: True,
+            on_connect=lambda addr, port: True,
+            flight_recorder=recorder,
         ),
         host,
         port,
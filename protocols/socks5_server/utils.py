@@ -61,7 +61,7 @@ def pack_address_port(addr, port, address_type: Optional[AddressType] = None):
     elif address_type == AddressType.IPV6_ADDRESS:
         bind_addr_bytes = inet_pton(socket.AF_INET6, addr)
     else:
-        bind_addr_bytes = struct.pack("!H", len(addr)) + addr.encode()
+        bind_addr_bytes = struct.pack("!B", len(addr)) + addr.encode()
 
     return (
         struct.pack("!B", address_type.value)
@@ -1,6 +1,8 @@
 import asyncio
 from asyncio import StreamReader
 
+from protocols.capture.format import Capture, RecordType
+
 
 def create_stream_reader_from_file(file: str) -> StreamReader:
     r = StreamReader()
@@ -15,3 +17,37 @@ def create_stream_reader_from_file(file: str) -> StreamReader:
     loop.create_task(feed())
 
     return r
+
+
+def create_stream_reader_from_capture(
+    file: str,
+    conn_id: int,
+    record_type: RecordType = RecordType.SERVER,
+    speed: float = 0,
+) -> StreamReader:
+    """
+    Feed one side of a recorded connection, chunk by chunk; with a ``speed``
+    the chunks arrive with their recorded spacing divided by it.
+    """
+    r = StreamReader()
+
+    async def feed():
+        with Capture(file) as capture:
+            chunks = [
+                (record.timestamp, bytes(record.payload))
+                for record in capture.connections()[conn_id]
+                if record.type == record_type
+            ]
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for timestamp, data in chunks:
+            if speed:
+                at = started + (timestamp - chunks[0][0]) / 1e9 / speed
+                await asyncio.sleep(max(0.0, at - loop.time()))
+            r.feed_data(data)
+        r.feed_eof()
+
+    loop = asyncio.get_event_loop()
+    loop.create_task(feed())
+
+    return r
@@ -0,0 +1,326 @@
+import asyncio
+import itertools
+import os
+import re
+import struct
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from protocols.postgres.auth import md5_password
+from protocols.postgres.messages import (
+    AUTH_CLEARTEXT_PASSWORD,
+    AUTH_MD5_PASSWORD,
+    AUTH_OK,
+    CANCEL_REQUEST,
+    FAILED_TRANSACTION,
+    HEADER,
+    IDLE,
+    IN_TRANSACTION,
+    OID_INT4,
+    OID_TEXT,
+    SSL_REQUEST,
+    authentication,
+    backend_key_data,
+    command_complete,
+    data_row,
+    error_response,
+    message,
+    parameter_status,
+    parse_startup_parameters,
+    ready_for_query,
+    row_description,
+)
+
+# row description, rows, command tag
+Result = Tuple[List[Tuple[str, int]], List[List[Optional[bytes]]], str]
+
+
+class FakePostgres:
+    """
+    Just enough of a PostgreSQL backend for tests; use an instance as the
+    protocol factory of ``create_server``.
+
+    Both query protocols understand BEGIN, COMMIT/ROLLBACK, FAIL (raises an
+    error), ``SELECT generate_series(a, b)`` and ``SELECT`` of a list of
+    integer or quoted literals, NULL, ``$n`` and ``pg_backend_pid()``;
+    anything else just completes. ``COPY t FROM STDIN`` and ``COPY t TO
+    STDOUT`` move lines in and out of ``tables``.
+    """
+
+    def __init__(self, auth: int = AUTH_OK, password: str = ""):
+        self.auth = auth
+        self.password = password
+        self.process_ids = itertools.count(1000)
+        self.connections = 0
+        self.active = 0
+        self.queries: List[str] = []
+        self.cancelled: List[Tuple[int, int]] = []
+        self.sessions: List["FakePostgresProtocol"] = []
+        self.tables: Dict[str, bytearray] = {}
+
+    def __call__(self) -> "FakePostgresProtocol":
+        return FakePostgresProtocol(self)
+
+
+class FakePostgresProtocol(asyncio.Protocol):
+    transport: asyncio.Transport
+    user = ""
+    salt = b""
+
+    def __init__(self, server: FakePostgres):
+        self.server = server
+        self.buffer = bytearray()
+        self.started = False
+        self.authenticated = False
+        self.status = IDLE
+        self.process_id = 0
+        self.secret_key = 0
+        self.statements: Dict[bytes, str] = {}
+        self.portals: Dict[bytes, Tuple[str, List[Optional[bytes]]]] = {}
+        # after an error, extended protocol messages are ignored up to Sync
+        self.skipping = False
+        self.copy_table: Optional[str] = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc: Optional[Exception]):
+        if self.process_id:
+            self.server.active -= 1
+
+    def data_received(self, data: bytes):
+        self.buffer += data
+        while not self.transport.is_closing():
+            if not self.started:
+                if len(self.buffer) < 4:
+                    return
+                (length,) = struct.unpack_from("!I", self.buffer)
+                if len(self.buffer) < length:
+                    return
+                packet = bytes(self.buffer[4:length])
+                del self.buffer[:length]
+                self.startup(packet)
+                continue
+            if len(self.buffer) < HEADER.size:
+                return
+            message_type, length = HEADER.unpack_from(self.buffer)
+            if len(self.buffer) < length + 1:
+                return
+            payload = bytes(self.buffer[HEADER.size : length + 1])
+            del self.buffer[: length + 1]
+            self.handle(message_type, payload)
+
+    def startup(self, packet: bytes):
+        (code,) = struct.unpack_from("!I", packet)
+        if code == SSL_REQUEST:
+            self.transport.write(b"N")
+            return
+        if code == CANCEL_REQUEST:
+            self.server.cancelled.append(struct.unpack_from("!II", packet, 4))
+            self.transport.close()
+            return
+        self.started = True
+        self.user = parse_startup_parameters(packet[4:]).get("user", "")
+        if self.server.auth == AUTH_OK:
+            self.login()
+        elif self.server.auth == AUTH_MD5_PASSWORD:
+            self.salt = os.urandom(4)
+            self.transport.write(authentication(AUTH_MD5_PASSWORD, self.salt))
+        else:
+            self.transport.write(authentication(AUTH_CLEARTEXT_PASSWORD))
+
+    def login(self):
+        self.authenticated = True
+        self.process_id = next(self.server.process_ids)
+        self.secret_key = self.process_id * 7
+        self.server.connections += 1
+        self.server.active += 1
+        self.server.sessions.append(self)
+        self.transport.write(
+            authentication(AUTH_OK)
+            + parameter_status("server_version", "16.0")
+            + parameter_status("client_encoding", "UTF8")
+            + backend_key_data(self.process_id, self.secret_key)
+            + ready_for_query()
+        )
+
+    def handle(self, message_type: bytes, payload: bytes):
+        if not self.authenticated:
+            password = payload.rstrip(b"\0").decode()
+            expected = self.server.password
+            if self.server.auth == AUTH_MD5_PASSWORD:
+                expected = md5_password(self.user, expected, self.salt)
+            if message_type != b"p" or password != expected:
+                self.transport.write(error_response("bad password", "28P01"))
+                self.transport.close()
+                return
+            self.login()
+        elif message_type == b"X":
+            self.transport.close()
+        elif self.copy_table is not None:
+            self.copy_in(message_type, payload)
+        elif message_type == b"Q":
+            self.simple_query(payload.rstrip(b"\0").decode())
+        elif message_type == b"S":
+            self.skipping = False
+            self.transport.write(ready_for_query(self.status))
+        elif not self.skipping:
+            try:
+                self.extended(message_type, payload)
+            except FakeError as e:
+                self.fail(e)
+                self.skipping = True
+
+    def fail(self, error: "FakeError"):
+        if self.status == IN_TRANSACTION:
+            self.status = FAILED_TRANSACTION
+        self.transport.write(error_response(str(error), error.code, "ERROR"))
+
+    def simple_query(self, sql: str):
+        for statement in filter(None, (part.strip() for part in sql.split(";"))):
+            self.server.queries.append(statement)
+            words = statement.split()
+            if words[0].upper() == "COPY":
+                if self.copy(words):
+                    # ReadyForQuery comes after the CopyDone
+                    return
+                continue
+            try:
+                fields, rows, tag = self.run(statement)
+            except FakeError as e:
+                self.fail(e)
+                break
+            if fields:
+                self.transport.write(row_description(fields))
+            self.transport.write(b"".join(data_row(row) for row in rows))
+            self.transport.write(command_complete(tag))
+        self.transport.write(ready_for_query(self.status))
+
+    def extended(self, message_type: bytes, payload: bytes):
+        if message_type == b"P":
+            name, text, _ = payload.split(b"\0", 2)
+            self.statements[name] = text.decode()
+            self.transport.write(message(b"1"))
+        elif message_type == b"B":
+            portal, name, rest = payload.split(b"\0", 2)
+            (formats,) = struct.unpack_from("!H", rest)
+            offset = 2 + 2 * formats
+            (count,) = struct.unpack_from("!H", rest, offset)
+            offset += 2
+            params: List[Optional[bytes]] = []
+            for _ in range(count):
+                (length,) = struct.unpack_from("!i", rest, offset)
+                offset += 4
+                params.append(None if length < 0 else rest[offset : offset + length])
+                offset += max(length, 0)
+            self.portals[portal] = (self.statements[name], params)
+            self.transport.write(message(b"2"))
+        elif message_type == b"D":
+            name = payload[1:].rstrip(b"\0")
+            if payload[:1] == b"S":
+                sql = self.statements[name]
+                count = max(map(int, re.findall(r"\$(\d+)", sql)), default=0)
+                self.transport.write(
+                    message(
+                        b"t",
+                        struct.pack("!H", count) + struct.pack("!I", OID_TEXT) * count,
+                    )
+                )
+                fields = self.describe(sql, [None] * count)
+            else:
+                fields = self.describe(*self.portals[name])
+            self.transport.write(row_description(fields) if fields else message(b"n"))
+        elif message_type == b"E":
+            portal = payload.split(b"\0", 1)[0]
+            sql, params = self.portals[portal]
+            self.server.queries.append(sql)
+            _, rows, tag = self.run(sql, params)
+            self.transport.write(b"".join(data_row(row) for row in rows))
+            self.transport.write(command_complete(tag))
+        elif message_type == b"C":
+            if payload[:1] == b"S":
+                self.statements.pop(payload[1:].rstrip(b"\0"), None)
+            self.transport.write(message(b"3"))
+
+    def describe(self, sql: str, params: Sequence[Optional[bytes]]):
+        words = sql.split(None, 1)
+        if words[0].upper() != "SELECT":
+            return []
+        return self.select(words[1], params)[0]
+
+    def run(self, sql: str, params: Sequence[Optional[bytes]] = ()) -> Result:
+        words = sql.split(None, 1)
+        command = words[0].upper()
+        if self.status == FAILED_TRANSACTION and command not in ("ROLLBACK", "COMMIT"):
+            raise FakeError("current transaction is aborted", "25P02")
+        if command == "BEGIN":
+            self.status = IN_TRANSACTION
+        elif command in ("COMMIT", "ROLLBACK"):
+            command = "ROLLBACK" if self.status == FAILED_TRANSACTION else command
+            self.status = IDLE
+        elif command == "FAIL":
+            raise FakeError("failed", "P0001")
+        elif command == "SELECT":
+            fields, rows = self.select(words[1], params)
+            return fields, rows, f"SELECT {len(rows)}"
+        return [], [], command
+
+    def select(self, expressions: str, params: Sequence[Optional[bytes]]):
+        series = re.fullmatch(r"generate_series\((\d+), *(\d+)\)", expressions)
+        if series:
+            start, stop = int(series[1]), int(series[2])
+            rows = [[str(i).encode()] for i in range(start, stop + 1)]
+            return [("generate_series", OID_INT4)], rows
+        fields, row = [], []
+        for expression in expressions.split(","):
+            name, oid, value = self.evaluate(expression.strip(), params)
+            fields.append((name, oid))
+            row.append(value)
+        return fields, [row]
+
+    def evaluate(self, expression: str, params: Sequence[Optional[bytes]]):
+        if expression.startswith("$"):
+            return "?column?", OID_TEXT, params[int(expression[1:]) - 1]
+        if expression.startswith("'"):
+            return "?column?", OID_TEXT, expression.strip("'").encode()
+        if expression.upper() == "NULL":
+            return "?column?", OID_TEXT, None
+        if expression == "pg_backend_pid()":
+            return "pg_backend_pid", OID_INT4, str(self.process_id).encode()
+        if expression.lstrip("-").isdigit():
+            return "?column?", OID_INT4, expression.encode()
+        raise FakeError(f'column "{expression}" does not exist', "42703")
+
+    def copy(self, words: List[str]) -> bool:
+        # COPY table FROM STDIN | COPY table TO STDOUT, one column of text
+        table, direction = words[1], words[2].upper()
+        response = struct.pack("!BHH", 0, 1, 0)
+        if direction == "FROM":
+            self.copy_table = table
+            self.server.tables[table] = bytearray()
+            self.transport.write(message(b"G", response))
+            return True
+        lines = self.server.tables.get(table, bytearray()).splitlines(keepends=True)
+        self.transport.write(message(b"H", response))
+        self.transport.write(b"".join(message(b"d", line) for line in lines))
+        self.transport.write(message(b"c") + command_complete(f"COPY {len(lines)}"))
+        return False
+
+    def copy_in(self, message_type: bytes, payload: bytes):
+        assert self.copy_table is not None
+        table, self.copy_table = self.copy_table, None
+        if message_type == b"d":
+            self.server.tables[table] += payload
+            self.copy_table = table
+            return
+        if message_type == b"c":
+            lines = self.server.tables[table].count(b"\n")
+            self.transport.write(command_complete(f"COPY {lines}"))
+        else:
+            self.fail(FakeError("COPY from stdin failed", "57014"))
+        self.transport.write(ready_for_query(self.status))
+
+
+class FakeError(Exception):
+    def __init__(self, text: str, code: str):
+        super().__init__(text)
+        self.code = code
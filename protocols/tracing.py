@@ -0,0 +1,200 @@
+import itertools
+import json
+import random
+import threading
+import time
+from array import array
+from collections import Counter, deque
+from enum import IntEnum
+from typing import Callable, Deque, List, Optional
+
+
+class Phase(IntEnum):
+    ACCEPT = 0
+    # on_accept returned
+    ON_ACCEPT = 1
+    # the request (HTTP header, SOCKS5 CONNECT) was read
+    HEADER = 2
+    # authentication finished
+    AUTH = 3
+    # the upstream host name was resolved
+    RESOLVE = 4
+    # the upstream connection is open
+    CONNECT = 5
+    # the first upstream byte was passed on to the client
+    FIRST_BYTE = 6
+    CLOSE = 7
+
+
+class ConnectionTrace:
+    """
+    Monotonic nanosecond timestamps of one connection's phases; a phase that
+    never happened stays 0.
+    """
+
+    __slots__ = (
+        "tracer",
+        "conn_id",
+        "protocol",
+        "peer",
+        "target",
+        "marks",
+        "sent",
+        "received",
+        "error",
+    )
+
+    def __init__(self, tracer: "Tracer", conn_id: int, protocol: str, peer: str):
+        self.tracer = tracer
+        self.conn_id = conn_id
+        self.protocol = protocol
+        self.peer = peer
+        self.target = ""
+        self.marks = array("q", bytes(8 * len(Phase)))
+        self.sent = 0
+        self.received = 0
+        self.error = ""
+        self.marks[Phase.ACCEPT] = time.monotonic_ns()
+
+    def mark(self, phase: Phase):
+        self.marks[phase] = time.monotonic_ns()
+
+    def mark_first_byte(self):
+        if not self.marks[Phase.FIRST_BYTE]:
+            self.mark(Phase.FIRST_BYTE)
+
+    def close(self, sent: int = 0, received: int = 0):
+        if self.marks[Phase.CLOSE]:
+            return
+        self.mark(Phase.CLOSE)
+        self.sent = sent
+        self.received = received
+        self.tracer.sink(self)
+
+    def duration(self, phase: Phase) -> Optional[float]:
+        """
+        Seconds from accepting the connection to ``phase``.
+        """
+        if not self.marks[phase]:
+            return None
+        return (self.marks[phase] - self.marks[Phase.ACCEPT]) / 1e9
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.conn_id,
+            "protocol": self.protocol,
+            "peer": self.peer,
+            "target": self.target,
+            # microseconds since accept, in the order they happened
+            "phases": {
+                phase.name.lower(): (self.marks[phase] - self.marks[Phase.ACCEPT])
+                // 1000
+                for phase in sorted(Phase, key=lambda phase: self.marks[phase])
+                if self.marks[phase]
+            },
+            "sent": self.sent,
+            "received": self.received,
+            "error": self.error,
+        }
+
+
+Sink = Callable[[ConnectionTrace], None]
+
+
+class RingBufferSink:
+    """
+    Keeps the last ``capacity`` traces in memory.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.traces: Deque[ConnectionTrace] = deque(maxlen=capacity)
+
+    def __call__(self, trace: ConnectionTrace):
+        self.traces.append(trace)
+
+    def snapshot(self) -> List[dict]:
+        return [trace.to_dict() for trace in self.traces]
+
+
+class JsonLinesSink:
+    """
+    One JSON line per trace, written by a background thread as the access
+    log does: the loop only queues the finished trace. Past ``max_queue``
+    waiting traces new ones are dropped and counted.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_queue: int = 65536,
+        batch_size: int = 1024,
+        flush_interval: float = 1.0,
+    ):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.stats: Counter = Counter()
+
+        self.queue: Deque[ConnectionTrace] = deque()
+        self.wakeup = threading.Event()
+        self.closed = False
+        self.file = open(path, "a")
+        self.thread = threading.Thread(target=self.run, name="traces", daemon=True)
+        self.thread.start()
+
+    def __call__(self, trace: ConnectionTrace):
+        queue = self.queue
+        if len(queue) >= self.max_queue:
+            self.stats["dropped"] += 1
+            return
+        queue.append(trace)
+        if len(queue) == self.batch_size:
+            self.wakeup.set()
+
+    def run(self):
+        while not self.closed:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            self.flush()
+        self.flush()
+
+    def flush(self):
+        queue = self.queue
+        while queue:
+            batch: List[str] = []
+            while queue and len(batch) < self.batch_size:
+                batch.append(json.dumps(queue.popleft().to_dict()) + "\n")
+            self.file.write("".join(batch))
+            self.stats["written"] += len(batch)
+            self.stats["batches"] += 1
+        self.file.flush()
+
+    def close(self, timeout: Optional[float] = None):
+        """
+        Writes what is still queued and stops the thread.
+        """
+        self.closed = True
+        self.wakeup.set()
+        self.thread.join(timeout)
+        self.file.close()
+
+
+class Tracer:
+    """
+    Hands out a ConnectionTrace for ``sample_rate`` of the connections; the
+    others get None, so an unsampled connection costs a single check per
+    phase.
+    """
+
+    def __init__(self, sample_rate: float = 1.0, sink: Optional[Sink] = None):
+        self.sample_rate = sample_rate
+        self.sink: Sink = sink or RingBufferSink()
+        self.conn_ids = itertools.count(1)
+
+    def start(self, protocol: str, peer) -> Optional[ConnectionTrace]:
+        if self.sample_rate <= 0:
+            return None
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return None
+        host, port = peer[:2] if peer else ("", 0)
+        return ConnectionTrace(self, next(self.conn_ids), protocol, f"{host}:{port}")
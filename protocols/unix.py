@@ -0,0 +1,25 @@
+import asyncio
+from typing import Callable
+
+from protocols.forward import StreamPair
+
+
+def unix_address(path: str) -> str:
+    """
+    ``@name`` is the Linux abstract socket ``name``, which lives in the
+    network namespace rather than the file system; anything else is a path.
+    """
+    return "\0" + path[1:] if path.startswith("@") else path
+
+
+async def open_unix_connection(path: str) -> StreamPair:
+    return await asyncio.open_unix_connection(unix_address(path))
+
+
+async def create_unix_server(
+    factory: Callable[[], asyncio.BaseProtocol], path: str, backlog: int = 100
+) -> asyncio.AbstractServer:
+    # a stale socket file left by a previous run is replaced by asyncio
+    return await asyncio.get_running_loop().create_unix_server(
+        factory, unix_address(path), backlog=backlog
+    )